@@ -0,0 +1,53 @@
+"""Micro-benchmark de la construcción del contexto.
+
+Mide cuánto cuesta _get_context para distintos tamaños de memoria.
+Como los mensajes se renderizan al guardarlos, el coste debe
+mantenerse plano aunque crezca MEMORY_SIZE.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_context.py
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from dogimobot import settings  # noqa: E402
+from dogimobot.main import DiscordClient  # noqa: E402
+from dogimobot.memory import ConversationStore  # noqa: E402
+
+MEMORY_SIZES = [10, 100, 1_000, 10_000]
+REPEAT = 200
+
+
+def fake_message(content: str) -> SimpleNamespace:
+    """Mensaje mínimo con los atributos que usa el bot"""
+    return SimpleNamespace(
+        content=content,
+        author=SimpleNamespace(name=next(iter(settings.USERS)), bot=False),
+        attachments=[],
+        guild=SimpleNamespace(id=1),
+        channel=SimpleNamespace(id=1),
+    )
+
+
+def bench(memory_size: int) -> float:
+    client = DiscordClient(intents=None)
+    client.memory = ConversationStore(
+        window_size=memory_size, max_messages=memory_size
+    )
+    message = fake_message(f"{settings.CHAT_COMMAND} ¿Qué es la regularización L2?")
+    for _ in range(memory_size):
+        client._save_in_memory(message)
+    seconds = timeit.timeit(lambda: client._get_context(message), number=REPEAT)
+    return seconds / REPEAT * 1e6
+
+
+if __name__ == "__main__":
+    print(f"{'MEMORY_SIZE':>12} | {'_get_context (µs)':>18}")
+    for size in MEMORY_SIZES:
+        print(f"{size:>12} | {bench(size):>18.1f}")
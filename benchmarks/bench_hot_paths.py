@@ -0,0 +1,343 @@
+"""Suite de micro-benchmarks de los caminos calientes del bot.
+
+Mide sin conexión, con mensajes de discord falsos, el tiempo medio de:
+    _get_context y _save_in_memory para distintos tamaños de
+    memoria y proporciones de mensajes con adjuntos,
+    RateLimiter.limit, BotStats.add_user_stats y format_stats
+    para distintos números de usuarios.
+
+Los resultados se guardan en JSON. Con --save se guardan como
+baseline y con --check se comparan con ella: el script falla si
+algún caso es más lento que la baseline multiplicada por el umbral.
+Antes de cada caso se mide también un bucle de referencia en
+Python puro y los tiempos se corrigen con la mediana de esas
+medidas, así que influye poco lo cargada que esté la máquina.
+Los casos que salen más lentos se repiten antes de darlos por
+regresión. Aun así la baseline se debe regenerar si cambia la
+versión de Python.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_hot_paths.py
+    python benchmarks/bench_hot_paths.py --save
+    python benchmarks/bench_hot_paths.py --check --threshold 1.5
+"""
+
+import argparse
+from functools import partial
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import sys
+from types import SimpleNamespace
+import timeit
+from typing import Any, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from dogimobot import settings  # noqa: E402
+from dogimobot.formatters import format_stats  # noqa: E402
+from dogimobot.main import DiscordClient  # noqa: E402
+from dogimobot.memory import ConversationStore  # noqa: E402
+from dogimobot.rate_limiting import RateLimiter  # noqa: E402
+from dogimobot.stats import BotStats  # noqa: E402
+
+BASELINE = Path(__file__).parent / "baseline.json"
+DEFAULT_THRESHOLD = 1.5  # más de un 50% más lento es una regresión
+RECHECKS = 2  # veces que se repite un caso lento antes de darlo por regresión
+
+MEMORY_SIZES = [10, 100, 1_000, 10_000]
+ATTACHMENT_RATIOS = [0.0, 0.5]  # fracción de mensajes con adjuntos
+USER_COUNTS = [1, 100, 1_000]
+
+
+def fake_attachment(index: int) -> SimpleNamespace:
+    return SimpleNamespace(content_type="image/png", filename=f"imagen_{index}.png")
+
+
+def fake_message(
+    content: str, author: str, with_attachments: bool = False
+) -> SimpleNamespace:
+    """Mensaje mínimo con los atributos que usa el bot"""
+    return SimpleNamespace(
+        content=content,
+        author=SimpleNamespace(name=author, bot=False),
+        attachments=(
+            [fake_attachment(0), fake_attachment(1)] if with_attachments else []
+        ),
+        guild=SimpleNamespace(id=1),
+        channel=SimpleNamespace(id=1),
+    )
+
+
+def fake_users(count: int) -> list[str]:
+    """Nombres de usuarios conocidos por el bot. Los que faltan
+    se añaden a settings.USERS con un nombre propio inventado"""
+    users = [f"usuario_{i}" for i in range(count)]
+    for user in users:
+        settings.USERS.setdefault(user, user.capitalize())
+    return users
+
+
+def messages_with_attachments(count: int, ratio: float) -> list[SimpleNamespace]:
+    """Mensajes de un mismo canal donde una fracción
+    ratio lleva adjuntos, repartidos uniformemente"""
+    author = next(iter(settings.USERS))
+    every = round(1 / ratio) if ratio else 0
+    return [
+        fake_message(
+            f"{settings.CHAT_COMMAND} pregunta número {i} sobre regularización L2",
+            author,
+            with_attachments=bool(every) and i % every == 0,
+        )
+        for i in range(count)
+    ]
+
+
+def client_with_memory(memory_size: int, ratio: float) -> DiscordClient:
+    client = DiscordClient(intents=None)
+    client.memory = ConversationStore(window_size=memory_size, max_messages=memory_size)
+    for message in messages_with_attachments(memory_size, ratio):
+        client._save_in_memory(message)  # type: ignore[arg-type]
+    return client
+
+
+def measure(func: Callable[[], Any]) -> float:
+    """Microsegundos por llamada. Se toma la mejor de cinco
+    rondas de al menos 0.2 segundos cada una"""
+    func()  # calentamiento
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=number))
+    return best / number * 1e6
+
+
+def reference() -> list[str]:
+    """Carga de referencia con operaciones parecidas a las del bot"""
+    table = {}
+    for i in range(200):
+        table[str(i)] = f"{i}: {i * 2}"
+    return sorted(table)
+
+
+def bench_get_context(memory_size: int, ratio: float) -> float:
+    client = client_with_memory(memory_size, ratio)
+    message = messages_with_attachments(1, ratio)[0]
+    return measure(lambda: client._get_context(message))  # type: ignore[arg-type]
+
+
+def bench_save_in_memory(memory_size: int, ratio: float) -> float:
+    # La memoria ya está llena, así que se mide también el desalojo
+    client = client_with_memory(memory_size, ratio)
+    messages = messages_with_attachments(100, ratio)
+    index = 0
+
+    def save() -> None:
+        nonlocal index
+        client._save_in_memory(messages[index % len(messages)])  # type: ignore[arg-type]
+        index += 1
+
+    return measure(save)
+
+
+def bench_rate_limit(users: int) -> float:
+    RateLimiter.reset()
+    # Con límites muy altos se mide el camino en que se admite la petición
+    limited = RateLimiter.limit(msg_per_minute=10**9, rate_time=60)(
+        lambda message, context: None
+    )
+    messages = [fake_message("hola", user) for user in fake_users(users)]
+    global_limits = (
+        settings.GLOBAL_MAX_MSG_PER_MINUTE,
+        settings.GLOBAL_MAX_TOKENS_PER_MINUTE,
+    )
+    settings.GLOBAL_MAX_MSG_PER_MINUTE = 10**9
+    settings.GLOBAL_MAX_TOKENS_PER_MINUTE = 10**9
+    index = 0
+
+    def call() -> None:
+        nonlocal index
+        limited(message=messages[index % users], context=[])
+        index += 1
+
+    try:
+        return measure(call)
+    finally:
+        (
+            settings.GLOBAL_MAX_MSG_PER_MINUTE,
+            settings.GLOBAL_MAX_TOKENS_PER_MINUTE,
+        ) = global_limits
+        RateLimiter.reset()
+
+
+def bench_add_user_stats(users: int) -> float:
+    bot_stats = BotStats()
+    messages = [fake_message("hola", user) for user in fake_users(users)]
+    index = 0
+
+    def add() -> None:
+        nonlocal index
+        bot_stats.add_user_stats(messages[index % users], 100, 0.001)  # type: ignore[arg-type]
+        index += 1
+
+    return measure(add)
+
+
+def bench_format_stats(users: int) -> float:
+    user_stats = {
+        user: {"tokens": 1_000, "cost": 0.01, "queries": 5}
+        for user in fake_users(users)
+    }
+    return measure(
+        lambda: format_stats(
+            template=settings.STATS_REPLY_TEMPLATE,
+            session_id="benchmark",
+            version="0.0.0",
+            model=settings.MODELO,
+            elapsed_days=0,
+            elapsed_hours=1,
+            elapsed_minutes=2,
+            elapsed_seconds=3,
+            total_tokens=1_000 * users,
+            total_queries=5 * users,
+            total_cost=0.01 * users,
+            user_stats=user_stats,
+            max_cost=0.005,
+            session_start_time="01/01/2024",
+        )
+    )
+
+
+def build_cases() -> dict[str, Callable[[], float]]:
+    """Casos de la suite: nombre -> función que devuelve
+    los microsegundos por llamada"""
+    cases: dict[str, Callable[[], float]] = {}
+    for size in MEMORY_SIZES:
+        for ratio in ATTACHMENT_RATIOS:
+            suffix = f"memory={size},attachments={ratio:.0%}"
+            cases[f"_get_context[{suffix}]"] = partial(bench_get_context, size, ratio)
+            cases[f"_save_in_memory[{suffix}]"] = partial(
+                bench_save_in_memory, size, ratio
+            )
+    for users in USER_COUNTS:
+        cases[f"RateLimiter.limit[users={users}]"] = partial(bench_rate_limit, users)
+        cases[f"BotStats.add_user_stats[users={users}]"] = partial(
+            bench_add_user_stats, users
+        )
+        cases[f"format_stats[users={users}]"] = partial(bench_format_stats, users)
+    return cases
+
+
+def run_cases(cases: dict[str, Callable[[], float]]) -> tuple[dict[str, float], float]:
+    """Ejecuta los casos midiendo el bucle de referencia antes de cada uno
+
+    Parameters
+    ----------
+    cases : dict[str, Callable[[], float]]
+        _description_
+
+    Returns
+    -------
+    tuple[dict[str, float], float]
+        Microsegundos por llamada de cada caso y mediana de
+        los microsegundos del bucle de referencia
+    """
+    results: dict[str, float] = {}
+    references: list[float] = []
+    for name, case in cases.items():
+        references.append(measure(reference))
+        results[name] = case()
+    return results, statistics.median(references)
+
+
+def compare(
+    results: dict[str, float],
+    reference_us: float,
+    baseline: dict[str, Any],
+    threshold: float,
+) -> dict[str, str]:
+    """Casos más lentos que la baseline por encima del umbral.
+    Se comparan los tiempos relativos al bucle de referencia
+
+    Parameters
+    ----------
+    results : dict[str, float]
+        Microsegundos por llamada de cada caso
+    reference_us : float
+        Microsegundos del bucle de referencia en esta ejecución
+    baseline : dict[str, Any]
+        Documento guardado con --save
+    threshold : float
+        Ratio máximo admitido entre el tiempo actual y el de la baseline
+
+    Returns
+    -------
+    dict[str, str]
+        Nombre del caso -> descripción de la regresión
+    """
+    # Cuánto más lenta va la máquina ahora que al guardar la baseline
+    drift = reference_us / baseline["reference_us"]
+    regressions = {}
+    for name, micros in results.items():
+        expected = baseline["results"].get(name)
+        if expected is None:
+            continue
+        ratio = micros / (expected * drift)
+        if ratio > threshold:
+            regressions[name] = (
+                f"{name}: {micros:.1f} µs frente a {expected:.1f} µs "
+                f"(x{ratio:.2f} descontando la carga de la máquina)"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="guarda la baseline")
+    parser.add_argument("--check", action="store_true", help="compara con la baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--output", type=Path, help="guarda aquí los resultados")
+    args = parser.parse_args()
+
+    cases = build_cases()
+    results, reference_us = run_cases(cases)
+    width = max(len(name) for name in results)
+    print(f"{'caso':<{width}} | {'tiempo (µs)':>12}")
+    for name, micros in results.items():
+        print(f"{name:<{width}} | {micros:>12.2f}")
+
+    document = {
+        "python": platform.python_version(),
+        "unit": "us_per_call",
+        "reference_us": reference_us,
+        "results": results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(document, indent=2), encoding="utf-8")
+    if args.save:
+        args.baseline.write_text(json.dumps(document, indent=2), encoding="utf-8")
+        print(f"Baseline guardada en {args.baseline}")
+    if args.check:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(results, reference_us, baseline, args.threshold)
+        # Los casos lentos se repiten para descartar ruido de la máquina
+        for _ in range(RECHECKS):
+            if not regressions:
+                break
+            slow = {name: cases[name] for name in regressions}
+            for name, micros in run_cases(slow)[0].items():
+                results[name] = min(results[name], micros)
+            regressions = compare(results, reference_us, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegresiones (umbral x{args.threshold}):")
+            print("\n".join(regressions.values()))
+            return 1
+        print(f"\nSin regresiones (umbral x{args.threshold})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""Micro-benchmark del arranque en frío de la memoria persistente.
+
+Rellena una base de datos SQLite con miles de mensajes repartidos
+en varios canales y mide cuánto tarda en cargarse la ventana
+reciente de una conversación.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_memory_load.py
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dogimobot import settings  # noqa: E402
+from dogimobot.memory import ConversationStore  # noqa: E402
+from dogimobot.persistence import SQLiteMemoryBackend  # noqa: E402
+
+STORED_MESSAGES = [1_000, 10_000, 100_000]
+CHANNELS = 20
+
+
+def fill(path: Path, total: int) -> None:
+    backend = SQLiteMemoryBackend(path)
+    for i in range(total):
+        content = f"mensaje {i}"
+        backend.enqueue(
+            (1, i % CHANNELS),
+            {
+                "role": "user",
+                "content": content,
+                "author": "testuser",
+                "time": "01/01/2024 a las 00:00:00",
+                "param": {"role": "user", "content": content},
+                "tokens": 10,
+            },
+        )
+    backend.close()
+
+
+def bench(total: int) -> float:
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "memory.db"
+        fill(path, total)
+        start = time.perf_counter()
+        store = ConversationStore(backend=SQLiteMemoryBackend(path))
+        store.get((1, 0))
+        elapsed = time.perf_counter() - start
+        store.backend.close()  # type: ignore[union-attr]
+    return elapsed * 1e3
+
+
+if __name__ == "__main__":
+    print(f"MEMORY_SIZE = {settings.MEMORY_SIZE}")
+    print(f"{'Mensajes guardados':>18} | {'Arranque + carga (ms)':>22}")
+    for total in STORED_MESSAGES:
+        print(f"{total:>18} | {bench(total):>22.2f}")
@@ -0,0 +1,77 @@
+"""Micro-benchmark del formateo de !help y !stats.
+
+Cuenta las lecturas de disco de las plantillas y mide el tiempo
+medio de formateo. Con el registro de plantillas, en régimen
+estacionario no debe haber ninguna lectura.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_templates.py
+"""
+
+import os
+from pathlib import Path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from dogimobot import settings  # noqa: E402
+from dogimobot.formatters import format_help, format_stats, templates  # noqa: E402
+
+REPEAT = 2_000
+
+reads = 0
+_read_text = Path.read_text
+
+
+def counting_read_text(self, *args, **kwargs):
+    """Path.read_text que cuenta las lecturas"""
+    global reads
+    reads += 1
+    return _read_text(self, *args, **kwargs)
+
+
+def render_help() -> str:
+    return format_help(
+        settings.HELP_REPLY_TEMPLATE,
+        chat_command=settings.CHAT_COMMAND,
+        stats_command=settings.INFO_COMMAND,
+        help_command=settings.HELP_COMMAND,
+    )
+
+
+def render_stats() -> str:
+    user = next(iter(settings.USERS))
+    return format_stats(
+        template=settings.STATS_REPLY_TEMPLATE,
+        session_id="benchmark",
+        version="0.0.0",
+        model=settings.MODELO,
+        elapsed_days=0,
+        elapsed_hours=1,
+        elapsed_minutes=2,
+        elapsed_seconds=3,
+        total_tokens=1234,
+        total_queries=5,
+        total_cost=0.01,
+        user_stats={user: {"tokens": 1234, "cost": 0.01, "queries": 5}},
+        max_cost=0.005,
+        session_start_time="01/01/2024",
+    )
+
+
+def bench(name: str, render) -> None:
+    global reads
+    render()  # calentamiento: primera lectura y compilación
+    reads = 0
+    seconds = timeit.timeit(render, number=REPEAT)
+    print(f"{name:>8} | {seconds / REPEAT * 1e6:>12.1f} | {reads:>8}")
+
+
+if __name__ == "__main__":
+    Path.read_text = counting_read_text  # type: ignore[method-assign]
+    templates.clear()
+    print(f"{'comando':>8} | {'tiempo (µs)':>12} | {'lecturas':>8}")
+    bench("!help", render_help)
+    bench("!stats", render_stats)
@@ -0,0 +1,322 @@
+"""Prueba de carga de extremo a extremo de DiscordClient.on_message.
+
+Genera un flujo sintético de mensajes de discord (usuarios, canales,
+mezcla de comandos y ritmo de llegada configurables) y los pasa por
+el handler completo, con el cliente de openAI apuntando al servidor
+local de benchmarks/openai_stub.py. No hace falta conexión con
+discord ni con openAI.
+
+Informa del throughput y la latencia (p50/p99) de las respuestas
+a !chat, medida desde que llega el mensaje hasta el último envío, el lag
+del event loop y el pico de memoria (RSS). Con --sweep se prueban
+varios ritmos de llegada seguidos para encontrar el punto de
+saturación: el ritmo a partir del cual el throughput deja de crecer
+y la latencia se dispara.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/load_test.py --rate 10 --duration 30
+    python benchmarks/load_test.py --sweep 5,10,20,40 --latency 1.0
+    python benchmarks/load_test.py --rate 20 --error-rate 0.1 --no-stream
+"""
+
+import argparse
+import asyncio
+import os
+import logging
+import random
+import resource
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+
+from openai_stub import OpenAIStub, StubConfig  # noqa: E402
+
+from dogimobot import settings  # noqa: E402
+from dogimobot.logging_config import listener  # noqa: E402
+
+# Intervalo de la sonda del lag del event loop
+LAG_INTERVAL = 0.05
+
+
+class FakeSentMessage:
+    """Mensaje enviado por el bot que se puede editar"""
+
+    def __init__(self, channel: "FakeChannel", content: str) -> None:
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content: str) -> None:
+        self.content = content
+        self.channel.edits += 1
+
+
+class FakeChannel:
+    """Canal de discord que solo cuenta lo que se envía"""
+
+    def __init__(self, channel_id: int, send_latency: float) -> None:
+        self.id = channel_id
+        self.send_latency = send_latency
+        self.sends: int = 0
+        self.edits: int = 0
+
+    async def send(self, content: str) -> FakeSentMessage:
+        # Simula el viaje de ida y vuelta a discord
+        await asyncio.sleep(self.send_latency)
+        self.sends += 1
+        return FakeSentMessage(self, content)
+
+
+class LagProbe:
+    """Mide cuánto se retrasa el event loop en despertar una tarea"""
+
+    def __init__(self, interval: float = LAG_INTERVAL) -> None:
+        self.interval = interval
+        self.samples: list[float] = []
+        self.task: Optional[asyncio.Task[None]] = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - start - self.interval)
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Percentil por rango más cercano. 0 si no hay valores"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb() -> float:
+    """Pico de memoria residente del proceso en MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # En macOS ru_maxrss está en bytes y en Linux en KB
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """Convierte "chat=0.8,stats=0.1,help=0.1" en pesos por comando"""
+    commands = {
+        "chat": settings.CHAT_COMMAND,
+        "stats": settings.INFO_COMMAND,
+        "help": settings.HELP_COMMAND,
+        "plain": "",
+    }
+    weights: dict[str, float] = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        weights[commands[name.strip()]] = float(weight)
+    return weights
+
+
+def configure(args: argparse.Namespace, base_url: str) -> None:
+    """Ajusta settings antes de crear el cliente. Se hace antes de
+    importar dogimobot.main porque el rate limit fija sus límites
+    al definir la clase"""
+    settings.OPENAI_BASE_URL = base_url
+    settings.STREAM_REPLIES = args.stream
+    settings.COALESCE_ENABLED = False
+    settings.PERSIST_MEMORY = False
+    settings.PERSIST_STATS = False
+    if not args.rate_limit:
+        settings.MAX_MSG_PER_MINUTES = 10**9
+        settings.MAX_TOKENS_PER_MINUTE = 10**9
+        settings.GLOBAL_MAX_MSG_PER_MINUTE = 10**9
+        settings.GLOBAL_MAX_TOKENS_PER_MINUTE = 10**9
+    if args.max_concurrency is not None:
+        settings.SCHEDULER_MAX_CONCURRENCY = args.max_concurrency
+    for i in range(args.users):
+        settings.USERS.setdefault(f"usuario_{i}", f"Usuario {i}")
+    # Se sigue escribiendo el log en fichero, pero no por pantalla
+    for handler in listener.handlers:
+        if type(handler) is logging.StreamHandler:
+            handler.setLevel(logging.WARNING)
+
+
+async def run_load(
+    args: argparse.Namespace, rate: float, stub: OpenAIStub
+) -> dict[str, Any]:
+    """Lanza mensajes a ritmo rate (llegadas de Poisson)
+    durante args.duration segundos y espera a que terminen
+
+    Returns
+    -------
+    dict[str, Any]
+        Métricas de la ejecución
+    """
+    from dogimobot.main import DiscordClient
+    from dogimobot.rate_limiting import RateLimiter
+
+    RateLimiter.reset()
+    client = DiscordClient(intents=None)
+    rng = random.Random(args.seed)
+    channels = [FakeChannel(i, args.send_latency) for i in range(args.channels)]
+    guild = SimpleNamespace(id=1)
+    mix = parse_mix(args.mix)
+    commands, weights = list(mix), list(mix.values())
+    latencies: list[float] = []
+    failures = completed = 0
+    pending: set[asyncio.Task[None]] = set()
+
+    async def handle(message: SimpleNamespace) -> None:
+        nonlocal failures, completed
+        start = time.perf_counter()
+        try:
+            await client.on_message(message)  # type: ignore[arg-type]
+        except Exception:
+            failures += 1
+            return
+        completed += 1
+        # La latencia y el throughput se miden sobre las respuestas de !chat
+        if message.content.startswith(settings.CHAT_COMMAND):
+            latencies.append(time.perf_counter() - start)
+
+    probe = LagProbe()
+    probe.start()
+    requests_before = stub.requests
+    started = time.perf_counter()
+    sent = 0
+    while time.perf_counter() - started < args.duration:
+        command = rng.choices(commands, weights)[0]
+        user = f"usuario_{rng.randrange(args.users)}"
+        message = SimpleNamespace(
+            content=f"{command} pregunta {sent} sobre redes neuronales".strip(),
+            author=SimpleNamespace(name=user, bot=False),
+            attachments=[],
+            guild=guild,
+            channel=rng.choice(channels),
+        )
+        task = asyncio.create_task(handle(message))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        sent += 1
+        await asyncio.sleep(rng.expovariate(rate))
+    if pending:
+        await asyncio.wait(pending)
+    elapsed = time.perf_counter() - started
+    await probe.stop()
+    await client.client_openai.close()
+
+    return {
+        "rate": rate,
+        "sent": sent,
+        "completed": completed,
+        "failures": failures,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "lag_p50": percentile(probe.samples, 0.5),
+        "lag_p99": percentile(probe.samples, 0.99),
+        "lag_max": max(probe.samples, default=0.0),
+        "rss_mb": peak_rss_mb(),
+        "openai_requests": stub.requests - requests_before,
+        "rate_limited": RateLimiter.rejections,
+        "retries": client.resilience.retries,
+        "openai_errors": client.resilience.failures,
+        "breaker_rejections": client.resilience.fast_failures,
+        "tokens": client.bot_stats.total_tokens,
+        "cost": client.bot_stats.total_cost,
+    }
+
+
+def print_report(results: list[dict[str, Any]]) -> None:
+    print(
+        f"{'ritmo/s':>8} | {'enviados':>8} | {'ok':>6} | {'fallos':>6} | "
+        f"{'chat/s':>7} | {'p50 (s)':>8} | {'p99 (s)':>8} | "
+        f"{'lag p99 (ms)':>12} | {'lag máx (ms)':>12} | {'RSS (MB)':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['rate']:>8.1f} | {result['sent']:>8} | "
+            f"{result['completed']:>6} | {result['failures']:>6} | "
+            f"{result['throughput']:>7.2f} | {result['p50']:>8.3f} | "
+            f"{result['p99']:>8.3f} | {result['lag_p99'] * 1000:>12.1f} | "
+            f"{result['lag_max'] * 1000:>12.1f} | {result['rss_mb']:>8.1f}"
+        )
+    last = results[-1]
+    print(
+        f"\nÚltima ejecución: {last['openai_requests']} peticiones al stub, "
+        f"{last['openai_errors']} errores de openAI, {last['retries']} reintentos, "
+        f"{last['breaker_rejections']} rechazos del circuit breaker, "
+        f"{last['rate_limited']} rechazos del rate limit, "
+        f"{last['tokens']} tokens (${last['cost']:.4f} simulados)"
+    )
+    if len(results) > 1:
+        best = max(results, key=lambda result: result["throughput"])
+        print(
+            f"Throughput máximo: {best['throughput']:.2f} respuestas de chat/s "
+            f"con {best['rate']:.1f} mensajes/s"
+        )
+
+
+async def main(args: argparse.Namespace) -> None:
+    stub = OpenAIStub(
+        StubConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            completion_tokens=args.completion_tokens,
+            error_rate=args.error_rate,
+            retry_after=args.retry_after,
+            seed=args.seed,
+        )
+    )
+    base_url = await stub.start()
+    configure(args, base_url)
+    rates = (
+        [float(rate) for rate in args.sweep.split(",")] if args.sweep else [args.rate]
+    )
+    results = []
+    try:
+        for rate in rates:
+            results.append(await run_load(args, rate, stub))
+    finally:
+        await stub.close()
+    print_report(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=5.0, help="mensajes por segundo")
+    parser.add_argument("--sweep", help="varios ritmos separados por comas")
+    parser.add_argument("--duration", type=float, default=20.0, help="segundos")
+    parser.add_argument(
+        "--mix",
+        default="chat=0.8,stats=0.05,help=0.05,plain=0.1",
+        help="pesos de chat, stats, help y plain (sin comando)",
+    )
+    parser.add_argument("--latency", type=float, default=0.5, help="latencia del stub")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--send-latency", type=float, default=0.05)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        "--rate-limit",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="aplica los límites de settings (por defecto se desactivan)",
+    )
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,245 @@
+"""Servidor local compatible con la API de chat completions de openAI.
+
+Responde a POST /v1/chat/completions con una respuesta inventada,
+con o sin streaming, tras una latencia configurable. Permite
+inyectar errores (429 con Retry-After y 503) para probar los
+reintentos y el circuit breaker sin gastar dinero.
+
+Lo usa benchmarks/load_test.py, pero también se puede arrancar
+solo y apuntar el bot a él con OPENAI_BASE_URL:
+    python benchmarks/openai_stub.py --port 8089 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Optional
+
+from aiohttp import web
+
+WORDS = (
+    "la regularización penaliza los pesos grandes del modelo para "
+    "reducir el sobreajuste y mejorar la generalización en datos nuevos"
+).split()
+
+
+class StubConfig:
+    """Comportamiento del servidor"""
+
+    def __init__(
+        self,
+        latency: float = 0.5,
+        jitter: float = 0.1,
+        completion_tokens: int = 100,
+        error_rate: float = 0.0,
+        retry_after: float = 1.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        """Inicializa la configuración
+
+        Parameters
+        ----------
+        latency : float, optional
+            Segundos medios hasta terminar la respuesta
+        jitter : float, optional
+            Variación máxima (+-) de la latencia en segundos
+        completion_tokens : int, optional
+            Tokens de cada respuesta (uno por chunk en streaming)
+        error_rate : float, optional
+            Fracción de peticiones que fallan. La mitad con 429
+            y la otra mitad con 503
+        retry_after : float, optional
+            Segundos de la cabecera Retry-After de los 429
+        seed : Optional[int], optional
+            Semilla para que las ejecuciones sean repetibles
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+
+class OpenAIStub:
+    """Aplicación aiohttp con los contadores del servidor"""
+
+    def __init__(self, config: StubConfig) -> None:
+        self.config = config
+        self.requests: int = 0
+        self.errors: int = 0
+        self.in_flight: int = 0
+        self.max_in_flight: int = 0
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.runner: Optional[web.AppRunner] = None
+
+    def _latency(self) -> float:
+        jitter = self.config.random.uniform(-self.config.jitter, self.config.jitter)
+        return max(0.0, self.config.latency + jitter)
+
+    @staticmethod
+    def _prompt_tokens(body: dict[str, Any]) -> int:
+        """Aproximación de los tokens del prompt: palabras + 4 por mensaje"""
+        return sum(
+            len(str(message.get("content", "")).split()) + 4
+            for message in body.get("messages", [])
+        )
+
+    def _error(self) -> Optional[web.Response]:
+        """Respuesta de error si toca inyectar uno"""
+        if self.config.random.random() >= self.config.error_rate:
+            return None
+        self.errors += 1
+        if self.config.random.random() < 0.5:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={"Retry-After": f"{self.config.retry_after}"},
+            )
+        return web.json_response(
+            {"error": {"message": "Service unavailable", "type": "server_error"}},
+            status=503,
+        )
+
+    def _completion_words(self) -> list[str]:
+        return [
+            WORDS[i % len(WORDS)] + " " for i in range(self.config.completion_tokens)
+        ]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body: dict[str, Any] = await request.json()
+            error = self._error()
+            if error is not None:
+                await asyncio.sleep(self._latency() / 10)
+                return error
+            usage = {
+                "prompt_tokens": self._prompt_tokens(body),
+                "completion_tokens": self.config.completion_tokens,
+                "total_tokens": self._prompt_tokens(body)
+                + self.config.completion_tokens,
+            }
+            if body.get("stream"):
+                return await self._stream(request, body, usage)
+            await asyncio.sleep(self._latency())
+            return web.json_response(
+                {
+                    "id": f"chatcmpl-stub-{self.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "".join(self._completion_words()).strip(),
+                            },
+                            "logprobs": None,
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(
+        self, request: web.Request, body: dict[str, Any], usage: dict[str, int]
+    ) -> web.StreamResponse:
+        """Envía la respuesta como server-sent events, un token
+        por chunk repartidos a lo largo de la latencia"""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = self._completion_words()
+        delay = self._latency() / max(1, len(words))
+        base = {
+            "id": f"chatcmpl-stub-{self.requests}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+        }
+
+        async def send(chunk: dict[str, Any]) -> None:
+            await response.write(f"data: {json.dumps({**base, **chunk})}\n\n".encode())
+
+        for word in words:
+            await asyncio.sleep(delay)
+            await send(
+                {
+                    "choices": [
+                        {"index": 0, "delta": {"content": word}, "finish_reason": None}
+                    ]
+                }
+            )
+        await send({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if body.get("stream_options", {}).get("include_usage"):
+            await send({"choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Arranca el servidor en el event loop actual
+
+        Returns
+        -------
+        str
+            base_url para el cliente de openAI
+        """
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound_host, bound_port = self.runner.addresses[0][:2]
+        return f"http://{bound_host}:{bound_port}/v1"
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def serve(config: StubConfig, host: str, port: int) -> None:
+    stub = OpenAIStub(config)
+    base_url = await stub.start(host, port)
+    print(f"Stub de openAI en {base_url} (Ctrl+C para parar)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            serve(
+                StubConfig(
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    completion_tokens=args.completion_tokens,
+                    error_rate=args.error_rate,
+                    seed=args.seed,
+                ),
+                args.host,
+                args.port,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
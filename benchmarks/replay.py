@@ -0,0 +1,236 @@
+"""Reproduce tráfico real grabado con RECORD_TRAFFIC.
+
+Lee la grabación (data/traffic.jsonl por defecto), reconstruye
+mensajes con la misma forma (autor, canal, comando, longitud y
+adjuntos) y los pasa por on_message respetando los tiempos entre
+ellos, en tiempo real o acelerados con --speed, contra el stub
+local de openAI de benchmarks/openai_stub.py.
+
+Cada reproducción añade su resumen a benchmarks/replay_results.jsonl
+etiquetado con la versión del bot (o --label) y se imprime la
+comparación de latencia y gasto de tokens entre versiones para la
+misma grabación.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/replay.py data/traffic.jsonl --speed 10
+    python benchmarks/replay.py data/traffic.jsonl --speed 1 --label rama-nueva
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+os.environ.setdefault("OPENAI_API_KEY", "replay")
+
+from load_test import (  # noqa: E402
+    FakeChannel,
+    LagProbe,
+    configure,
+    peak_rss_mb,
+    percentile,
+)
+from openai_stub import OpenAIStub, StubConfig  # noqa: E402
+
+from dogimobot import settings  # noqa: E402
+from dogimobot.recording import load_events, replay_delays  # noqa: E402
+from dogimobot.utils import PROJECT_VERSION  # noqa: E402
+
+RESULTS = Path(__file__).parent / "replay_results.jsonl"
+FILLER = "texto de relleno con la misma longitud que el mensaje original "
+
+
+def build_messages(
+    events: list[dict[str, Any]], send_latency: float
+) -> list[SimpleNamespace]:
+    """Mensajes falsos con la forma de los eventos grabados.
+    Los autores se registran en settings.USERS"""
+    channels: dict[str, FakeChannel] = {}
+    guild = SimpleNamespace(id=1)
+    messages = []
+    for event in events:
+        author = f"rec_{event['a']}"
+        settings.USERS.setdefault(author, f"Usuario {event['a'][:4]}")
+        channel = channels.get(event["c"])
+        if channel is None:
+            channel = channels[event["c"]] = FakeChannel(len(channels), send_latency)
+        # Tras el comando va un espacio que también cuenta en len
+        length = event["len"] - 1 if event["cmd"] and event["len"] else event["len"]
+        body = (FILLER * (length // len(FILLER) + 1))[:length]
+        separator = " " if event["cmd"] and event["len"] else ""
+        messages.append(
+            SimpleNamespace(
+                content=f"{event['cmd']}{separator}{body}",
+                author=SimpleNamespace(name=author, bot=False),
+                attachments=[
+                    SimpleNamespace(content_type=kind or None, filename=f"adjunto_{i}")
+                    for i, kind in enumerate(event["att"])
+                ],
+                guild=guild,
+                channel=channel,
+            )
+        )
+    return messages
+
+
+async def replay(
+    args: argparse.Namespace, events: list[dict[str, Any]], stub: OpenAIStub
+) -> dict[str, Any]:
+    """Reproduce los eventos y devuelve el resumen"""
+    from dogimobot.main import DiscordClient
+
+    client = DiscordClient(intents=None)
+    messages = build_messages(events, args.send_latency)
+    delays = replay_delays(events, args.speed, args.max_gap)
+    latencies: list[float] = []
+    failures = 0
+    pending: set[asyncio.Task[None]] = set()
+
+    async def handle(message: SimpleNamespace) -> None:
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            await client.on_message(message)  # type: ignore[arg-type]
+        except Exception:
+            failures += 1
+            return
+        if message.content.startswith(settings.CHAT_COMMAND):
+            latencies.append(time.perf_counter() - start)
+
+    probe = LagProbe()
+    probe.start()
+    started = time.perf_counter()
+    for message, delay in zip(messages, delays):
+        await asyncio.sleep(delay)
+        task = asyncio.create_task(handle(message))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+    elapsed = time.perf_counter() - started
+    await probe.stop()
+    await client.client_openai.close()
+
+    return {
+        "label": args.label,
+        "recording": args.recording.name,
+        "events": len(events),
+        "speed": args.speed,
+        "date": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        "elapsed": elapsed,
+        "failures": failures,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "lag_p99": percentile(probe.samples, 0.99),
+        "rss_mb": peak_rss_mb(),
+        "openai_requests": stub.requests,
+        "tokens": client.bot_stats.total_tokens,
+        "cost": client.bot_stats.total_cost,
+    }
+
+
+def print_comparison(results_path: Path, current: dict[str, Any]) -> None:
+    """Compara la última reproducción de cada versión con
+    la misma grabación y velocidad"""
+    latest: dict[str, dict[str, Any]] = {}
+    with open(results_path, "r", encoding="utf-8") as file:
+        for line in file:
+            result = json.loads(line)
+            if (result["recording"], result["speed"]) == (
+                current["recording"],
+                current["speed"],
+            ):
+                # Las entradas posteriores pisan a las anteriores
+                latest.pop(result["label"], None)
+                latest[result["label"]] = result
+
+    print(
+        f"\n{current['recording']} ({current['events']} eventos, "
+        f"x{current['speed']:g})"
+    )
+    print(
+        f"{'versión':>14} | {'p50 (s)':>8} | {'p99 (s)':>8} | {'tokens':>9} | "
+        f"{'coste ($)':>9} | {'peticiones':>10} | {'Δ p99':>7} | {'Δ tokens':>8}"
+    )
+    reference = next(iter(latest.values()))
+    for label, result in latest.items():
+        delta_p99 = result["p99"] / reference["p99"] - 1 if reference["p99"] else 0.0
+        delta_tokens = (
+            result["tokens"] / reference["tokens"] - 1 if reference["tokens"] else 0.0
+        )
+        print(
+            f"{label:>14} | {result['p50']:>8.3f} | {result['p99']:>8.3f} | "
+            f"{result['tokens']:>9} | {result['cost']:>9.4f} | "
+            f"{result['openai_requests']:>10} | {delta_p99:>+7.1%} | "
+            f"{delta_tokens:>+8.1%}"
+        )
+    print(f"Las diferencias (Δ) son respecto a {next(iter(latest))}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    events = load_events(args.recording)
+    if not events:
+        print(f"{args.recording} no tiene eventos")
+        return
+    stub = OpenAIStub(
+        StubConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            completion_tokens=args.completion_tokens,
+            error_rate=args.error_rate,
+            seed=args.seed,
+        )
+    )
+    configure(args, await stub.start())
+    try:
+        result = await replay(args, events, stub)
+    finally:
+        await stub.close()
+
+    with open(args.results, "a", encoding="utf-8") as file:
+        file.write(json.dumps(result) + "\n")
+    print_comparison(args.results, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "recording",
+        type=Path,
+        nargs="?",
+        default=settings.DATA_FOLDER / settings.RECORDING_FILE,
+    )
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = tiempo real")
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=60.0,
+        help="espera máxima entre mensajes en segundos grabados",
+    )
+    parser.add_argument("--label", default=PROJECT_VERSION, help="versión a comparar")
+    parser.add_argument("--results", type=Path, default=RESULTS)
+    parser.add_argument("--latency", type=float, default=0.5, help="latencia del stub")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--send-latency", type=float, default=0.05)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument(
+        "--rate-limit",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="aplica los límites de settings como en producción",
+    )
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    # configure registra usuarios sintéticos; aquí se usan los grabados
+    parser.set_defaults(users=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,287 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Presupuestos de gasto diarios y mensuales por usuario y por guild.
+El coste de cada petición se estima en local antes de llamar
+a openAI y si se pasaría del presupuesto se responde sin llamar.
+El coste estimado queda reservado hasta que se cobra el real,
+así las peticiones concurrentes no se pasan del límite.
+Los contadores se reinician al cambiar de día y de mes y el gasto
+se persiste con el resto de estadísticas de BotStats."""
+
+from datetime import date, datetime
+from typing import Any, Callable, Optional
+
+from dogimobot import settings
+from dogimobot.stats import BotStats
+
+PERIODS = ("daily", "monthly")
+
+
+class BudgetTracker:
+    """Lleva el gasto de cada usuario y guild
+    en el día y el mes en curso
+    """
+
+    def __init__(
+        self,
+        user_limits: Optional[dict[str, Optional[float]]] = None,
+        guild_limits: Optional[dict[str, Optional[float]]] = None,
+        overrides: Optional[dict[str, dict[str, Optional[float]]]] = None,
+        today: Callable[[], date] = lambda: datetime.now().date(),
+        bot_stats: Optional[BotStats] = None,
+    ) -> None:
+        """Inicializa los presupuestos
+
+        Parameters
+        ----------
+        user_limits : Optional[dict[str, Optional[float]]], optional
+            Límites "daily" y "monthly" en dólares por usuario.
+            None en un periodo es sin límite
+        guild_limits : Optional[dict[str, Optional[float]]], optional
+            Límites "daily" y "monthly" en dólares por guild
+        overrides : Optional[dict[str, dict[str, Optional[float]]]], optional
+            Límites propios de algunos usuarios ("user:<nombre>")
+            o guilds ("guild:<id>")
+        today : Callable[[], date], optional
+            Devuelve la fecha actual, para poder probar los reinicios
+        bot_stats : Optional[BotStats], optional
+            Estadísticas donde se apunta el gasto para persistirlo
+        """
+        self.limits: dict[str, dict[str, Optional[float]]] = {
+            "user": (
+                user_limits
+                if user_limits is not None
+                else {
+                    "daily": settings.BUDGET_USER_DAILY,
+                    "monthly": settings.BUDGET_USER_MONTHLY,
+                }
+            ),
+            "guild": (
+                guild_limits
+                if guild_limits is not None
+                else {
+                    "daily": settings.BUDGET_GUILD_DAILY,
+                    "monthly": settings.BUDGET_GUILD_MONTHLY,
+                }
+            ),
+        }
+        self.overrides = (
+            overrides if overrides is not None else settings.BUDGET_OVERRIDES
+        )
+        self.today = today
+        self.bot_stats = bot_stats
+        # "user:<nombre>" / "guild:<id>" -> gasto del periodo en curso
+        # y coste reservado por las peticiones en vuelo
+        self.spend: dict[str, dict[str, Any]] = {}
+        self._day: Optional[date] = None
+        self.rejections: int = 0
+
+    @staticmethod
+    def period_ids(today: date) -> dict[str, str]:
+        """Identificadores del día y el mes en curso"""
+        return {
+            "daily": today.isoformat(),
+            "monthly": f"{today.year:04d}-{today.month:02d}",
+        }
+
+    def restore(self, state: dict[str, Any]) -> None:
+        """Recupera el gasto de los periodos en curso
+        guardado con las estadísticas
+
+        Parameters
+        ----------
+        state : dict[str, Any]
+            Estado como el de BotStats.empty_state
+        """
+        ids = self.period_ids(self.today())
+        for key, periods in state.get("budget_spend", {}).items():
+            entry = self._get(key)
+            for period in PERIODS:
+                entry[period] = periods.get(ids[period], 0.0)
+        self._prune()
+
+    @staticmethod
+    def keys_for(user: str, guild_id: Optional[int]) -> list[str]:
+        """Claves de presupuesto que afectan a una petición.
+        Los mensajes directos no tienen guild"""
+        keys = [f"user:{user}"]
+        if guild_id is not None:
+            keys.append(f"guild:{guild_id}")
+        return keys
+
+    def limit_for(self, key: str, period: str) -> Optional[float]:
+        """Límite en dólares de la clave en el periodo"""
+        override = self.overrides.get(key)
+        if override is not None and period in override:
+            return override[period]
+        return self.limits[key.split(":", 1)[0]][period]
+
+    def _prune(self) -> None:
+        """Olvida el gasto de los periodos que ya han terminado"""
+        today = self.today()
+        self._day = today
+        month = (today.year, today.month)
+        for key, entry in list(self.spend.items()):
+            if entry["month"] != month and not entry["reserved"]:
+                del self.spend[key]
+        if self.bot_stats is not None:
+            self.bot_stats.prune_budget_spend(set(self.period_ids(today).values()))
+
+    def _get(self, key: str) -> dict[str, Any]:
+        """Gasto de la clave, reiniciado si ha cambiado el día o el mes"""
+        today = self.today()
+        if today != self._day:
+            self._prune()
+        month = (today.year, today.month)
+        entry = self.spend.get(key)
+        if entry is None:
+            entry = self.spend[key] = {
+                "day": today,
+                "month": month,
+                "daily": 0.0,
+                "monthly": 0.0,
+                "reserved": 0.0,
+            }
+        if entry["day"] != today:
+            entry["day"], entry["daily"] = today, 0.0
+        if entry["month"] != month:
+            entry["month"], entry["monthly"] = month, 0.0
+        return entry
+
+    def remaining(self, user: str, guild_id: Optional[int]) -> Optional[float]:
+        """Dólares que quedan antes de agotar el presupuesto
+        más restrictivo. None si no hay ningún límite
+
+        Parameters
+        ----------
+        user : str
+            _description_
+        guild_id : Optional[int]
+            _description_
+
+        Returns
+        -------
+        Optional[float]
+            _description_
+        """
+        remaining: Optional[float] = None
+        for key in self.keys_for(user, guild_id):
+            entry = self._get(key)
+            for period in PERIODS:
+                limit = self.limit_for(key, period)
+                if limit is None:
+                    continue
+                left = max(limit - entry[period] - entry["reserved"], 0.0)
+                remaining = left if remaining is None else min(remaining, left)
+        return remaining
+
+    def check(
+        self, user: str, guild_id: Optional[int], estimated_cost: float
+    ) -> Optional[str]:
+        """Comprueba si la petición cabe en los presupuestos
+        y, si cabe, reserva su coste estimado hasta que se cobre
+        el real con charge o se libere con release
+
+        Parameters
+        ----------
+        user : str
+            _description_
+        guild_id : Optional[int]
+            _description_
+        estimated_cost : float
+            Coste estimado de la petición en dólares
+
+        Returns
+        -------
+        Optional[str]
+            None si cabe o el presupuesto que se superaría
+        """
+        keys = self.keys_for(user, guild_id)
+        for key in keys:
+            entry = self._get(key)
+            for period in PERIODS:
+                limit = self.limit_for(key, period)
+                if (
+                    limit is not None
+                    and entry[period] + entry["reserved"] + estimated_cost > limit
+                ):
+                    self.rejections += 1
+                    scope = "del usuario" if key.startswith("user:") else "del servidor"
+                    name = "diario" if period == "daily" else "mensual"
+                    return f"{name} {scope}"
+        for key in keys:
+            self._get(key)["reserved"] += estimated_cost
+        return None
+
+    def release(self, user: str, guild_id: Optional[int], reserved: float) -> None:
+        """Libera el coste reservado por check de una
+        petición que no ha llegado a hacerse
+
+        Parameters
+        ----------
+        user : str
+            _description_
+        guild_id : Optional[int]
+            _description_
+        reserved : float
+            Coste estimado que se reservó
+        """
+        for key in self.keys_for(user, guild_id):
+            entry = self._get(key)
+            entry["reserved"] = max(entry["reserved"] - reserved, 0.0)
+
+    def charge(
+        self, user: str, guild_id: Optional[int], cost: float, reserved: float = 0.0
+    ) -> None:
+        """Apunta el coste real de una petición ya hecha
+        y libera lo que se reservó al comprobarla
+
+        Parameters
+        ----------
+        user : str
+            _description_
+        guild_id : Optional[int]
+            _description_
+        cost : float
+            _description_
+        reserved : float, optional
+            Coste estimado que se reservó con check
+        """
+        self.release(user, guild_id, reserved)
+        ids = self.period_ids(self.today())
+        for key in self.keys_for(user, guild_id):
+            entry = self._get(key)
+            for period in PERIODS:
+                entry[period] += cost
+            if self.bot_stats is not None:
+                self.bot_stats.add_budget_spend(key, list(ids.values()), cost)
+
+    def status(self, user: str, guild_id: Optional[int]) -> dict[str, Any]:
+        """Gasto y límites del usuario y del guild para !stats
+
+        Returns
+        -------
+        dict[str, Any]
+            {"user": {...}, "guild": {...} o None} con el gasto
+            y el límite de cada periodo
+        """
+        status: dict[str, Any] = {"user": None, "guild": None}
+        for key in self.keys_for(user, guild_id):
+            entry = self._get(key)
+            status[key.split(":", 1)[0]] = {
+                period: (entry[period], self.limit_for(key, period))
+                for period in PERIODS
+            }
+        return status
@@ -0,0 +1,153 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caché de respuestas para preguntas repetidas.
+Las claves combinan la pregunta normalizada, el modelo
+y una huella del contexto del que depende la respuesta.
+Las entradas caducan (TTL) y se desalojan por LRU."""
+
+from collections import OrderedDict
+import hashlib
+import re
+import time
+from typing import Optional
+import unicodedata
+
+from dogimobot import settings
+
+
+class ResponseCache:
+    """Caché LRU con caducidad de respuestas de openAI"""
+
+    def __init__(
+        self,
+        max_entries: int = settings.RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = settings.RESPONSE_CACHE_TTL,
+    ) -> None:
+        """Inicializa la caché
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            Número máximo de respuestas guardadas
+        ttl : float, optional
+            Segundos que una respuesta es válida
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # clave -> (instante de caducidad, respuesta)
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        """Normaliza la pregunta: minúsculas, sin tildes,
+        sin signos de puntuación y con espacios simples
+
+        Parameters
+        ----------
+        question : str
+            _description_
+
+        Returns
+        -------
+        str
+            _description_
+        """
+        text = unicodedata.normalize("NFKD", question.lower())
+        text = "".join(char for char in text if not unicodedata.combining(char))
+        text = re.sub(r"[^\w\s]", " ", text)
+        return " ".join(text.split())
+
+    @staticmethod
+    def make_key(question: str, model: str, fingerprint: str) -> str:
+        """Devuelve la clave de la caché para la pregunta
+
+        Parameters
+        ----------
+        question : str
+            Pregunta del usuario sin el comando
+        model : str
+            Modelo que genera la respuesta
+        fingerprint : str
+            Huella del contexto del que depende la respuesta
+
+        Returns
+        -------
+        str
+            _description_
+        """
+        raw = "\x00".join([ResponseCache.normalize(question), model, fingerprint])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable(question: str) -> bool:
+        """Las preguntas muy cortas ("¿y eso?", "explica más")
+        suelen depender de la conversación y no se cachean"""
+        return len(ResponseCache.normalize(question)) >= (
+            settings.RESPONSE_CACHE_MIN_CHARS
+        )
+
+    def get(self, key: str, allow_stale: bool = False) -> Optional[str]:
+        """Devuelve la respuesta guardada o None si no existe
+        o ha caducado
+
+        Parameters
+        ----------
+        key : str
+            _description_
+        allow_stale : bool, optional
+            Devuelve también respuestas caducadas, sin borrarlas.
+            Se usa cuando openAI no está disponible
+
+        Returns
+        -------
+        Optional[str]
+            _description_
+        """
+        entry = self._entries.get(key)
+        if entry is None or (entry[0] < time.monotonic() and not allow_stale):
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, reply: str) -> None:
+        """Guarda la respuesta desalojando la menos usada
+        si se supera max_entries
+
+        Parameters
+        ----------
+        key : str
+            _description_
+        reply : str
+            _description_
+        """
+        self._entries[key] = (time.monotonic() + self.ttl, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        """Porcentaje de aciertos sobre el total de consultas"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,136 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Agrupación de ráfagas de !chat.
+Cuando varios usuarios escriben !chat en el mismo canal
+casi a la vez, los mensajes se juntan durante una ventana
+corta y se responden con una sola completion, así el
+contexto del canal solo se paga una vez."""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Coroutine
+
+from discord import Message
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+from dogimobot.memory import ConversationKey, ConversationStore
+
+
+class ChatCoalescer:
+    """Junta los !chat pendientes de cada conversación
+    y se los pasa en lote al handler
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list[Message]], Awaitable[None]],
+        window: float = settings.COALESCE_WINDOW,
+        max_messages: int = settings.COALESCE_MAX_MESSAGES,
+    ) -> None:
+        """Inicializa el agrupador
+
+        Parameters
+        ----------
+        handler : Callable[[list[Message]], Awaitable[None]]
+            Corrutina que responde un lote de mensajes
+        window : float, optional
+            Segundos que se espera a más mensajes desde el primero
+        max_messages : int, optional
+            Tamaño de lote a partir del cual se responde sin esperar
+        """
+        self.handler = handler
+        self.window = window
+        self.max_messages = max_messages
+        self._pending: dict[ConversationKey, list[Message]] = {}
+        self._timers: dict[ConversationKey, asyncio.Task[None]] = {}
+        # Guardamos referencias a las tareas para que no las recoja el GC
+        self._tasks: set[asyncio.Task[None]] = set()
+        # Métricas
+        self.batches: int = 0
+        self.coalesced_messages: int = 0
+
+    def _spawn(self, coro: Coroutine[Any, Any, None]) -> asyncio.Task[None]:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_done)
+        return task
+
+    def _on_done(self, task: asyncio.Task[None]) -> None:
+        """Suelta la referencia a la tarea y registra
+        cualquier excepción que se le haya escapado"""
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            logger.error(f"Error en un lote de mensajes agrupados: {exc!r}")
+
+    def submit(self, message: Message) -> None:
+        """Añade el mensaje al lote pendiente de su conversación.
+        El primer mensaje abre la ventana y el lote se responde
+        al cerrarse o al llegar a max_messages
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+        """
+        key = ConversationStore.key_for(message)
+        batch = self._pending.setdefault(key, [])
+        batch.append(message)
+
+        if len(batch) >= self.max_messages:
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            self._spawn(self._flush(key))
+        elif key not in self._timers:
+            self._timers[key] = self._spawn(self._flush_later(key))
+
+    async def _flush_later(self, key: ConversationKey) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(key, None)
+        await self._flush(key)
+
+    async def _flush(self, key: ConversationKey) -> None:
+        """Responde el lote pendiente de la conversación"""
+        batch = self._pending.pop(key, [])
+        if not batch:
+            return
+        if len(batch) > 1:
+            self.batches += 1
+            self.coalesced_messages += len(batch)
+        try:
+            await self.handler(batch)
+        except Exception as exc:
+            # Los usuarios del lote están esperando una respuesta
+            logger.error(f"Error al responder un lote de mensajes agrupados: {exc!r}")
+            await self._notify(batch)
+
+    @staticmethod
+    async def _notify(batch: list[Message]) -> None:
+        """Avisa en el canal del lote de que no se ha podido responder"""
+        try:
+            await batch[-1].channel.send(settings.FALLBACK_ANSWER)
+        except Exception as exc:
+            logger.error(f"No se ha podido avisar del error en el canal: {exc!r}")
+
+    async def close(self) -> None:
+        """Responde los lotes pendientes sin esperar a la ventana"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for key in list(self._pending):
+            await self._flush(key)
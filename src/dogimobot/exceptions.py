@@ -23,3 +23,15 @@ class FormatterException(Exception):
     Exception : _type_
         _description_
     """
+
+
+class CircuitOpenException(Exception):
+    """Cuando el circuit breaker de openAI
+    está abierto y la petición se rechaza
+    sin llegar a hacerse
+
+    Parameters
+    ----------
+    Exception : _type_
+        _description_
+    """
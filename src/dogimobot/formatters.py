@@ -15,10 +15,123 @@
 # from icecream import ic
 from pathlib import Path
 from string import Template
-from typing import Any
+import time
+from typing import Any, Optional
 
 from dogimobot.exceptions import FormatterException
-from dogimobot.settings import USERS
+from dogimobot.settings import (
+    DISCORD_MAX_MESSAGE_LENGTH,
+    TEMPLATE_RELOAD_INTERVAL,
+    USERS,
+)
+
+CODE_FENCE = "```"
+
+
+class TemplateRegistry:
+    """Caché de plantillas compiladas.
+    Cada plantilla se lee y compila una vez y solo se vuelve
+    a leer si cambia su mtime, que se consulta como mucho una
+    vez cada reload_interval segundos. Las salidas que solo
+    dependen de la plantilla y de sus argumentos se memorizan.
+    """
+
+    def __init__(self, reload_interval: float = TEMPLATE_RELOAD_INTERVAL) -> None:
+        self.reload_interval = reload_interval
+        # ruta -> (mtime, plantilla compilada)
+        self._templates: dict[Path, tuple[int, Template]] = {}
+        # ruta -> instante de la última consulta del mtime
+        self._checked: dict[Path, float] = {}
+        # (ruta, argumentos) -> (mtime, salida)
+        self._rendered: dict[
+            tuple[Path, tuple[tuple[str, Any], ...]], tuple[int, str]
+        ] = {}
+        # Lecturas de disco, para los benchmarks
+        self.reads: int = 0
+
+    def _mtime(self, path: Path) -> Optional[int]:
+        """mtime de la plantilla o None si no se puede consultar"""
+        try:
+            return path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, path: Path) -> tuple[Template, Optional[int]]:
+        """Devuelve la plantilla compilada y su mtime.
+        Si no se puede consultar el mtime no se cachea
+
+        Parameters
+        ----------
+        path : Path
+            _description_
+
+        Returns
+        -------
+        tuple[Template, Optional[int]]
+            _description_
+        """
+        cached = self._templates.get(path)
+        now = time.monotonic()
+        if cached is not None and now - self._checked[path] < self.reload_interval:
+            return cached[1], cached[0]
+
+        mtime = self._mtime(path)
+        if cached is not None and mtime == cached[0]:
+            self._checked[path] = now
+            return cached[1], mtime
+
+        template = Template(path.read_text(encoding="utf-8"))
+        self.reads += 1
+        if mtime is not None:
+            self._templates[path] = (mtime, template)
+            self._checked[path] = now
+        return template, mtime
+
+    def render_static(self, path: Path, **kwargs: Any) -> str:
+        """Formatea una plantilla cuya salida solo depende
+        de los argumentos y la memoriza hasta que cambie
+
+        Parameters
+        ----------
+        path : Path
+            _description_
+
+        Returns
+        -------
+        str
+            _description_
+        """
+        template, mtime = self.get(path)
+        key = (path, tuple(sorted(kwargs.items())))
+        cached = self._rendered.get(key)
+        if cached is not None and mtime is not None and cached[0] == mtime:
+            return cached[1]
+        rendered = template.safe_substitute(**kwargs)
+        if mtime is not None:
+            self._rendered[key] = (mtime, rendered)
+        return rendered
+
+    def clear(self) -> None:
+        """Vacía la caché y el contador de lecturas"""
+        self._templates.clear()
+        self._checked.clear()
+        self._rendered.clear()
+        self.reads = 0
+
+
+templates = TemplateRegistry()
+
+
+def _format_budget(scope: Optional[dict[str, Any]]) -> str:
+    """Texto con el gasto y el límite de hoy y del mes"""
+    if scope is None:
+        return "-"
+    parts = []
+    for period, name in (("daily", "hoy"), ("monthly", "este mes")):
+        spent, limit = scope[period]
+        limit_text = "sin límite" if limit is None else f"{limit:.2f} $"
+        parts.append(f"{name} {spent:.4f} $ de {limit_text}")
+    return ", ".join(parts)
 
 
 def format_stats(
@@ -36,6 +149,20 @@ def format_stats(
     user_stats: dict[str, dict[str, Any]],
     max_cost: float,
     session_start_time: str,
+    conversations: int = 0,
+    memory_messages: int = 0,
+    memory_hits: int = 0,
+    memory_misses: int = 0,
+    memory_evictions: int = 0,
+    alltime: Optional[dict[str, Any]] = None,
+    cache_hits: int = 0,
+    cache_hit_rate: float = 0.0,
+    scheduler: Optional[dict[str, Any]] = None,
+    resilience: Optional[dict[str, Any]] = None,
+    model_stats: Optional[dict[str, dict[str, Any]]] = None,
+    budget: Optional[dict[str, Any]] = None,
+    latency: Optional[dict[str, dict[str, Any]]] = None,
+    shard_stats: Optional[dict[int, dict[str, Any]]] = None,
 ) -> str:
     """Formatea la plantilla de stats
     y la devuelve formateada
@@ -62,6 +189,36 @@ def format_stats(
         _description_
     session_start_time : str
         _description_
+    conversations : int, optional
+        Número de conversaciones en memoria
+    memory_messages : int, optional
+        Número de mensajes en memoria entre todas las conversaciones
+    memory_hits : int, optional
+        Consultas de contexto con la conversación ya en memoria
+    memory_misses : int, optional
+        Consultas de contexto sin la conversación en memoria
+    memory_evictions : int, optional
+        Conversaciones desalojadas por el tope global
+    alltime : Optional[dict[str, Any]], optional
+        Totales históricos incluyendo la sesión actual.
+        Si no se indica se muestran los de la sesión
+    cache_hits : int, optional
+        Respuestas servidas desde la caché
+    cache_hit_rate : float, optional
+        Tasa de aciertos de la caché entre 0 y 1
+    scheduler : Optional[dict[str, Any]], optional
+        Métricas del planificador de peticiones
+    resilience : Optional[dict[str, Any]], optional
+        Reintentos y estado del circuit breaker de openAI
+    model_stats : Optional[dict[str, dict[str, Any]]], optional
+        Consumo de la sesión por modelo usado
+    budget : Optional[dict[str, Any]], optional
+        Gasto y límites del usuario y del servidor
+        como los devuelve BudgetTracker.status
+    latency : Optional[dict[str, dict[str, Any]]], optional
+        Percentiles de latencia por etapa como los devuelve Tracer.summary
+    shard_stats : Optional[dict[int, dict[str, Any]]], optional
+        Consumo de la sesión por shard. None si no se usan shards
 
     Returns
     -------
@@ -71,7 +228,7 @@ def format_stats(
 
     # Cargamos la plantilla
     try:
-        plantilla = Template(template.read_text(encoding="utf-8"))
+        plantilla, _ = templates.get(template)
     except Exception as exc:
         print(f"Se ha producido un error al formatear: {exc}")
         raise FormatterException("Se ha producido un problema al formatear:", exc)
@@ -104,6 +261,59 @@ def format_stats(
         )
     user_stats_table += "```"
 
+    # Presupuestos del usuario y del servidor
+    budget = budget or {"user": None, "guild": None}
+
+    # Latencias por etapa
+    latency_lines = "\n".join(
+        f"- **{stage}**: p50 {stats['p50']:.1f} ms · p95 {stats['p95']:.1f} ms · "
+        f"p99 {stats['p99']:.1f} ms ({stats['count']})"
+        for stage, stats in (latency or {}).items()
+    )
+
+    # Consumo por modelo
+    model_stats_lines = "\n".join(
+        f"- **{model}**: {stats['queries']} peticiones, "
+        f"{stats['tokens']} tokens, {stats['cost']:.4f} $"
+        for model, stats in (model_stats or {}).items()
+    )
+
+    # Consumo por shard
+    shard_stats_lines = "\n".join(
+        f"- **Shard {shard}**: {stats['queries']} peticiones, "
+        f"{stats['tokens']} tokens, {stats['cost']:.4f} $"
+        for shard, stats in sorted((shard_stats or {}).items())
+    )
+
+    # Totales históricos
+    if alltime is None:
+        alltime = {
+            "total_tokens": total_tokens,
+            "total_queries": total_queries,
+            "total_cost": total_cost,
+            "max_cost": max_cost,
+        }
+
+    # Métricas del planificador
+    if scheduler is None:
+        scheduler = {
+            "in_flight": 0,
+            "queue_depth": 0,
+            "total_scheduled": 0,
+            "avg_wait": 0.0,
+            "max_wait": 0.0,
+        }
+
+    # Reintentos y circuit breaker
+    if resilience is None:
+        resilience = {
+            "state": "cerrado",
+            "retries": 0,
+            "failures": 0,
+            "fast_failures": 0,
+            "times_opened": 0,
+        }
+
     return plantilla.safe_substitute(
         session_id=session_id,
         version=version,
@@ -116,8 +326,38 @@ def format_stats(
         total_queries=total_queries,
         total_cost=total_cost,
         user_stats=user_stats_table,
+        model_stats=model_stats_lines or "Sin peticiones todavía",
+        latency=latency_lines or "Sin mediciones todavía",
+        shard_stats=(
+            "Sin shards"
+            if shard_stats is None
+            else shard_stats_lines or "Sin peticiones todavía"
+        ),
+        budget_user=_format_budget(budget["user"]),
+        budget_guild=_format_budget(budget["guild"]),
         max_cost=max_cost,
         session_start_time=session_start_time,
+        conversations=conversations,
+        memory_messages=memory_messages,
+        memory_hits=memory_hits,
+        memory_misses=memory_misses,
+        memory_evictions=memory_evictions,
+        alltime_total_tokens=alltime["total_tokens"],
+        alltime_total_queries=alltime["total_queries"],
+        alltime_total_cost=round(alltime["total_cost"], 4),
+        alltime_max_cost=round(alltime["max_cost"], 4),
+        cache_hits=cache_hits,
+        cache_hit_rate=f"{cache_hit_rate:.1%}",
+        scheduler_in_flight=scheduler["in_flight"],
+        scheduler_queue_depth=scheduler["queue_depth"],
+        scheduler_total=scheduler["total_scheduled"],
+        scheduler_avg_wait=f"{scheduler['avg_wait']:.2f}",
+        scheduler_max_wait=f"{scheduler['max_wait']:.2f}",
+        breaker_state=resilience["state"],
+        breaker_times_opened=resilience["times_opened"],
+        openai_retries=resilience["retries"],
+        openai_failures=resilience["failures"],
+        openai_fast_failures=resilience["fast_failures"],
     )
 
 
@@ -146,16 +386,91 @@ def format_help(
         _description_
     """
 
-    # Cargamos la plantilla
+    # La salida es estática: se memoriza mientras no cambie la plantilla
     try:
-        plantilla = Template(template.read_text(encoding="utf-8"))
+        return templates.render_static(
+            template,
+            chat_command=chat_command,
+            stats_command=stats_command,
+            help_command=help_command,
+        )
     except Exception as exc:
         print(f"Se ha producido un error al formatear: {exc}")
         raise FormatterException("Se ha producido un problema al formatear:", exc)
 
-    # Devolvemos la plantilla formateada
-    return plantilla.safe_substitute(
-        chat_command=chat_command,
-        stats_command=stats_command,
-        help_command=help_command,
-    )
+
+def _split_lines(lines: list[str], max_length: int) -> list[str]:
+    """Reparte líneas en trozos de como mucho max_length
+    caracteres. Si un trozo acaba dentro de un bloque de
+    código lo cierra y lo vuelve a abrir en el siguiente"""
+    # Hueco para cerrar y reabrir el bloque de código
+    room = max_length - 2 * (len(CODE_FENCE) + 1)
+    chunks: list[str] = []
+    current: list[str] = []
+    length = 0
+    in_code = False
+    for line in lines:
+        # Las líneas más largas que un mensaje se cortan
+        pieces = [line[i : i + room] for i in range(0, len(line), room)] or [""]
+        for piece in pieces:
+            closing = len(CODE_FENCE) + 1 if in_code else 0
+            if current and length + 1 + len(piece) + closing > max_length:
+                if in_code:
+                    current.append(CODE_FENCE)
+                chunks.append("\n".join(current))
+                current = [CODE_FENCE] if in_code else []
+                length = len(CODE_FENCE) if in_code else 0
+            length += len(piece) + (1 if current else 0)
+            current.append(piece)
+        if line.strip().startswith(CODE_FENCE):
+            in_code = not in_code
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def split_message(text: str, max_length: int = DISCORD_MAX_MESSAGE_LENGTH) -> list[str]:
+    """Divide un texto en mensajes que caben en el límite
+    de discord. Se corta entre secciones ("## ") siempre que
+    se puede y, si una sección no cabe sola, entre líneas
+
+    Parameters
+    ----------
+    text : str
+        _description_
+    max_length : int, optional
+        Longitud máxima de cada mensaje
+
+    Returns
+    -------
+    list[str]
+        Mensajes en orden
+    """
+    if len(text) <= max_length:
+        return [text]
+
+    # Secciones con su título
+    sections: list[list[str]] = []
+    for line in text.split("\n"):
+        if line.startswith("## ") or not sections:
+            sections.append([line])
+        else:
+            sections[-1].append(line)
+
+    chunks: list[str] = []
+    current = ""
+    for section in sections:
+        section_text = "\n".join(section)
+        if current and len(current) + 1 + len(section_text) <= max_length:
+            current = f"{current}\n{section_text}"
+            continue
+        if current:
+            chunks.append(current)
+        if len(section_text) <= max_length:
+            current = section_text
+            continue
+        *full, current = _split_lines(section, max_length)
+        chunks.extend(full)
+    if current:
+        chunks.append(current)
+    return chunks
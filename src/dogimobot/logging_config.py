@@ -12,10 +12,76 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+from datetime import datetime, timezone
+import json
 import logging
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+import queue
+from typing import Any
 
-from dogimobot.settings import LOG_PATH
+from dogimobot.settings import (
+    LOG_BACKUP_COUNT,
+    LOG_JSON,
+    LOG_LEVEL,
+    LOG_MAX_BYTES,
+    LOG_PATH,
+    LOG_ROTATION,
+    LOG_ROTATION_INTERVAL,
+    LOG_ROTATION_WHEN,
+)
+
+# Campos extra que se pasan con extra={...} y van al JSON
+EXTRA_FIELDS = (
+    "session_id",
+    "user",
+    "channel",
+    "model",
+    "tokens",
+    "cost",
+    "latency",
+)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formatea cada registro como una línea JSON
+    con los campos extra de EXTRA_FIELDS que tenga"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "module": record.module,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def file_handler_config() -> dict[str, Any]:
+    """Handler del fichero de log con rotación por tamaño o por tiempo"""
+    config: dict[str, Any] = {
+        "level": LOG_LEVEL,
+        "formatter": "json" if LOG_JSON else "detailed",
+        "filename": LOG_PATH,
+        "backupCount": LOG_BACKUP_COUNT,
+        "encoding": "utf-8",
+    }
+    if LOG_ROTATION == "time":
+        config["class"] = "logging.handlers.TimedRotatingFileHandler"
+        config["when"] = LOG_ROTATION_WHEN
+        config["interval"] = LOG_ROTATION_INTERVAL
+    else:
+        config["class"] = "logging.handlers.RotatingFileHandler"
+        config["maxBytes"] = LOG_MAX_BYTES
+    return config
 
 
 LOGGING_CONFIG = {
@@ -27,27 +93,47 @@ LOGGING_CONFIG = {
             "datefmt": "%Y-%m-%dT%H:%M:%S%z",
         },
         "simple": {"format": "%(levelname)s: %(message)s"},
+        "json": {"()": JsonFormatter},
     },
     "handlers": {
-        "file": {
-            "class": "logging.handlers.RotatingFileHandler",
-            "level": "INFO",
-            "formatter": "detailed",
-            "filename": LOG_PATH,
-            "maxBytes": 100_000,
-            "backupCount": 3,
-            "encoding": "utf-8",
-        },
+        "file": file_handler_config(),
         "console": {  # Handler para printear por pantalla. Agregarlo a handlers debajo
             "class": "logging.StreamHandler",
-            "level": "INFO",
+            "level": LOG_LEVEL,
             "formatter": "simple",
             "stream": "ext://sys.stdout",
         },
     },
-    "loggers": {"root": {"level": "INFO", "handlers": ["file", "console"]}},
+    "loggers": {"root": {"level": LOG_LEVEL, "handlers": ["file", "console"]}},
 }
 
+
+def start_queue_listener() -> QueueListener:
+    """Pasa los handlers del root logger a un QueueListener
+    en un hilo aparte. El root logger solo deja los registros
+    en una cola, así loguear no bloquea el event loop con
+    escrituras a disco.
+
+    Returns
+    -------
+    QueueListener
+        _description_
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Vacía la cola al salir
+    atexit.register(listener.stop)
+    return listener
+
+
 # Instanciamos el logger
 dictConfig(LOGGING_CONFIG)
+listener = start_queue_listener()
 logger = logging.getLogger("dogimobot")
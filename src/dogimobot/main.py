@@ -13,17 +13,18 @@
 # limitations under the License.
 
 
-from collections import deque
+import asyncio
 from datetime import datetime
+from pathlib import Path
 import time
-from typing import Deque, Union, Any
+from typing import Any, Optional, Union
 import uuid
 
 import discord
 from discord import Message, Attachment
-from icecream import ic
-from openai import OpenAI
+from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
 from openai.types.chat.chat_completion_system_message_param import (
     ChatCompletionSystemMessageParam,
@@ -36,12 +37,30 @@ from openai.types.chat.chat_completion_assistant_message_param import (
 )
 
 from dogimobot import settings
+from dogimobot.budgets import BudgetTracker
+from dogimobot.cache import ResponseCache
+from dogimobot.coalescing import ChatCoalescer
 from dogimobot.exceptions import FormatterException
-from dogimobot.formatters import format_stats, format_help
+from dogimobot.formatters import format_stats, format_help, split_message
 from dogimobot.logging_config import logger
-from dogimobot.rate_limiting import RateLimiter
+from dogimobot.memory import Conversation, ConversationStore
+from dogimobot.metrics import MetricsServer
+from dogimobot.persistence import SQLiteMemoryBackend, StatsStore
+from dogimobot.rate_limiting import (
+    RateLimiter,
+    default_response,
+    is_default_response,
+)
+from dogimobot.recording import TrafficRecorder
+from dogimobot.resilience import ResilientCaller
+from dogimobot.routing import ModelRouter, estimate_cost
+from dogimobot.scheduler import Priority, RequestScheduler
+from dogimobot.state import StateBackend, create_state_backend
 from dogimobot.stats import BotStats
-from dogimobot.utils import get_discord_key, get_openai_key, get_project_version
+from dogimobot.summarizer import ConversationSummarizer, summary_message
+from dogimobot.tokens import count_message_tokens, get_context_budget
+from dogimobot.tracing import tracer
+from dogimobot.utils import PROJECT_VERSION, get_discord_key, get_openai_key
 
 OpenAIMessageType = Union[
     ChatCompletionSystemMessageParam,
@@ -53,18 +72,125 @@ OpenAIMessageType = Union[
 class DiscordClient(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.memory: Deque[dict[str, Any]] = deque(maxlen=settings.MEMORY_SIZE)
+        # Estado opcional compartido con otras réplicas del bot:
+        # rate limit, estadísticas y memoria de conversaciones
+        self.state_backend: Optional[StateBackend] = create_state_backend(
+            settings.STATE_BACKEND
+        )
+        if self.state_backend is not None:
+            RateLimiter.backend = self.state_backend
+        # Memoria persistente opcional en SQLite (o en el estado compartido)
+        self.memory_backend: Optional[Union[SQLiteMemoryBackend, StateBackend]] = (
+            self.state_backend
+            if self.state_backend is not None
+            else (
+                SQLiteMemoryBackend(settings.DATA_FOLDER / settings.MEMORY_DB_FILE)
+                if settings.PERSIST_MEMORY
+                else None
+            )
+        )
+        # Memoria independiente por guild y canal/hilo
+        self.memory: ConversationStore = self._create_memory()
+        # Caché opcional de respuestas a preguntas repetidas
+        self.response_cache: Optional[ResponseCache] = (
+            ResponseCache() if settings.RESPONSE_CACHE_ENABLED else None
+        )
+        # Reparto justo y acotado de las llamadas a openAI
+        self.scheduler: RequestScheduler = RequestScheduler()
+        # Agrupación opcional de ráfagas de !chat por canal
+        self.coalescer: Optional[ChatCoalescer] = (
+            ChatCoalescer(self._handle_chat_batch)
+            if settings.COALESCE_ENABLED
+            else None
+        )
+        # Tareas en segundo plano lanzadas al arrancar
+        self.background_tasks: list[asyncio.Task[None]] = []
         self.model: str = settings.MODELO
-        self.client_openai: OpenAI = OpenAI(api_key=get_openai_key())
+        # Elección del modelo de cada petición
+        self.router: ModelRouter = ModelRouter(default_model=self.model)
+        # Los reintentos los gestiona self.resilience
+        self.client_openai: AsyncOpenAI = AsyncOpenAI(
+            api_key=get_openai_key(), base_url=settings.OPENAI_BASE_URL, max_retries=0
+        )
+        # Las esperas entre reintentos no ocupan hueco del planificador
+        self.resilience: ResilientCaller = ResilientCaller(sleep=self.scheduler.sleep)
         self.session_id: str = f"{uuid.uuid4()}"
         # Inicializamos estadísticas
         self.bot_stats: BotStats = BotStats()
+        # Persistencia opcional de las estadísticas entre sesiones
+        self.stats_store: Optional[StatsStore] = None
+        if self.state_backend is not None:
+            # Los totales históricos se suman en el estado compartido
+            self.state_backend.attach_stats(self.bot_stats)
+        elif settings.PERSIST_STATS:
+            self.stats_store = StatsStore(self._stats_folder())
+            self.bot_stats.historical = self.stats_store.load()
+            self.bot_stats.enable_journal()
+        # Presupuestos de gasto por usuario y guild. El gasto
+        # se guarda con las estadísticas para sobrevivir a reinicios
+        self.budgets: BudgetTracker = BudgetTracker(bot_stats=self.bot_stats)
+        self.budgets.restore(
+            self.state_backend.stats_state()
+            if self.state_backend is not None
+            else self.bot_stats.historical
+        )
+        # Endpoint opcional de métricas para Prometheus
+        self.metrics_server: Optional[MetricsServer] = (
+            MetricsServer.for_components(
+                tracer,
+                self.bot_stats,
+                self.memory,
+                self.scheduler,
+                self.resilience,
+                self.budgets,
+                self.response_cache,
+                port=settings.METRICS_PORT,
+            )
+            if settings.METRICS_ENABLED
+            else None
+        )
+        # Grabación opcional del tráfico para reproducirlo en benchmarks
+        self.recorder: Optional[TrafficRecorder] = (
+            TrafficRecorder() if settings.RECORD_TRAFFIC else None
+        )
+        # Resumen en segundo plano de las conversaciones largas
+        self.summarizer: ConversationSummarizer = ConversationSummarizer(
+            self.memory, self.client_openai, self.bot_stats
+        )
         # Iniciamos contar de sesión
         self.session_start: float = time.perf_counter()
         self.session_start_date: str = datetime.now().strftime("%d/%m/%Y - %H:%M:%S")
         # Validamos que el modelo sea válido
         self._validate_model()
 
+    def _create_memory(self) -> ConversationStore:
+        """Crea la memoria de conversaciones"""
+        return ConversationStore(
+            window_size=settings.MEMORY_SIZE,
+            max_messages=settings.MEMORY_MAX_MESSAGES,
+            backend=self.memory_backend,
+        )
+
+    def _stats_folder(self) -> Path:
+        """Carpeta donde se persisten las estadísticas"""
+        return settings.DATA_FOLDER
+
+    def shard_of(self, message: Message) -> Optional[int]:
+        """Shard por el que ha llegado el mensaje.
+        None porque este cliente no usa shards
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+
+        Returns
+        -------
+        Optional[int]
+            _description_
+        """
+        return None
+
     def _validate_model(self) -> None:
         """Valida si el modelo especificado en settings
         corresponde con la lista de modelos válidos
@@ -92,7 +218,8 @@ class DiscordClient(discord.Client):
         return mensaje
 
     def _save_in_memory(self, message: Message) -> None:
-        """Guarda un dict en memoria para pasarle
+        """Guarda un dict en la memoria de la conversación
+        (guild y canal) del mensaje para pasarle
         a openAI con las conversaciones anteriores
         Guarda solo los mensajes de los usuarios
 
@@ -111,7 +238,8 @@ class DiscordClient(discord.Client):
         if message.attachments:
             adjuntos = message.attachments
 
-        self.memory.append(
+        self._append_to_memory(
+            message,
             {
                 "role": (
                     "user" if message.author.name in settings.USERS else "assistant"
@@ -120,89 +248,357 @@ class DiscordClient(discord.Client):
                 "author": str(message.author.name),
                 "time": datetime.now().strftime("%d/%m/%Y a las %H:%M:%S"),
                 "attachments": adjuntos,
-            }
+            },
         )
 
-    def _get_context(self) -> list[ChatCompletionMessageParam]:
-        """Devuelve una lista con el formato
-        apropiado para enviar a openai.
-        Esta lista consta de los mensajes anteriores
-        y del system prompt en el formato "role" y "content".
+    def _save_reply_in_memory(self, message: Message, reply: str) -> None:
+        """Guarda la respuesta del bot en la memoria
+        de la conversación del mensaje al que responde
+
+        Parameters
+        ----------
+        message : Message
+            Mensaje del usuario al que se ha respondido
+        reply : str
+            Respuesta del bot
+        """
+        self._append_to_memory(
+            message,
+            {"role": "assistant", "content": reply, "author": settings.BOT_NAME},
+        )
+
+    def _append_to_memory(self, message: Message, entry: dict[str, Any]) -> None:
+        """Renderiza el mensaje al formato de openai y cuenta
+        sus tokens una sola vez, al guardarlo. Así _get_context
+        solo tiene que reutilizar los mensajes ya renderizados.
+
+        Parameters
+        ----------
+        message : Message
+            Mensaje que determina la conversación
+        entry : dict[str, Any]
+            Mensaje a guardar en memoria
+        """
+        entry["param"] = self._render_message(entry)
+        entry["tokens"] = count_message_tokens(
+            str(entry["param"]["content"]), self.model
+        )
+        self.memory.append(ConversationStore.key_for(message), entry)
+
+    def _render_message(self, msg: dict[str, Any]) -> OpenAIMessageType:
+        """Convierte un mensaje de la memoria al formato
+        de mensaje de openai.
         Gestiona también el uso de adjuntos en los mensajes.
 
         En el content se añade quien dijo el mensaje para que
         el chatbot sepa identificarlo.
 
+        Parameters
+        ----------
+        msg : dict[str, Any]
+            Mensaje guardado en memoria
+
         Returns
         -------
-        list[dict[str, Any]]
+        OpenAIMessageType
             _description_
         """
-        context: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(
-                role="system", content=settings.SYSTEM_PROMPT
+        if msg["role"] == "assistant":
+            return ChatCompletionAssistantMessageParam(
+                role="assistant",
+                content=msg["content"],
+            )
+
+        contenido = (
+            f"El {msg['time']}, "
+            f"{settings.USERS[msg['author']]} dijo: {msg['content']} "
+        )
+        # Comprobamos si ha mandado adjuntos
+        if msg["attachments"]:
+            num_adjuntos = len(msg["attachments"])
+            adjuntos: list[Attachment] = msg["attachments"]
+            # Si ha mandado, añadimos el content_type y el filename
+            # Hay que comprobar si content_type y filename son str
+            contenido += (
+                f"y envió {num_adjuntos} adjunto(s) "
+                f"cuyos 'content_type' fueron: "
+                f"'{', '.join([adjunto.content_type for adjunto in adjuntos if adjunto.content_type])}' "
+                f"y cuyos 'filename' fueron: '{', '.join([adjunto.filename for adjunto in adjuntos])}'"
             )
+
+        return ChatCompletionUserMessageParam(
+            role="user",
+            content=contenido,
+        )
+
+    def _get_context(
+        self,
+        message: Message,
+        question: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> list[ChatCompletionMessageParam]:
+        """Devuelve una lista con el formato
+        apropiado para enviar a openai.
+        Esta lista consta del system prompt y de los mensajes
+        más recientes de la conversación del mensaje que caben
+        en el presupuesto de tokens del modelo
+        (settings.OPENAI_CONTEXT_BUDGET), en el formato "role" y "content".
+
+        Los mensajes se renderizan y se cuentan sus tokens
+        al guardarlos en memoria, por lo que aquí solo se
+        reutilizan y el coste no depende del tamaño de la memoria
+        sino de los mensajes que caben en el presupuesto.
+
+        Si la conversación tiene un resumen de los mensajes
+        antiguos se añade justo después del system prompt.
+
+        Parameters
+        ----------
+        message : Message
+            Mensaje cuya conversación se usa como contexto
+        question : Optional[str], optional
+            Pregunta que se envía aparte. Por defecto el
+            mensaje sin el comando
+        model : Optional[str], optional
+            Modelo que va a responder, determina el presupuesto.
+            Por defecto self.model
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            _description_
+        """
+        conversation = self.memory.get(ConversationStore.key_for(message))
+        system_prompt = ChatCompletionSystemMessageParam(
+            role="system", content=settings.SYSTEM_PROMPT
+        )
+
+        if question is None:
+            question = self._remove_command_from_msg(message)
+        model = model or self.model
+
+        history: list[ChatCompletionMessageParam] = [
+            msg["param"] for msg in self._fit_history(conversation, question, model)
         ]
-        for msg in self.memory:
-            if msg["role"] == "assistant":
-                context.append(
-                    ChatCompletionAssistantMessageParam(
-                        role="assistant",
-                        content=msg["content"],
-                    )
-                )
-            else:
-                contenido = (
-                    f"El {msg['time']}, "
-                    f"{settings.USERS[msg['author']]} dijo: {msg['content']} "
-                )
-                # Comprobamos si ha mandado adjuntos
-                if msg["attachments"]:
-                    num_adjuntos = len(msg["attachments"])
-                    adjuntos: list[Attachment] = msg["attachments"]
-                    # Si ha mandado, añadimos el content_type y el filename
-                    # Hay que comprobar si content_type y filename son str
-                    contenido += (
-                        f"y envió {num_adjuntos} adjunto(s) "
-                        f"cuyos 'content_type' fueron: "
-                        f"'{', '.join([adjunto.content_type for adjunto in adjuntos if adjunto.content_type])}' "
-                        f"y cuyos 'filename' fueron: '{', '.join([adjunto.filename for adjunto in adjuntos])}'"
-                    )
+        # El resumen de los mensajes antiguos va como un único mensaje
+        if conversation.summary:
+            return [system_prompt, summary_message(conversation.summary)] + history
+        return [system_prompt] + history
 
-                context.append(
-                    ChatCompletionUserMessageParam(
-                        role="user",
-                        content=contenido,
-                    )
-                )
-        return context
+    @staticmethod
+    def _fit_history(
+        conversation: Conversation, question: str, model: str
+    ) -> list[dict[str, Any]]:
+        """Mensajes más recientes de la conversación que caben
+        en el presupuesto de contexto del modelo, por orden
+
+        Parameters
+        ----------
+        conversation : Conversation
+            _description_
+        question : str
+            Pregunta que se envía aparte
+        model : str
+            Modelo que va a responder
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            _description_
+        """
+        # Reservamos el system prompt y el mensaje actual,
+        # que se envía aparte en _get_response_from_openai
+        budget: int = (
+            get_context_budget(model)
+            - count_message_tokens(settings.SYSTEM_PROMPT, model)
+            - count_message_tokens(question, model)
+            - conversation.summary_tokens
+        )
+
+        # Recorremos de más reciente a más antiguo hasta agotar el presupuesto
+        history: list[dict[str, Any]] = []
+        for msg in reversed(conversation.messages):
+            budget -= msg["tokens"]
+            if budget < 0:
+                break
+            history.append(msg)
+
+        history.reverse()
+        return history
 
     @RateLimiter.limit(
         msg_per_minute=settings.MAX_MSG_PER_MINUTES, rate_time=settings.RATE_LIMIT
     )
-    def _get_response_from_openai(
-        self, message: Message, context: list[ChatCompletionMessageParam]
-    ) -> ChatCompletion:
+    async def _get_response_from_openai(
+        self,
+        message: Message,
+        context: list[ChatCompletionMessageParam],
+        stream: bool = False,
+        model: Optional[str] = None,
+    ) -> Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]:
         """Realiza la query a la API de openAI
-        y devuelve la respuesta
+        y devuelve la respuesta. La llamada es asíncrona
+        para no bloquear el event loop de discord
+        mientras se espera a openAI.
+
+        Si stream es True devuelve un AsyncStream de chunks
+        que incluye el uso de tokens en el último chunk.
+        Si se excede el rate limit siempre se devuelve
+        un ChatCompletion.
 
         Returns
         -------
-        ChatCompletion
+        Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]
             _description_
         """
-        response: ChatCompletion = self.client_openai.chat.completions.create(
-            model=self.model,
-            messages=context
-            + [
-                ChatCompletionUserMessageParam(
-                    role="user",
-                    content=self._remove_command_from_msg(message),
+        return await self._create_completion(
+            context, self._remove_command_from_msg(message), stream, model
+        )
+
+    async def _create_completion(
+        self,
+        context: list[ChatCompletionMessageParam],
+        question: str,
+        stream: bool = False,
+        model: Optional[str] = None,
+    ) -> Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]:
+        """Llama a openAI con el contexto y la pregunta,
+        sin pasar por el rate limit. Los errores transitorios
+        se reintentan y si openAI está caído el circuit breaker
+        lanza CircuitOpenException sin llegar a llamar.
+        En streaming solo se reintenta la apertura del stream
+
+        Parameters
+        ----------
+        context : list[ChatCompletionMessageParam]
+            _description_
+        question : str
+            Pregunta que se añade al final del contexto
+        stream : bool, optional
+            _description_
+        model : Optional[str], optional
+            Modelo elegido por el router. Por defecto self.model
+
+        Returns
+        -------
+        Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]
+            _description_
+        """
+        model = model or self.model
+        messages: list[ChatCompletionMessageParam] = context + [
+            ChatCompletionUserMessageParam(role="user", content=question)
+        ]
+        if stream:
+            return await self.resilience.call(
+                lambda: self.client_openai.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
                 )
-            ],
+            )
+        response: ChatCompletion = await self.resilience.call(
+            lambda: self.client_openai.chat.completions.create(
+                model=model,
+                messages=messages,
+            )
         )
         return response
 
+    def _should_edit(self, pending_tokens: int, elapsed: float) -> bool:
+        """Decide si toca editar el mensaje que se está
+        construyendo en streaming. Se edita cuando hay
+        suficientes tokens nuevos o ha pasado el intervalo,
+        pero nunca más a menudo que STREAM_MIN_EDIT_INTERVAL
+        para respetar el rate limit de ediciones de discord
+
+        Parameters
+        ----------
+        pending_tokens : int
+            Tokens recibidos desde la última edición
+        elapsed : float
+            Segundos desde la última edición
+
+        Returns
+        -------
+        bool
+            True si hay que editar el mensaje
+        """
+        if pending_tokens == 0 or elapsed < settings.STREAM_MIN_EDIT_INTERVAL:
+            return False
+        return (
+            pending_tokens >= settings.STREAM_EDIT_TOKENS
+            or elapsed >= settings.STREAM_EDIT_INTERVAL
+        )
+
+    async def _stream_reply(
+        self, message: Message, stream: AsyncStream[ChatCompletionChunk]
+    ) -> tuple[str, int, int]:
+        """Consume el stream de openAI publicando un mensaje
+        provisional que se va editando por lotes.
+        Si la respuesta supera el máximo de caracteres de discord
+        se cierra el mensaje actual y se continúa en uno nuevo.
+
+        Parameters
+        ----------
+        message : Message
+            Mensaje del usuario al que se responde
+        stream : AsyncStream[ChatCompletionChunk]
+            Stream devuelto por openAI
+
+        Returns
+        -------
+        tuple[str, int, int]
+            Devuelve la respuesta completa, prompt_tokens y completion_tokens
+        """
+        max_length = settings.DISCORD_MAX_MESSAGE_LENGTH
+        sent: Message = await message.channel.send(settings.STREAM_PLACEHOLDER)
+        parts: list[str] = []
+        # Texto del mensaje de discord que se está editando
+        current = ""
+        pending_tokens = 0
+        last_edit = time.perf_counter()
+        prompt_tokens = completion_tokens = 0
+
+        async for chunk in stream:
+            if chunk.usage is not None:
+                prompt_tokens = int(chunk.usage.prompt_tokens)
+                completion_tokens = int(chunk.usage.completion_tokens)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+
+            delta: str = chunk.choices[0].delta.content
+            parts.append(delta)
+            pending_tokens += 1
+
+            if len(current) + len(delta) > max_length:
+                # Cerramos el mensaje actual y seguimos en uno nuevo
+                if current.strip():
+                    await sent.edit(content=current)
+                current = delta
+                sent = await message.channel.send(
+                    current if current.strip() else settings.STREAM_PLACEHOLDER
+                )
+                pending_tokens = 0
+                last_edit = time.perf_counter()
+                continue
+
+            current += delta
+            if self._should_edit(pending_tokens, time.perf_counter() - last_edit):
+                if current.strip():
+                    await sent.edit(content=current)
+                pending_tokens = 0
+                last_edit = time.perf_counter()
+
+        reply = "".join(parts).strip()
+        if not reply:
+            reply = settings.DEFAULT_ERR_ANSWER
+            current = reply
+        # Edición final con todo el texto pendiente
+        await sent.edit(content=current.strip() or reply)
+
+        return reply, prompt_tokens, completion_tokens
+
     def _get_reply_from_openai(self, response: ChatCompletion) -> str:
         """Devuelve el contenido de la respuesta
         de openAI. Si lo que devuelve openAI
@@ -252,102 +648,730 @@ class DiscordClient(discord.Client):
 
         return prompt_tokens, completion_tokens
 
+    async def setup_hook(self) -> None:
+        """Lanza las tareas en segundo plano en el event loop
+        del bot antes de conectarse a discord"""
+        if self.memory_backend is not None:
+            self.background_tasks.append(asyncio.create_task(self.memory_backend.run()))
+        if self.stats_store is not None:
+            self.background_tasks.append(
+                asyncio.create_task(self.stats_store.run(self.bot_stats))
+            )
+        if self.recorder is not None:
+            self.background_tasks.append(asyncio.create_task(self.recorder.run()))
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+    async def close(self) -> None:
+        """Para las tareas en segundo plano y vuelca
+        lo pendiente antes de cerrar"""
+        if self.coalescer is not None:
+            await self.coalescer.close()
+        for task in self.background_tasks:
+            task.cancel()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.memory_backend is not None:
+            self.memory_backend.close()
+        if self.stats_store is not None:
+            self.stats_store.close(self.bot_stats)
+        if self.recorder is not None:
+            self.recorder.flush()
+        await super().close()
+
     async def on_ready(self):
         logger.info(
             f"********* SESSION STARTED*********\nSESSION ID {self.session_id} *********"
         )
         print(f"Logged on as {self.user}")
 
-    async def on_message(self, message: Message):
-        # No respondas a ti mismo o a otros bots
-        if message.author == self.user or message.author.bot:
-            return
+    def _log_extra(self, message: Message, **fields: Any) -> dict[str, Any]:
+        """Campos estructurados para los registros de log
+        de un mensaje (ver logging_config.EXTRA_FIELDS)
 
-        # Inicializamos reply para evitar errores
-        reply = ""
+        Parameters
+        ----------
+        message : Message
+            _description_
 
-        # Guarda el mensaje en la memoria tanto del usuario como del bot
-        self._save_in_memory(message)
+        Returns
+        -------
+        dict[str, Any]
+            _description_
+        """
+        guild_id, channel_id = ConversationStore.key_for(message)
+        return {
+            "session_id": self.session_id,
+            "user": message.author.name,
+            "channel": f"{guild_id}/{channel_id}",
+            **fields,
+        }
 
-        # Logging
-        logger.info(
-            f"SESSION ID: {self.session_id} | {message.author} dijo: {message.content}"
+    async def _stats_snapshot(
+        self,
+    ) -> tuple[dict[str, Any], dict[str, Any], Optional[dict[int, dict[str, Any]]]]:
+        """Estadísticas que muestra !stats. Los totales del
+        estado compartido se leen en un hilo aparte
+
+        Returns
+        -------
+        tuple[dict[str, Any], dict[str, Any], Optional[dict[int, dict[str, Any]]]]
+            Las de la sesión, las históricas y las de cada shard
+            (None si no se usan shards)
+        """
+        alltime = (
+            await asyncio.to_thread(self.state_backend.stats_state)
+            if self.state_backend is not None
+            else self.bot_stats.alltime_state()
         )
+        return self.bot_stats.session_state(), alltime, None
 
-        # Si el mensaje contiene el comando, responde
-        if message.content.lower().startswith(settings.CHAT_COMMAND):
+    def _context_fingerprint(self, message: Message) -> str:
+        """Huella de la parte del contexto de la que depende
+        una respuesta cacheable: el system prompt y el usuario
+        al que se dirige (el bot le llama por su nombre)"""
+        return f"{hash(settings.SYSTEM_PROMPT)}:{message.author.name}"
 
-            # Prepara el contexto incluyendo las últimas interacciones
-            context = self._get_context()
-            ic(context)
+    def _record_usage(
+        self,
+        message: Message,
+        in_tokens: int,
+        out_tokens: int,
+        model: Optional[str] = None,
+        reserved: float = 0.0,
+    ) -> tuple[int, float]:
+        """Alimenta las estadísticas con el consumo de una petición
 
-            try:
-                response = self._get_response_from_openai(
-                    message=message, context=context
-                )
-            except Exception as exc:
-                print(f"Se ha producido un error: {exc}")
-                return
+        Parameters
+        ----------
+        message : Message
+            Mensaje del usuario que hizo la petición
+        in_tokens : int
+            _description_
+        out_tokens : int
+            _description_
+        model : Optional[str], optional
+            Modelo que ha respondido. Por defecto self.model
+        reserved : float, optional
+            Coste reservado en el presupuesto al comprobarla
+
+        Returns
+        -------
+        tuple[int, float]
+            Tokens totales y coste total de la petición
+        """
+        return self._record_batch_usage(
+            [message], in_tokens, out_tokens, model, reserved
+        )
+
+    def _record_batch_usage(
+        self,
+        messages: list[Message],
+        in_tokens: int,
+        out_tokens: int,
+        model: Optional[str] = None,
+        reserved: float = 0.0,
+    ) -> tuple[int, float]:
+        """Alimenta las estadísticas con el consumo de una
+        completion que responde a uno o varios mensajes.
+        Cada mensaje cuenta como una petición y los tokens
+        y el coste se reparten a partes iguales entre ellos
+
+        Parameters
+        ----------
+        messages : list[Message]
+            Mensajes respondidos por la completion
+        in_tokens : int
+            _description_
+        out_tokens : int
+            _description_
+        model : Optional[str], optional
+            Modelo que ha respondido. Por defecto self.model
+        reserved : float, optional
+            Coste reservado en el presupuesto por cada mensaje
 
+        Returns
+        -------
+        tuple[int, float]
+            Tokens totales y coste total de la completion
+        """
+        model = model or self.model
+        total_tokens = in_tokens + out_tokens
+
+        # Sumamos los tokens totales a la sesión
+        self.bot_stats.add_total_tokens(total_tokens)
+        self.bot_stats.add_direction_tokens(in_tokens, out_tokens)
+
+        # Calculamos el coste total con el modelo que ha respondido
+        total_cost: float = self.bot_stats.calculate_total_cost(
+            in_tokens, out_tokens, model
+        )
+
+        # Sumamos al coste total de la sesión y al del modelo
+        self.bot_stats.add_total_and_max_cost(total_cost)
+        self.bot_stats.add_model_stats(model, total_tokens, total_cost)
+
+        # Repartimos el consumo entre los usuarios
+        share_tokens, remainder = divmod(total_tokens, len(messages))
+        share_cost = total_cost / len(messages)
+        for index, message in enumerate(messages):
+            tokens = share_tokens + (1 if index < remainder else 0)
+            shard = self.shard_of(message)
+            # Añadimos 1 a las queries totales
+            self.bot_stats.add_total_queries()
+            # Alimentamos las estadísticas
+            self.bot_stats.add_user_stats(message, tokens, share_cost)
+            if shard is not None:
+                self.bot_stats.add_shard_stats(shard, tokens, share_cost)
+            # Cobramos los tokens en el rate limiter y el coste en el presupuesto
+            RateLimiter.consume_tokens(message.author.name, tokens, shard)
+            self.budgets.charge(
+                message.author.name,
+                ConversationStore.key_for(message)[0],
+                share_cost,
+                reserved,
+            )
+
+        return total_tokens, total_cost
+
+    async def _read_response(
+        self,
+        message: Message,
+        response: Union[ChatCompletion, AsyncStream[ChatCompletionChunk]],
+    ) -> tuple[str, int, int]:
+        """Saca la respuesta y los tokens de lo que devuelve openAI.
+        Si es un stream se va publicando a medida que llega
+
+        Parameters
+        ----------
+        message : Message
+            Mensaje al que se responde
+        response : Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]
+            _description_
+
+        Returns
+        -------
+        tuple[str, int, int]
+            Respuesta, prompt_tokens y completion_tokens
+        """
+        if isinstance(response, ChatCompletion):
             reply = self._get_reply_from_openai(response)
             # Sacamos los in y out tokens
             in_tokens, out_tokens = self._get_tokens_from_response(response)
-            total_tokens = in_tokens + out_tokens
+            return reply, in_tokens, out_tokens
+        # La respuesta se publica a medida que llega
+        return await self._stream_reply(message, response)
 
-            # Sumamos los tokens totales a la sesión
-            self.bot_stats.add_total_tokens(total_tokens)
-            # Añadimos 1 a las queries totales
-            self.bot_stats.add_total_queries()
+    def _estimate_prompt_tokens(
+        self, message: Message, question: str, model: Optional[str] = None
+    ) -> int:
+        """Estima en local los tokens del prompt que se envía
+        al modelo: system prompt, resumen, pregunta y el historial
+        recortado al presupuesto de contexto del modelo
+
+        Parameters
+        ----------
+        message : Message
+            Mensaje (o último mensaje del lote) que se responde
+        question : str
+            Pregunta que se envía a openAI
+        model : Optional[str], optional
+            Modelo que va a responder. Por defecto self.model
 
-            # Calculamos el coste total
-            total_cost: float = self.bot_stats.calculate_total_cost(
-                in_tokens, out_tokens
+        Returns
+        -------
+        int
+            _description_
+        """
+        model = model or self.model
+        conversation = self.memory.peek(ConversationStore.key_for(message))
+        prompt_tokens = count_message_tokens(
+            settings.SYSTEM_PROMPT, model
+        ) + count_message_tokens(question, model)
+        if conversation is not None:
+            prompt_tokens += conversation.summary_tokens + sum(
+                msg["tokens"]
+                for msg in self._fit_history(conversation, question, model)
             )
+        return prompt_tokens
 
-            # Sumamos al coste total de la sesión
-            self.bot_stats.add_total_and_max_cost(total_cost)
+    def _route(self, message: Message, question: str) -> str:
+        """Elige el modelo que responde a la pregunta
+        según el tamaño estimado del prompt, la complejidad,
+        el usuario y el presupuesto que queda
 
-            # Alimentamos las estadísticas
-            self.bot_stats.add_user_stats(message, total_tokens, total_cost)
+        Parameters
+        ----------
+        message : Message
+            Mensaje (o último mensaje del lote) que se responde
+        question : str
+            Pregunta que se envía a openAI
 
-            # Añadimos la respuesta a memoria
-            self.memory.append(
-                {"role": "assistant", "content": reply, "author": settings.BOT_NAME}
+        Returns
+        -------
+        str
+            Modelo elegido
+        """
+        guild_id, _ = ConversationStore.key_for(message)
+        remaining_budget = self.budgets.remaining(message.author.name, guild_id)
+        if settings.ROUTING_BUDGET is not None:
+            session_left = max(settings.ROUTING_BUDGET - self.bot_stats.total_cost, 0.0)
+            remaining_budget = (
+                session_left
+                if remaining_budget is None
+                else min(remaining_budget, session_left)
             )
 
-            # Añadimos respuesta de openAI junto con costes al logging
-            log_msg = (
-                f"SESSION ID: {self.session_id} | "
-                f"{settings.BOT_NAME} dijo: {reply} | "
-                f"Tokens totales: {total_tokens} | "
-                f"Coste total: {total_cost}"
+        # El historial se recorta al contexto de cada modelo
+        model, reason = self.router.route(
+            question,
+            lambda candidate: self._estimate_prompt_tokens(
+                message, question, candidate
+            ),
+            user=message.author.name,
+            remaining_budget=remaining_budget,
+        )
+        logger.info(
+            f"SESSION ID: {self.session_id} | Modelo {model} ({reason}) "
+            f"para {message.author.name}",
+            extra=self._log_extra(message, model=model),
+        )
+        return model
+
+    def _check_budget(
+        self, message: Message, model: str, prompt_tokens: int, share: int = 1
+    ) -> tuple[Optional[str], float]:
+        """Estima el coste de la petición y lo compara con los
+        presupuestos del usuario y del guild antes de llamar a openAI.
+        Si cabe el coste estimado queda reservado en el presupuesto
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+        model : str
+            Modelo que va a responder
+        prompt_tokens : int
+            Tokens estimados del prompt
+        share : int, optional
+            Usuarios entre los que se reparte la petición
+
+        Returns
+        -------
+        tuple[Optional[str], float]
+            None si cabe en el presupuesto o la respuesta para el usuario,
+            y el coste reservado
+        """
+        estimated_cost = (
+            estimate_cost(model, prompt_tokens, settings.ROUTING_EXPECTED_OUT_TOKENS)
+            / share
+        )
+        guild_id, _ = ConversationStore.key_for(message)
+        exceeded = self.budgets.check(message.author.name, guild_id, estimated_cost)
+        if exceeded is None:
+            return None, estimated_cost
+        logger.warning(
+            f"SESSION ID: {self.session_id} | Presupuesto {exceeded} agotado "
+            f"para {message.author.name} (coste estimado {estimated_cost:.4f} $)",
+            extra=self._log_extra(message, model=model, cost=estimated_cost),
+        )
+        return settings.BUDGET_EXCEEDED_ANSWER.format(budget=exceeded), 0.0
+
+    def _fallback_reply(self, cache_key: Optional[str]) -> str:
+        """Respuesta cuando openAI falla o el circuito está abierto:
+        la de la caché aunque haya caducado o una por defecto
+
+        Parameters
+        ----------
+        cache_key : Optional[str]
+            Clave de la pregunta en la caché si es cacheable
+
+        Returns
+        -------
+        str
+            _description_
+        """
+        if cache_key is not None and self.response_cache is not None:
+            cached = self.response_cache.get(cache_key, allow_stale=True)
+            if cached is not None:
+                return cached
+        return settings.FALLBACK_ANSWER
+
+    @staticmethod
+    def _priority_for(message: Message) -> Priority:
+        """Prioridad en el planificador según el autor del mensaje
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+
+        Returns
+        -------
+        Priority
+            _description_
+        """
+        if message.author.name in settings.ADMIN_USERS:
+            return Priority.HIGH
+        return Priority.NORMAL
+
+    async def _handle_chat(self, message: Message) -> None:
+        """Responde a un mensaje con el comando de chat.
+        Si la caché de respuestas está activa y la pregunta
+        ya se ha respondido se reutiliza la respuesta sin
+        llamar a openAI
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+        """
+        # La conversación puede haberse desalojado mientras esperaba
+        await self.memory.ensure_loaded(ConversationStore.key_for(message))
+        question = self._remove_command_from_msg(message)
+        model = self._route(message, question)
+        prompt_tokens = self._estimate_prompt_tokens(message, question, model)
+        cache_key: Optional[str] = None
+        cached: Optional[str] = None
+        if self.response_cache is not None and ResponseCache.is_cacheable(question):
+            cache_key = ResponseCache.make_key(
+                question, model, self._context_fingerprint(message)
             )
-            logger.info(log_msg)
+            cached = self.response_cache.get(cache_key)
 
+        if cached is not None:
+            # Acierto de caché: cuenta como petición sin coste
+            reply = cached
+            total_tokens, total_cost = self._record_usage(message, 0, 0, model)
+            self._save_reply_in_memory(message, reply)
+            logger.info(
+                f"SESSION ID: {self.session_id} | "
+                f"{settings.BOT_NAME} dijo (caché): {reply}",
+                extra=self._log_extra(message, model=model, tokens=0, cost=0.0),
+            )
             await message.channel.send(reply)
+            return
+
+        # Si se pasaría del presupuesto se responde sin llamar a openAI
+        over_budget, reserved = self._check_budget(message, model, prompt_tokens)
+        if over_budget is not None:
+            await message.channel.send(over_budget)
+            return
+
+        # Prepara el contexto incluyendo las últimas interacciones
+        with tracer.span("context"):
+            context = self._get_context(message, model=model)
+        if tracer.is_tracing():
+            logger.info(
+                f"SESSION ID: {self.session_id} | Contexto: {context}",
+                extra=self._log_extra(message, model=model),
+            )
+
+        async def complete() -> tuple[Any, str, int, int]:
+            # El hueco del planificador se ocupa hasta terminar el stream
+            tracer.record("queue", time.perf_counter() - started)
+            with tracer.span("openai"):
+                response = await self._get_response_from_openai(
+                    message=message,
+                    context=context,
+                    stream=settings.STREAM_REPLIES,
+                    model=model,
+                )
+            with tracer.span("reply"):
+                reply, in_tokens, out_tokens = await self._read_response(
+                    message, response
+                )
+            return response, reply, in_tokens, out_tokens
+
+        started = time.perf_counter()
+        try:
+            response, reply, in_tokens, out_tokens = await self.scheduler.run(
+                complete,
+                user=message.author.name,
+                channel=ConversationStore.key_for(message),
+                priority=self._priority_for(message),
+            )
+        except Exception as exc:
+            logger.error(
+                f"SESSION ID: {self.session_id} | Error al llamar a openAI: {exc!r}",
+                extra=self._log_extra(
+                    message,
+                    model=model,
+                    latency=round(time.perf_counter() - started, 3),
+                ),
+            )
+            print(f"Se ha producido un error: {exc}")
+            self.budgets.release(
+                message.author.name, ConversationStore.key_for(message)[0], reserved
+            )
+            await message.channel.send(self._fallback_reply(cache_key))
+            return
+
+        total_tokens, total_cost = self._record_usage(
+            message, in_tokens, out_tokens, model, reserved
+        )
+
+        # Guardamos en caché solo respuestas reales de openAI
+        if (
+            cache_key is not None
+            and self.response_cache is not None
+            and reply != settings.DEFAULT_ERR_ANSWER
+            and not (
+                isinstance(response, ChatCompletion) and is_default_response(response)
+            )
+        ):
+            self.response_cache.put(cache_key, reply)
+
+        # Añadimos la respuesta a memoria
+        await self.memory.ensure_loaded(ConversationStore.key_for(message))
+        self._save_reply_in_memory(message, reply)
+        self.summarizer.maybe_schedule(ConversationStore.key_for(message))
+
+        # Añadimos respuesta de openAI junto con costes al logging
+        log_msg = (
+            f"SESSION ID: {self.session_id} | "
+            f"{settings.BOT_NAME} dijo: {reply} | "
+            f"Modelo: {model} | "
+            f"Tokens totales: {total_tokens} | "
+            f"Coste total: {total_cost}"
+        )
+        logger.info(
+            log_msg,
+            extra=self._log_extra(
+                message,
+                model=model,
+                tokens=total_tokens,
+                cost=total_cost,
+                latency=round(time.perf_counter() - started, 3),
+            ),
+        )
+
+        if isinstance(response, ChatCompletion):
+            with tracer.span("send"):
+                await message.channel.send(reply)
+
+    def _batch_question(self, messages: list[Message]) -> str:
+        """Pregunta conjunta para responder a varios usuarios a la vez
+
+        Parameters
+        ----------
+        messages : list[Message]
+            _description_
+
+        Returns
+        -------
+        str
+            _description_
+        """
+        if len(messages) == 1:
+            return self._remove_command_from_msg(messages[0])
+        return "\n".join(
+            [settings.COALESCE_PROMPT]
+            + [
+                f"{settings.USERS.get(msg.author.name, msg.author.name)}: "
+                f"{self._remove_command_from_msg(msg)}"
+                for msg in messages
+            ]
+        )
+
+    async def _handle_chat_batch(self, messages: list[Message]) -> None:
+        """Responde con una sola completion a varios mensajes
+        con el comando de chat llegados casi a la vez a la misma
+        conversación. Cada usuario pasa su propio rate limit
+        y el consumo se reparte entre todos
+
+        Parameters
+        ----------
+        messages : list[Message]
+            Mensajes de la misma conversación por orden de llegada
+        """
+        if len(messages) == 1:
+            await self._handle_chat(messages[0])
+            return
+
+        await self.memory.ensure_loaded(ConversationStore.key_for(messages[-1]))
+        # Presupuesto estimado con el lote completo y repartido entre todos
+        question = self._batch_question(messages)
+        model = self._route(messages[-1], question)
+        prompt_tokens = self._estimate_prompt_tokens(messages[-1], question, model)
+
+        accepted: list[Message] = []
+        reserved = 0.0
+        for message in messages:
+            over_budget, reserved = self._check_budget(
+                message, model, prompt_tokens, share=len(messages)
+            )
+            if over_budget is not None:
+                await message.channel.send(over_budget)
+                continue
+            retry_after = await RateLimiter.acquire_async(
+                message.author.name,
+                settings.MAX_MSG_PER_MINUTES,
+                settings.RATE_LIMIT,
+                shard=self.shard_of(message),
+            )
+            if retry_after is None:
+                accepted.append(message)
+            else:
+                self.budgets.release(
+                    message.author.name, ConversationStore.key_for(message)[0], reserved
+                )
+                await message.channel.send(
+                    self._get_reply_from_openai(
+                        default_response(message.author.name, retry_after)
+                    )
+                )
+        if not accepted:
+            return
+
+        last = accepted[-1]
+        if len(accepted) < len(messages):
+            question = self._batch_question(accepted)
+        # El contexto de la conversación se paga una sola vez
+        await self.memory.ensure_loaded(ConversationStore.key_for(last))
+        with tracer.span("context"):
+            context = self._get_context(last, question, model)
+
+        async def complete() -> tuple[Any, str, int, int]:
+            tracer.record("queue", time.perf_counter() - started)
+            with tracer.span("openai"):
+                response = await self._create_completion(
+                    context, question, settings.STREAM_REPLIES, model
+                )
+            with tracer.span("reply"):
+                reply, in_tokens, out_tokens = await self._read_response(last, response)
+            return response, reply, in_tokens, out_tokens
+
+        priority = min(self._priority_for(msg) for msg in accepted)
+        started = time.perf_counter()
+        try:
+            response, reply, in_tokens, out_tokens = await self.scheduler.run(
+                complete,
+                user=last.author.name,
+                channel=ConversationStore.key_for(last),
+                priority=priority,
+            )
+        except Exception as exc:
+            logger.error(
+                f"SESSION ID: {self.session_id} | Error al llamar a openAI: {exc!r}",
+                extra=self._log_extra(
+                    last,
+                    model=model,
+                    latency=round(time.perf_counter() - started, 3),
+                ),
+            )
+            print(f"Se ha producido un error: {exc}")
+            for message in accepted:
+                self.budgets.release(
+                    message.author.name, ConversationStore.key_for(message)[0], reserved
+                )
+            await last.channel.send(self._fallback_reply(None))
+            return
+
+        total_tokens, total_cost = self._record_batch_usage(
+            accepted, in_tokens, out_tokens, model, reserved
+        )
+
+        # Añadimos la respuesta a memoria
+        await self.memory.ensure_loaded(ConversationStore.key_for(last))
+        self._save_reply_in_memory(last, reply)
+        self.summarizer.maybe_schedule(ConversationStore.key_for(last))
+
+        logger.info(
+            f"SESSION ID: {self.session_id} | "
+            f"{settings.BOT_NAME} dijo ({len(accepted)} mensajes agrupados): "
+            f"{reply} | "
+            f"Modelo: {model} | "
+            f"Tokens totales: {total_tokens} | "
+            f"Coste total: {total_cost}",
+            extra=self._log_extra(
+                last,
+                model=model,
+                tokens=total_tokens,
+                cost=total_cost,
+                latency=round(time.perf_counter() - started, 3),
+            ),
+        )
+
+        if isinstance(response, ChatCompletion):
+            with tracer.span("send"):
+                await last.channel.send(reply)
+
+    async def on_message(self, message: Message):
+        # No respondas a ti mismo o a otros bots
+        if message.author == self.user or message.author.bot:
+            return
+
+        # Inicializamos reply para evitar errores
+        reply = ""
+
+        if self.recorder is not None:
+            self.recorder.record(message)
+
+        # Una fracción de los mensajes se traza entera en el log
+        tracer.start_trace()
+
+        # Guarda el mensaje en la memoria tanto del usuario como del bot
+        with tracer.span("memory"):
+            await self.memory.ensure_loaded(ConversationStore.key_for(message))
+            self._save_in_memory(message)
+            self.summarizer.maybe_schedule(ConversationStore.key_for(message))
+
+        # Logging
+        logger.info(
+            f"SESSION ID: {self.session_id} | {message.author} dijo: {message.content}",
+            extra=self._log_extra(message),
+        )
+
+        # Si el mensaje contiene el comando, responde
+        if message.content.lower().startswith(settings.CHAT_COMMAND):
+            if self.coalescer is not None:
+                self.coalescer.submit(message)
+            else:
+                with tracer.span("chat"):
+                    await self._handle_chat(message)
 
         elif message.content.lower().startswith(settings.INFO_COMMAND):
             elapsed_time = time.perf_counter() - self.session_start
             days, remainder = divmod(elapsed_time, 86400)  # 86400 segundos en un día
             hours, remainder = divmod(remainder, 3600)
             minutes, seconds = divmod(remainder, 60)
+            session, alltime, shard_stats = await self._stats_snapshot()
 
             try:
                 reply = format_stats(
                     template=settings.STATS_REPLY_TEMPLATE,
                     session_id=self.session_id,
-                    version=get_project_version(),
+                    version=PROJECT_VERSION,
                     model=self.model,
                     elapsed_days=int(days),
                     elapsed_hours=int(hours),
                     elapsed_minutes=int(minutes),
                     elapsed_seconds=int(seconds),
-                    total_tokens=self.bot_stats.total_tokens,
-                    total_queries=self.bot_stats.total_queries,
-                    total_cost=round(self.bot_stats.total_cost, 4),
-                    user_stats=self.bot_stats.user_stats,
-                    max_cost=round(self.bot_stats.max_cost, 4),
+                    total_tokens=session["total_tokens"],
+                    total_queries=session["total_queries"],
+                    total_cost=round(session["total_cost"], 4),
+                    user_stats=session["user_stats"],
+                    max_cost=round(session["max_cost"], 4),
                     session_start_time=self.session_start_date,
+                    conversations=len(self.memory),
+                    memory_messages=self.memory.total_messages,
+                    memory_hits=self.memory.hits,
+                    memory_misses=self.memory.misses,
+                    memory_evictions=self.memory.evictions,
+                    alltime=alltime,
+                    cache_hits=(self.response_cache.hits if self.response_cache else 0),
+                    cache_hit_rate=(
+                        self.response_cache.hit_rate if self.response_cache else 0.0
+                    ),
+                    scheduler=self.scheduler.stats(),
+                    latency=tracer.summary(),
+                    model_stats=session["model_stats"],
+                    shard_stats=shard_stats,
+                    budget=self.budgets.status(
+                        message.author.name, ConversationStore.key_for(message)[0]
+                    ),
+                    resilience=self.resilience.stats(),
                 )
             except FormatterException as fexc:
                 reply = f"Se ha producido un error al formatear {fexc}"
@@ -359,7 +1383,9 @@ class DiscordClient(discord.Client):
                 logger.error(reply)
                 print(reply)
             finally:
-                await message.channel.send(reply)
+                # Con tráfico las estadísticas superan el límite de discord
+                for chunk in split_message(reply):
+                    await message.channel.send(chunk)
 
         elif message.content.lower().startswith(settings.HELP_COMMAND):
             reply = format_help(
@@ -370,6 +1396,13 @@ class DiscordClient(discord.Client):
             )
             await message.channel.send(reply)
 
+        trace = tracer.finish_trace()
+        if trace is not None:
+            logger.info(
+                f"SESSION ID: {self.session_id} | Traza: {trace}",
+                extra=self._log_extra(message),
+            )
+
 
 if __name__ == "__main__":
     intents = discord.Intents.default()
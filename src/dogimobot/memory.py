@@ -0,0 +1,451 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memoria de conversaciones del bot.
+Cada conversación se identifica por (guild, canal/hilo)
+y tiene su propia ventana de mensajes. Las conversaciones
+inactivas se desalojan (LRU) cuando se supera el tope
+global de mensajes en memoria. Con shards cada shard tiene
+su propio almacén y su propio tope. Si el backend es compartido
+con otros procesos se comprueba en cada consulta la versión
+de la conversación en el backend y se recarga si ha cambiado,
+para ver también los mensajes de los demás.
+Las lecturas del backend se hacen en un hilo aparte con
+ensure_loaded antes de usar la conversación."""
+
+import asyncio
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Any, Callable, Deque, Iterator, Optional, Union
+
+from discord import Message
+
+from dogimobot import settings
+
+if TYPE_CHECKING:
+    from dogimobot.persistence import SQLiteMemoryBackend
+    from dogimobot.state import StateBackend
+
+    MemoryBackend = Union[SQLiteMemoryBackend, StateBackend]
+
+ConversationKey = tuple[Optional[int], int]
+# Ventana, resumen y tokens del resumen tal como los devuelve backend.load
+LoadedConversation = tuple[list[dict[str, Any]], str, int]
+# Versión en el backend compartido (None si no se comparte) y conversación
+VersionedConversation = tuple[Optional[tuple[int, int]], LoadedConversation]
+
+
+def shard_for(guild_id: Optional[int], shard_count: int) -> int:
+    """Shard al que discord asigna un guild. Los mensajes
+    directos (sin guild) llegan siempre por el shard 0
+
+    Parameters
+    ----------
+    guild_id : Optional[int]
+        _description_
+    shard_count : int
+        _description_
+
+    Returns
+    -------
+    int
+        _description_
+    """
+    if guild_id is None:
+        return 0
+    return (guild_id >> 22) % shard_count
+
+
+class Conversation:
+    """Ventana acotada de mensajes de un canal o hilo"""
+
+    def __init__(self, window_size: int = settings.MEMORY_SIZE) -> None:
+        self.messages: Deque[dict[str, Any]] = deque(maxlen=window_size)
+        # Resumen acumulado de los mensajes más antiguos
+        self.summary: str = ""
+        self.summary_tokens: int = 0
+        self.summarizing: bool = False
+        # Versión del backend compartido de la que se cargó
+        self.version: Optional[tuple[int, int]] = None
+
+    @property
+    def tokens(self) -> int:
+        """Tokens de los mensajes en la ventana"""
+        return sum(msg["tokens"] for msg in self.messages)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        return iter(self.messages)
+
+
+class ConversationStore:
+    """Almacén de conversaciones con desalojo LRU
+    de las conversaciones menos usadas cuando el total
+    de mensajes supera max_messages
+    """
+
+    def __init__(
+        self,
+        window_size: int = settings.MEMORY_SIZE,
+        max_messages: int = settings.MEMORY_MAX_MESSAGES,
+        backend: Optional["MemoryBackend"] = None,
+    ) -> None:
+        """Inicializa el almacén
+
+        Parameters
+        ----------
+        window_size : int, optional
+            Número máximo de mensajes por conversación
+        max_messages : int, optional
+            Número máximo de mensajes sumando todas las conversaciones
+        backend : Optional[MemoryBackend], optional
+            Backend persistente. Si se indica, las conversaciones
+            que no están en memoria se cargan de él y los mensajes
+            nuevos se encolan para guardarlos
+        """
+        self.window_size = window_size
+        self.max_messages = max_messages
+        self.backend = backend
+        self._conversations: OrderedDict[ConversationKey, Conversation] = OrderedDict()
+        # Conversaciones leídas del backend pendientes de entrar en memoria
+        self._preloaded: dict[ConversationKey, VersionedConversation] = {}
+        self.total_messages: int = 0
+        # Contadores
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @staticmethod
+    def key_for(message: Message) -> ConversationKey:
+        """Devuelve la clave de la conversación a la que
+        pertenece el mensaje. Los hilos son canales en discord
+        así que tienen su propia conversación. En mensajes
+        directos no hay guild y se usa None.
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+
+        Returns
+        -------
+        ConversationKey
+            Tupla (guild_id, channel_id)
+        """
+        guild_id = message.guild.id if message.guild is not None else None
+        return guild_id, message.channel.id
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._conversations
+
+    def peek(self, key: ConversationKey) -> Optional[Conversation]:
+        """Devuelve la conversación si existe sin contarla
+        como consulta ni cambiar su posición en el LRU"""
+        return self._conversations.get(key)
+
+    async def ensure_loaded(self, key: ConversationKey) -> None:
+        """Lee del backend en un hilo aparte la conversación
+        si no está en memoria, para que la lectura no bloquee
+        el event loop. La conversación entra en memoria la
+        próxima vez que se consulta. Si ya está en memoria y el
+        backend es compartido la recarga solo si su versión
+        ha cambiado.
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        """
+        if self.backend is None:
+            return
+        conversation = self._conversations.get(key)
+        if conversation is not None:
+            if self.backend.shared:
+                await self._refresh(key, conversation)
+            return
+        if key in self._preloaded:
+            return
+        loaded = await asyncio.to_thread(self._read, key, self.backend)
+        # Mientras se leía puede haberse creado la conversación
+        if key not in self._conversations:
+            self._preloaded[key] = loaded
+
+    async def _refresh(self, key: ConversationKey, conversation: Conversation) -> None:
+        """Recarga la conversación del backend compartido si
+        otro proceso (o un volcado) ha cambiado su versión"""
+        backend: "StateBackend" = self.backend  # type: ignore[assignment]
+        version = await asyncio.to_thread(backend.conversation_version, key)
+        if version == conversation.version:
+            return
+        marker = self._marker(conversation)
+        loaded = await asyncio.to_thread(backend.load, key, self.window_size)
+        # Si mientras se leía se ha desalojado o cambiado en este
+        # proceso se descarta la lectura y se recarga en la siguiente
+        if self._conversations.get(key) is conversation and (
+            self._marker(conversation) == marker
+        ):
+            self._apply(conversation, loaded)
+            conversation.version = version
+
+    @staticmethod
+    def _marker(conversation: Conversation) -> tuple[Optional[int], str]:
+        """Último mensaje y resumen, para detectar cambios locales"""
+        last = id(conversation.messages[-1]) if conversation.messages else None
+        return last, conversation.summary
+
+    def _read(
+        self, key: ConversationKey, backend: "MemoryBackend"
+    ) -> VersionedConversation:
+        """Lee del backend la conversación y su versión. La versión
+        se lee antes para que una escritura entre las dos lecturas
+        solo pueda provocar una recarga de más"""
+        version = (
+            backend.conversation_version(key)  # type: ignore[union-attr]
+            if backend.shared
+            else None
+        )
+        return version, backend.load(key, self.window_size)
+
+    def _get_or_create(self, key: ConversationKey) -> Conversation:
+        """Devuelve la conversación marcándola como la más
+        reciente. Si no existe la crea vacía."""
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            conversation = Conversation(self.window_size)
+            self._conversations[key] = conversation
+            if self.backend is not None:
+                # Carga perezosa de la ventana reciente guardada.
+                # Si no se ha precargado con ensure_loaded se lee aquí
+                preloaded = self._preloaded.pop(key, None)
+                if preloaded is None:
+                    preloaded = self._read(key, self.backend)
+                conversation.version, loaded = preloaded
+                self._apply(conversation, loaded)
+        else:
+            self._preloaded.pop(key, None)
+            self._conversations.move_to_end(key)
+        return conversation
+
+    def _apply(self, conversation: Conversation, loaded: LoadedConversation) -> None:
+        """Sustituye la ventana y el resumen de la conversación
+        por los leídos del backend"""
+        entries, summary, summary_tokens = loaded
+        self.total_messages += len(entries) - len(conversation)
+        conversation.messages.clear()
+        conversation.messages.extend(entries)
+        conversation.summary = summary
+        conversation.summary_tokens = summary_tokens
+
+    def get(self, key: ConversationKey) -> Conversation:
+        """Devuelve la conversación para construir el contexto
+        y actualiza los contadores de aciertos y fallos
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+
+        Returns
+        -------
+        Conversation
+            _description_
+        """
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return self._get_or_create(key)
+
+    def append(self, key: ConversationKey, entry: dict[str, Any]) -> None:
+        """Añade un mensaje a la conversación y desaloja
+        conversaciones inactivas si se supera el tope global
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        entry : dict[str, Any]
+            Mensaje a guardar
+        """
+        conversation = self._get_or_create(key)
+        if len(conversation.messages) < self.window_size:
+            self.total_messages += 1
+        conversation.messages.append(entry)
+        if self.backend is not None:
+            self.backend.enqueue(key, entry)
+        self._evict()
+
+    def fold(
+        self,
+        key: ConversationKey,
+        entries: list[dict[str, Any]],
+        summary: str,
+        summary_tokens: int,
+    ) -> int:
+        """Sustituye los mensajes más antiguos de la conversación
+        por un resumen. Solo se quitan los mensajes resumidos que
+        sigan al principio de la ventana, por si han llegado
+        mensajes nuevos mientras se generaba el resumen.
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        entries : list[dict[str, Any]]
+            Mensajes incluidos en el resumen
+        summary : str
+            Nuevo resumen de la conversación
+        summary_tokens : int
+            Tokens del resumen
+
+        Returns
+        -------
+        int
+            Número de mensajes eliminados de la ventana
+        """
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            # La conversación se ha desalojado mientras tanto
+            return 0
+
+        summarized = {id(entry) for entry in entries}
+        removed = 0
+        while conversation.messages and id(conversation.messages[0]) in summarized:
+            conversation.messages.popleft()
+            removed += 1
+
+        self.total_messages -= removed
+        conversation.summary = summary
+        conversation.summary_tokens = summary_tokens
+        if self.backend is not None:
+            self.backend.save_summary(key, summary, summary_tokens, entries)
+        return removed
+
+    def _evict(self) -> None:
+        """Desaloja las conversaciones menos usadas
+        hasta quedar por debajo del tope global.
+        Nunca desaloja la conversación más reciente."""
+        while self.total_messages > self.max_messages and len(self._conversations) > 1:
+            _, conversation = self._conversations.popitem(last=False)
+            self.total_messages -= len(conversation)
+            self.evictions += 1
+
+    @property
+    def hit_rate(self) -> float:
+        """Porcentaje de aciertos sobre el total de consultas"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class ShardedConversationStore(ConversationStore):
+    """Almacén repartido en un ConversationStore por shard.
+    Cada conversación pertenece al shard de su guild, así que
+    un shard con mucho tráfico solo desaloja sus conversaciones.
+    Los contadores son la suma de los de todos los shards.
+    """
+
+    def __init__(
+        self,
+        shard_count: Callable[[], int],
+        window_size: int = settings.MEMORY_SIZE,
+        max_messages: int = settings.MEMORY_MAX_MESSAGES,
+        backend: Optional["MemoryBackend"] = None,
+    ) -> None:
+        """Inicializa el almacén
+
+        Parameters
+        ----------
+        shard_count : Callable[[], int]
+            Devuelve el número total de shards. Es una función porque
+            discord puede decidirlo al conectar
+        window_size : int, optional
+            Número máximo de mensajes por conversación
+        max_messages : int, optional
+            Número máximo de mensajes en cada shard
+        backend : Optional[MemoryBackend], optional
+            Backend persistente compartido por todos los shards
+        """
+        super().__init__(window_size, max_messages, backend)
+        self.shard_count = shard_count
+        self.shards: dict[int, ConversationStore] = {}
+
+    def shard(self, key: ConversationKey) -> ConversationStore:
+        """Almacén del shard de la conversación"""
+        shard_id = shard_for(key[0], self.shard_count())
+        store = self.shards.get(shard_id)
+        if store is None:
+            store = self.shards[shard_id] = ConversationStore(
+                self.window_size, self.max_messages, self.backend
+            )
+        return store
+
+    def _sync(
+        self, store: ConversationStore, before: tuple[int, int, int, int]
+    ) -> None:
+        """Suma a los contadores globales lo que han
+        cambiado los del shard en la última operación"""
+        total_messages, hits, misses, evictions = before
+        self.total_messages += store.total_messages - total_messages
+        self.hits += store.hits - hits
+        self.misses += store.misses - misses
+        self.evictions += store.evictions - evictions
+
+    @staticmethod
+    def _counters(store: ConversationStore) -> tuple[int, int, int, int]:
+        return store.total_messages, store.hits, store.misses, store.evictions
+
+    def __len__(self) -> int:
+        return sum(len(store) for store in self.shards.values())
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, tuple):
+            return False
+        return key in self.shard(key)
+
+    def peek(self, key: ConversationKey) -> Optional[Conversation]:
+        return self.shard(key).peek(key)
+
+    async def ensure_loaded(self, key: ConversationKey) -> None:
+        await self.shard(key).ensure_loaded(key)
+
+    def get(self, key: ConversationKey) -> Conversation:
+        store = self.shard(key)
+        before = self._counters(store)
+        conversation = store.get(key)
+        self._sync(store, before)
+        return conversation
+
+    def append(self, key: ConversationKey, entry: dict[str, Any]) -> None:
+        store = self.shard(key)
+        before = self._counters(store)
+        store.append(key, entry)
+        self._sync(store, before)
+
+    def fold(
+        self,
+        key: ConversationKey,
+        entries: list[dict[str, Any]],
+        summary: str,
+        summary_tokens: int,
+    ) -> int:
+        store = self.shard(key)
+        before = self._counters(store)
+        removed = store.fold(key, entries, summary, summary_tokens)
+        self._sync(store, before)
+        return removed
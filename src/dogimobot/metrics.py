@@ -0,0 +1,317 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Métricas del bot en formato de texto de Prometheus.
+Los contadores ya los llevan BotStats, el planificador, la
+caché, etc. y se leen al pedir /metrics; los histogramas de
+latencia se alimentan desde el tracer con cubos fijos, así que
+cada evento cuesta O(1). Para exportarlas se levanta un
+servidor HTTP mínimo en el event loop del bot."""
+
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+from dogimobot import settings
+from dogimobot.budgets import BudgetTracker
+from dogimobot.cache import ResponseCache
+from dogimobot.logging_config import logger
+from dogimobot.memory import ConversationStore
+from dogimobot.rate_limiting import RateLimiter
+from dogimobot.resilience import CircuitBreaker, ResilientCaller
+from dogimobot.scheduler import RequestScheduler
+from dogimobot.stats import BotStats
+from dogimobot.tracing import Tracer
+
+# Muestra: nombre de la métrica, etiquetas y valor
+Sample = tuple[str, dict[str, str], float]
+
+# Nombre -> (tipo, ayuda) de las métricas exportadas
+METRICS: dict[str, tuple[str, str]] = {
+    "dogimobot_queries_total": ("counter", "Peticiones respondidas por openAI"),
+    "dogimobot_tokens_total": ("counter", "Tokens consumidos por dirección"),
+    "dogimobot_cost_dollars_total": ("counter", "Coste acumulado en dólares"),
+    "dogimobot_user_queries_total": ("counter", "Peticiones por usuario"),
+    "dogimobot_user_tokens_total": ("counter", "Tokens por usuario"),
+    "dogimobot_user_cost_dollars_total": ("counter", "Coste en dólares por usuario"),
+    "dogimobot_model_queries_total": ("counter", "Peticiones por modelo"),
+    "dogimobot_model_tokens_total": ("counter", "Tokens por modelo"),
+    "dogimobot_model_cost_dollars_total": ("counter", "Coste en dólares por modelo"),
+    "dogimobot_rate_limit_rejections_total": (
+        "counter",
+        "Peticiones rechazadas por el rate limit",
+    ),
+    "dogimobot_budget_rejections_total": (
+        "counter",
+        "Peticiones rechazadas por presupuesto",
+    ),
+    "dogimobot_scheduler_in_flight": ("gauge", "Completions en vuelo"),
+    "dogimobot_scheduler_queue_depth": ("gauge", "Peticiones esperando turno"),
+    "dogimobot_scheduler_avg_wait_seconds": ("gauge", "Espera media en la cola"),
+    "dogimobot_openai_retries_total": ("counter", "Reintentos a openAI"),
+    "dogimobot_openai_failures_total": ("counter", "Peticiones fallidas a openAI"),
+    "dogimobot_openai_circuit_open": (
+        "gauge",
+        "1 si el circuit breaker no está cerrado",
+    ),
+    "dogimobot_memory_conversations": ("gauge", "Conversaciones en memoria"),
+    "dogimobot_memory_messages": ("gauge", "Mensajes en memoria"),
+    "dogimobot_cache_entries": ("gauge", "Respuestas en la caché"),
+    "dogimobot_cache_hits_total": ("counter", "Aciertos de la caché de respuestas"),
+    "dogimobot_stage_latency_seconds": ("histogram", "Latencia por etapa del pipeline"),
+}
+
+
+class Histogram:
+    """Histograma de cubos fijos como los de Prometheus"""
+
+    def __init__(self, buckets: Iterable[float]) -> None:
+        self.buckets: list[float] = sorted(buckets)
+        # Observaciones por cubo (no acumuladas). La última es +Inf
+        self.counts: list[int] = [0] * (len(self.buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Límite superior de cada cubo con las observaciones
+        acumuladas hasta él, acabando en +Inf"""
+        total = 0
+        result: list[tuple[str, int]] = []
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else f"{bound:g}", total))
+        return result
+
+
+def _escape(value: str) -> str:
+    """Escapa el valor de una etiqueta"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_sample(name: str, labels: dict[str, str], value: float) -> str:
+    if labels:
+        rendered = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        name = f"{name}{{{rendered}}}"
+    return f"{name} {value}" if isinstance(value, int) else f"{name} {float(value)!r}"
+
+
+class MetricsRegistry:
+    """Reúne las métricas del bot y las renderiza"""
+
+    def __init__(
+        self, latency_buckets: Iterable[float] = settings.METRICS_LATENCY_BUCKETS
+    ) -> None:
+        """Inicializa el registro
+
+        Parameters
+        ----------
+        latency_buckets : Iterable[float], optional
+            Límites en segundos de los cubos de latencia
+        """
+        self.latency_buckets = tuple(latency_buckets)
+        # Etapa -> histograma de latencias
+        self.latencies: dict[str, Histogram] = {}
+        self.collectors: list[Callable[[], Iterable[Sample]]] = []
+
+    def observe_latency(self, stage: str, seconds: float) -> None:
+        """Apunta la duración de una etapa. Se registra
+        como listener del tracer
+
+        Parameters
+        ----------
+        stage : str
+            _description_
+        seconds : float
+            _description_
+        """
+        histogram = self.latencies.get(stage)
+        if histogram is None:
+            histogram = self.latencies[stage] = Histogram(self.latency_buckets)
+        histogram.observe(seconds)
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        """Añade una función que devuelve muestras al renderizar"""
+        self.collectors.append(collector)
+
+    def _latency_samples(self) -> Iterable[Sample]:
+        name = "dogimobot_stage_latency_seconds"
+        for stage, histogram in self.latencies.items():
+            for bound, count in histogram.cumulative():
+                yield f"{name}_bucket", {"stage": stage, "le": bound}, count
+            yield f"{name}_sum", {"stage": stage}, histogram.sum
+            yield f"{name}_count", {"stage": stage}, histogram.count
+
+    def render(self) -> str:
+        """Devuelve las métricas en formato de texto de Prometheus
+
+        Returns
+        -------
+        str
+            _description_
+        """
+        families: dict[str, list[str]] = {}
+        for collector in [*self.collectors, self._latency_samples]:
+            for name, labels, value in collector():
+                family = name
+                for suffix in ("_bucket", "_sum", "_count"):
+                    if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+                        family = name[: -len(suffix)]
+                families.setdefault(family, []).append(
+                    _format_sample(name, labels, value)
+                )
+        lines: list[str] = []
+        for family, samples in families.items():
+            kind, description = METRICS.get(family, ("untyped", family))
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def stats_collector(bot_stats: BotStats) -> Callable[[], Iterable[Sample]]:
+    """Muestras de consumo de la sesión"""
+
+    def collect() -> Iterable[Sample]:
+        yield "dogimobot_queries_total", {}, bot_stats.total_queries
+        yield "dogimobot_tokens_total", {"direction": "in"}, bot_stats.input_tokens
+        yield "dogimobot_tokens_total", {"direction": "out"}, bot_stats.output_tokens
+        yield "dogimobot_cost_dollars_total", {}, bot_stats.total_cost
+        for kind, label, table in (
+            ("user", "user", bot_stats.user_stats),
+            ("model", "model", bot_stats.model_stats),
+        ):
+            for key, stats in list(table.items()):
+                labels = {label: key}
+                yield f"dogimobot_{kind}_queries_total", labels, stats["queries"]
+                yield f"dogimobot_{kind}_tokens_total", labels, stats["tokens"]
+                yield f"dogimobot_{kind}_cost_dollars_total", labels, stats["cost"]
+
+    return collect
+
+
+def runtime_collector(
+    memory: ConversationStore,
+    scheduler: RequestScheduler,
+    resilience: ResilientCaller,
+    budgets: BudgetTracker,
+    response_cache: Optional[ResponseCache] = None,
+) -> Callable[[], Iterable[Sample]]:
+    """Muestras del estado de los componentes del bot"""
+
+    def collect() -> Iterable[Sample]:
+        yield "dogimobot_rate_limit_rejections_total", {}, RateLimiter.rejections
+        yield "dogimobot_budget_rejections_total", {}, budgets.rejections
+        yield "dogimobot_scheduler_in_flight", {}, scheduler.in_flight
+        yield "dogimobot_scheduler_queue_depth", {}, scheduler.queue_depth
+        yield "dogimobot_scheduler_avg_wait_seconds", {}, scheduler.avg_wait
+        yield "dogimobot_openai_retries_total", {}, resilience.retries
+        yield "dogimobot_openai_failures_total", {}, resilience.failures
+        yield (
+            "dogimobot_openai_circuit_open",
+            {},
+            int(resilience.breaker.state != CircuitBreaker.CLOSED),
+        )
+        yield "dogimobot_memory_conversations", {}, len(memory)
+        yield "dogimobot_memory_messages", {}, memory.total_messages
+        if response_cache is not None:
+            yield "dogimobot_cache_entries", {}, len(response_cache)
+            yield "dogimobot_cache_hits_total", {}, response_cache.hits
+
+    return collect
+
+
+class MetricsServer:
+    """Servidor HTTP mínimo que sirve GET /metrics"""
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        host: str = settings.METRICS_HOST,
+        port: int = settings.METRICS_PORT,
+    ) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    @classmethod
+    def for_components(
+        cls,
+        tracer: Tracer,
+        bot_stats: BotStats,
+        memory: ConversationStore,
+        scheduler: RequestScheduler,
+        resilience: ResilientCaller,
+        budgets: BudgetTracker,
+        response_cache: Optional[ResponseCache] = None,
+        port: Optional[int] = None,
+    ) -> "MetricsServer":
+        """Crea el servidor con las métricas de los componentes
+        del bot y conecta el tracer a los histogramas.
+        Si no se indica el puerto se lee settings.METRICS_PORT
+        al llamar, porque cada proceso con shards usa uno distinto"""
+        registry = MetricsRegistry()
+        registry.add_collector(stats_collector(bot_stats))
+        registry.add_collector(
+            runtime_collector(memory, scheduler, resilience, budgets, response_cache)
+        )
+        tracer.listeners.append(registry.observe_latency)
+        return cls(
+            registry,
+            host=settings.METRICS_HOST,
+            port=settings.METRICS_PORT if port is None else port,
+        )
+
+    async def start(self) -> None:
+        """Empieza a escuchar en el event loop actual"""
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Métricas disponibles en http://{self.host}:{self.port}/metrics")
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            # Descartamos las cabeceras
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status = "200 OK"
+                body = self.registry.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as exc:
+            logger.warning(f"Error sirviendo las métricas: {exc!r}")
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
@@ -0,0 +1,454 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistencia de la memoria de conversaciones y de las estadísticas.
+
+La memoria se guarda en SQLite en modo WAL y las escrituras se acumulan
+en memoria y se vuelcan por lotes en segundo plano, de forma
+que guardar un mensaje nunca hace I/O en el event loop.
+Al arrancar solo se carga, bajo demanda, la ventana reciente
+de cada conversación.
+
+Las estadísticas se guardan como una instantánea JSON que se
+reemplaza de forma atómica más un diario de cambios (JSON lines)
+con los cambios posteriores a la instantánea."""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Optional
+
+from openai.types.chat.chat_completion_assistant_message_param import (
+    ChatCompletionAssistantMessageParam,
+)
+from openai.types.chat.chat_completion_user_message_param import (
+    ChatCompletionUserMessageParam,
+)
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+from dogimobot.stats import BotStats
+
+ConversationKey = tuple[Optional[int], int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    author TEXT NOT NULL,
+    time TEXT,
+    content TEXT NOT NULL,
+    rendered TEXT NOT NULL,
+    tokens INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation
+    ON messages (guild_id, channel_id, id);
+CREATE TABLE IF NOT EXISTS summaries (
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, channel_id)
+);
+"""
+
+
+def row_key(key: ConversationKey) -> tuple[int, int]:
+    """Los mensajes directos no tienen guild; se guardan con guild 0"""
+    guild_id, channel_id = key
+    return (guild_id if guild_id is not None else 0), channel_id
+
+
+def entry_from_row(
+    db_id: int,
+    role: str,
+    author: str,
+    time: Optional[str],
+    content: str,
+    rendered: str,
+    tokens: int,
+) -> dict[str, Any]:
+    """Reconstruye un mensaje de la memoria a partir de lo guardado
+
+    Parameters
+    ----------
+    db_id : int
+        Id del mensaje en el almacén
+    role : str
+        _description_
+    author : str
+        _description_
+    time : Optional[str]
+        _description_
+    content : str
+        _description_
+    rendered : str
+        Contenido tal y como se manda a openAI
+    tokens : int
+        _description_
+
+    Returns
+    -------
+    dict[str, Any]
+        Mensaje con la forma de los de ConversationStore
+    """
+    param = (
+        ChatCompletionAssistantMessageParam(role="assistant", content=rendered)
+        if role == "assistant"
+        else ChatCompletionUserMessageParam(role="user", content=rendered)
+    )
+    return {
+        "role": role,
+        "content": content,
+        "author": author,
+        "time": time,
+        "attachments": None,
+        "param": param,
+        "tokens": tokens,
+        "db_id": db_id,
+    }
+
+
+class SQLiteMemoryBackend:
+    """Backend de memoria persistente en SQLite
+    con escrituras por lotes
+    """
+
+    # Solo lo usa este proceso (ver dogimobot.state para compartirlo)
+    shared: bool = False
+
+    def __init__(
+        self,
+        path: Path = settings.DATA_FOLDER / settings.MEMORY_DB_FILE,
+        flush_interval: float = settings.MEMORY_FLUSH_INTERVAL,
+    ) -> None:
+        """Abre (o crea) la base de datos
+
+        Parameters
+        ----------
+        path : Path, optional
+            Ruta del fichero de la base de datos
+        flush_interval : float, optional
+            Segundos entre volcados de las escrituras pendientes
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        # La conexión se comparte entre el event loop y el hilo de volcado
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            row = self._conn.execute("SELECT MAX(id) FROM messages").fetchone()
+        # Los ids se asignan al encolar para poder referenciarlos en los resúmenes
+        self._next_id: int = (row[0] or 0) + 1
+        self._pending_messages: list[tuple[Any, ...]] = []
+        self._pending_summaries: list[tuple[Any, ...]] = []
+
+    @property
+    def pending(self) -> int:
+        """Número de escrituras pendientes de volcar"""
+        return len(self._pending_messages) + len(self._pending_summaries)
+
+    def enqueue(self, key: ConversationKey, entry: dict[str, Any]) -> None:
+        """Encola un mensaje para guardarlo en el próximo volcado.
+        No hace I/O.
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        entry : dict[str, Any]
+            Mensaje ya renderizado (con param y tokens)
+        """
+        entry["db_id"] = self._next_id
+        self._next_id += 1
+        self._pending_messages.append(
+            (
+                entry["db_id"],
+                *row_key(key),
+                entry["role"],
+                entry["author"],
+                entry.get("time"),
+                entry["content"],
+                str(entry["param"]["content"]),
+                entry["tokens"],
+            )
+        )
+
+    def save_summary(
+        self,
+        key: ConversationKey,
+        summary: str,
+        tokens: int,
+        entries: list[dict[str, Any]],
+    ) -> None:
+        """Encola el resumen de la conversación junto con el id
+        del último mensaje que incluye, para no volver a cargar
+        los mensajes ya resumidos al arrancar
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        summary : str
+            _description_
+        tokens : int
+            Tokens del resumen
+        entries : list[dict[str, Any]]
+            Mensajes incluidos en el resumen
+        """
+        last_id = max((entry.get("db_id", 0) for entry in entries), default=0)
+        self._pending_summaries.append((*row_key(key), summary, tokens, last_id))
+
+    def _take_pending(self) -> tuple[list[tuple[Any, ...]], list[tuple[Any, ...]]]:
+        """Se lleva las escrituras pendientes. Se llama desde
+        el event loop para no competir con enqueue"""
+        messages, self._pending_messages = self._pending_messages, []
+        summaries, self._pending_summaries = self._pending_summaries, []
+        return messages, summaries
+
+    def _write(
+        self, messages: list[tuple[Any, ...]], summaries: list[tuple[Any, ...]]
+    ) -> int:
+        """Escribe un lote en una única transacción.
+        Puede ejecutarse en otro hilo."""
+        if not messages and not summaries:
+            return 0
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages "
+                "(id, guild_id, channel_id, role, author, time, content, rendered, tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                messages,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO summaries "
+                "(guild_id, channel_id, summary, tokens, last_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                summaries,
+            )
+        return len(messages) + len(summaries)
+
+    def flush(self) -> int:
+        """Escribe de forma síncrona todas las escrituras pendientes
+
+        Returns
+        -------
+        int
+            Número de escrituras volcadas
+        """
+        return self._write(*self._take_pending())
+
+    def load(
+        self, key: ConversationKey, limit: int
+    ) -> tuple[list[dict[str, Any]], str, int]:
+        """Carga la ventana reciente de una conversación
+        y su resumen. Usa el índice por conversación así que
+        solo lee las filas necesarias.
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        limit : int
+            Número máximo de mensajes a cargar
+
+        Returns
+        -------
+        tuple[list[dict[str, Any]], str, int]
+            Mensajes de más antiguo a más reciente, resumen y tokens del resumen
+        """
+        guild_id, channel_id = row_key(key)
+        with self._lock:
+            summary_row = self._conn.execute(
+                "SELECT summary, tokens, last_id FROM summaries "
+                "WHERE guild_id = ? AND channel_id = ?",
+                (guild_id, channel_id),
+            ).fetchone()
+            summary, summary_tokens, last_id = summary_row or ("", 0, 0)
+            rows = self._conn.execute(
+                "SELECT id, role, author, time, content, rendered, tokens "
+                "FROM messages WHERE guild_id = ? AND channel_id = ? AND id > ? "
+                "ORDER BY id DESC LIMIT ?",
+                (guild_id, channel_id, last_id, limit),
+            ).fetchall()
+
+        entries = [entry_from_row(*row) for row in reversed(rows)]
+        return entries, summary, summary_tokens
+
+    async def run(self) -> None:
+        """Bucle en segundo plano que vuelca las escrituras
+        pendientes cada flush_interval segundos en un hilo"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            messages, summaries = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write, messages, summaries)
+            except Exception as exc:
+                logger.error(f"Error guardando la memoria en {self.path}: {exc}")
+                # Devolvemos el lote a la cola para reintentarlo
+                self._pending_messages[:0] = messages
+                self._pending_summaries[:0] = summaries
+
+    def close(self) -> None:
+        """Vuelca lo pendiente y cierra la conexión"""
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+class StatsStore:
+    """Persistencia de BotStats con instantáneas atómicas
+    y un diario de cambios entre instantáneas
+    """
+
+    def __init__(
+        self,
+        folder: Path = settings.DATA_FOLDER,
+        flush_interval: float = settings.STATS_FLUSH_INTERVAL,
+        snapshot_interval: float = settings.STATS_SNAPSHOT_INTERVAL,
+    ) -> None:
+        """Inicializa el almacén
+
+        Parameters
+        ----------
+        folder : Path, optional
+            Carpeta donde se guardan la instantánea y el diario
+        flush_interval : float, optional
+            Segundos entre escrituras del diario
+        snapshot_interval : float, optional
+            Segundos entre instantáneas completas
+        """
+        self.snapshot_path = folder / settings.STATS_SNAPSHOT_FILE
+        self.deltas_path = folder / settings.STATS_DELTAS_FILE
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        folder.mkdir(parents=True, exist_ok=True)
+        # Número de secuencia del último cambio registrado
+        self.seq: int = 0
+        # Cambios numerados que aún no se han podido escribir
+        self._unwritten: list[dict[str, Any]] = []
+
+    def load(self) -> dict[str, Any]:
+        """Carga los totales históricos: la instantánea más
+        los cambios del diario posteriores a ella. Ignora una
+        posible última línea a medio escribir.
+
+        Returns
+        -------
+        dict[str, Any]
+            Estado acumulado como el de BotStats.empty_state
+        """
+        state = BotStats.empty_state()
+        snapshot_seq = 0
+        if self.snapshot_path.exists():
+            data = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+            state.update(data["state"])
+            snapshot_seq = data["seq"]
+        self.seq = snapshot_seq
+
+        if self.deltas_path.exists():
+            with open(self.deltas_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        delta = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    # Los cambios ya incluidos en la instantánea se ignoran
+                    if delta["seq"] <= snapshot_seq:
+                        continue
+                    BotStats.apply_delta(state, delta)
+                    self.seq = max(self.seq, delta["seq"])
+        return state
+
+    def _number(self, journal: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Asigna números de secuencia a los cambios"""
+        for delta in journal:
+            self.seq += 1
+            delta["seq"] = self.seq
+        return journal
+
+    def append_deltas(self, deltas: list[dict[str, Any]]) -> None:
+        """Añade los cambios al diario. Puede ejecutarse en otro hilo."""
+        if not deltas:
+            return
+        with open(self.deltas_path, "a", encoding="utf-8") as file:
+            file.writelines(json.dumps(delta) + "\n" for delta in deltas)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def write_snapshot(self, state: dict[str, Any], seq: int) -> None:
+        """Escribe la instantánea en un fichero temporal y lo renombra,
+        de forma que nunca queda una instantánea a medias.
+        Después vacía el diario. Puede ejecutarse en otro hilo.
+
+        Parameters
+        ----------
+        state : dict[str, Any]
+            Totales históricos
+        seq : int
+            Secuencia del último cambio incluido en la instantánea
+        """
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"seq": seq, "state": state}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Si se cae aquí, los cambios con seq <= seq se ignoran al cargar
+        with open(self.deltas_path, "w", encoding="utf-8"):
+            pass
+
+    async def run(self, bot_stats: BotStats) -> None:
+        """Bucle en segundo plano que escribe el diario cada
+        flush_interval segundos y una instantánea cada
+        snapshot_interval segundos
+
+        Parameters
+        ----------
+        bot_stats : BotStats
+            Estadísticas a persistir
+        """
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            elapsed += self.flush_interval
+            try:
+                # El diario y el estado se toman juntos en el event loop
+                self._unwritten.extend(self._number(bot_stats.take_journal()))
+                await asyncio.to_thread(self.append_deltas, self._unwritten)
+                self._unwritten = []
+                if elapsed >= self.snapshot_interval:
+                    elapsed = 0.0
+                    await asyncio.to_thread(
+                        self.write_snapshot, bot_stats.alltime_state(), self.seq
+                    )
+            except Exception as exc:
+                logger.error(f"Error guardando las estadísticas: {exc}")
+
+    def close(self, bot_stats: BotStats) -> None:
+        """Escribe una última instantánea al cerrar"""
+        self._unwritten.extend(self._number(bot_stats.take_journal()))
+        self.append_deltas(self._unwritten)
+        self._unwritten = []
+        self.write_snapshot(bot_stats.alltime_state(), self.seq)
@@ -14,25 +14,45 @@
 
 """Clase con métodos de rate limitter para decorar la función
 de obtener respuesta de openAI.
-El método limit de RateLimitter hace de decorador"""
+El método limit de RateLimitter hace de decorador.
 
-from collections import defaultdict
-from datetime import datetime
+El límite se implementa con token buckets: cada usuario tiene
+un bucket de peticiones y otro de tokens de openAI, y además hay
+un par de buckets globales compartidos por todos los usuarios
+(uno por shard si el cliente está repartido en shards).
+Cada decisión es O(1) y los buckets de usuarios inactivos
+se eliminan, por lo que el estado está acotado.
+
+Si se asigna RateLimiter.backend (ver dogimobot.state) los buckets
+viven en el backend y se comparten con los demás procesos del bot."""
+
+import asyncio
+from collections import OrderedDict
 from functools import wraps
+import inspect
+import math
 import random
-from typing import Callable, Any
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, Union
 
 from discord import Message
 from openai.types.chat.chat_completion import ChatCompletion, Choice
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
 from dogimobot import settings
+from dogimobot.tracing import tracer
+
+if TYPE_CHECKING:
+    from dogimobot.state import BucketSpec, StateBackend
+
+RATE_LIMIT_ID_PREFIX = "ratelimit-"
 
 
-def default_response(user: str) -> ChatCompletion:
+def default_response(user: str, retry_after: Optional[float] = None) -> ChatCompletion:
     """Respuesta por defecto cuando el usuario excede el rate limit"""
+    wait = settings.RATE_LIMIT if retry_after is None else math.ceil(retry_after)
     return ChatCompletion(
-        id=f"chatcmpl-{random.randint(111, 9999)}",
+        id=f"{RATE_LIMIT_ID_PREFIX}{random.randint(111, 9999)}",
         object="chat.completion",
         created=1677652288,
         model=settings.MODELO,
@@ -42,9 +62,9 @@ def default_response(user: str) -> ChatCompletion:
                 message=ChatCompletionMessage(
                     role="assistant",
                     content=(
-                        f"\n\n🛑 No tan rápido, {settings.USERS[user]}. "
+                        f"\n\n🛑 No tan rápido, {settings.USERS.get(user, user)}. "
                         f"Has excedido el límite de mensajes por minuto. "
-                        f"Por favor, espera {settings.RATE_LIMIT} segundos para enviar otro mensaje."
+                        f"Por favor, espera {wait} segundos para enviar otro mensaje."
                     ),
                 ),
                 logprobs=None,
@@ -54,44 +74,349 @@ def default_response(user: str) -> ChatCompletion:
     )
 
 
+def is_default_response(response: ChatCompletion) -> bool:
+    """Indica si la respuesta es la local por exceder el rate limit"""
+    return response.id.startswith(RATE_LIMIT_ID_PREFIX)
+
+
+class TokenBucket:
+    """Bucket que se rellena a ritmo constante hasta su capacidad.
+    Permite ráfagas de como mucho capacity unidades."""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, period: float, now: float) -> None:
+        """Crea el bucket lleno
+
+        Parameters
+        ----------
+        capacity : float
+            Unidades máximas (y ráfaga máxima)
+        period : float
+            Segundos en rellenar el bucket vacío
+        now : float
+            Instante actual (time.monotonic)
+        """
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, amount: float, now: float) -> bool:
+        """Indica si hay al menos amount unidades"""
+        self._refill(now)
+        return self.tokens >= amount
+
+    def take(self, amount: float, now: float) -> None:
+        """Consume unidades. El saldo puede quedar negativo
+        (deuda) cuando se cobra el consumo real a posteriori"""
+        self._refill(now)
+        self.tokens -= amount
+
+    def retry_after(self, amount: float) -> float:
+        """Segundos hasta que vuelva a haber amount unidades"""
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def idle(self, now: float) -> bool:
+        """Un bucket que se ha rellenado del todo no guarda
+        información y se puede eliminar"""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
 class RateLimiter:
-    track: defaultdict[str, dict[str, Any]] = defaultdict(
-        lambda: {"num_peticiones": 0, "start": datetime.now()}
-    )
+    # Buckets por usuario: nombre -> (peticiones, tokens). Ordenados por uso
+    buckets: OrderedDict[str, tuple[TokenBucket, TokenBucket]] = OrderedDict()
+    # Buckets globales (peticiones, tokens) por shard (None sin shards).
+    # Se crean con el primer uso
+    global_buckets: dict[Optional[int], tuple[TokenBucket, TokenBucket]] = {}
+    # Peticiones rechazadas desde el arranque
+    rejections: int = 0
+    # Estado compartido con otros procesos. None para guardarlo en memoria
+    backend: Optional["StateBackend"] = None
+
+    @staticmethod
+    def reset() -> None:
+        """Vacía todo el estado del rate limiter"""
+        RateLimiter.buckets = OrderedDict()
+        RateLimiter.global_buckets = {}
+        RateLimiter.rejections = 0
+        RateLimiter.backend = None
+
+    @staticmethod
+    def bucket_specs(
+        user_key: str,
+        msg_per_minute: int,
+        rate_time: int,
+        shard: Optional[int],
+        tokens: int = 0,
+    ) -> tuple["BucketSpec", "BucketSpec", "BucketSpec", "BucketSpec"]:
+        """Buckets del usuario y globales en un backend compartido
+
+        Returns
+        -------
+        tuple[BucketSpec, BucketSpec, BucketSpec, BucketSpec]
+            Peticiones del usuario, peticiones globales, tokens del usuario
+            y tokens globales. Las peticiones consumen una unidad y los
+            tokens la cantidad indicada
+        """
+        return (
+            (f"user:{user_key}:requests", msg_per_minute, rate_time, 1),
+            (
+                f"global:{shard}:requests",
+                settings.GLOBAL_MAX_MSG_PER_MINUTE,
+                settings.RATE_LIMIT,
+                1,
+            ),
+            (
+                f"user:{user_key}:tokens",
+                settings.MAX_TOKENS_PER_MINUTE,
+                rate_time,
+                tokens,
+            ),
+            (
+                f"global:{shard}:tokens",
+                settings.GLOBAL_MAX_TOKENS_PER_MINUTE,
+                settings.RATE_LIMIT,
+                tokens,
+            ),
+        )
+
+    @staticmethod
+    def _get_global_buckets(
+        now: float, shard: Optional[int] = None
+    ) -> tuple[TokenBucket, TokenBucket]:
+        buckets = RateLimiter.global_buckets.get(shard)
+        if buckets is None:
+            buckets = RateLimiter.global_buckets[shard] = (
+                TokenBucket(
+                    settings.GLOBAL_MAX_MSG_PER_MINUTE, settings.RATE_LIMIT, now
+                ),
+                TokenBucket(
+                    settings.GLOBAL_MAX_TOKENS_PER_MINUTE, settings.RATE_LIMIT, now
+                ),
+            )
+        return buckets
+
+    @staticmethod
+    def _get_user_buckets(
+        user_key: str, msg_per_minute: int, rate_time: int, now: float
+    ) -> tuple[TokenBucket, TokenBucket]:
+        """Devuelve los buckets del usuario creándolos si no existen
+        y elimina los de usuarios inactivos (amortizado O(1))"""
+        buckets = RateLimiter.buckets
+        user_buckets = buckets.get(user_key)
+        if user_buckets is None:
+            user_buckets = (
+                TokenBucket(msg_per_minute, rate_time, now),
+                TokenBucket(settings.MAX_TOKENS_PER_MINUTE, rate_time, now),
+            )
+            buckets[user_key] = user_buckets
+        else:
+            buckets.move_to_end(user_key)
+
+        # Los menos usados están al principio
+        while len(buckets) > 1:
+            oldest_key, (requests, tokens) = next(iter(buckets.items()))
+            if oldest_key == user_key:
+                break
+            if len(buckets) <= settings.RATE_LIMIT_MAX_KEYS and not (
+                requests.idle(now) and tokens.idle(now)
+            ):
+                break
+            del buckets[oldest_key]
+        return user_buckets
+
+    @staticmethod
+    def acquire(
+        user_key: str,
+        msg_per_minute: int = settings.MAX_MSG_PER_MINUTES,
+        rate_time: int = settings.RATE_LIMIT,
+        shard: Optional[int] = None,
+    ) -> Optional[float]:
+        """Intenta registrar una petición del usuario.
+        Se admite si hay saldo de peticiones y de tokens tanto
+        en los buckets del usuario como en los globales del shard.
+
+        Parameters
+        ----------
+        user_key : str
+            Nombre del usuario que hace la petición
+        msg_per_minute : int
+            Número máximo de peticiones (y ráfaga máxima) en rate_time
+        rate_time : int
+            Segundos en recuperar todas las peticiones
+        shard : Optional[int], optional
+            Shard del que llega el mensaje. None sin shards
+
+        Returns
+        -------
+        Optional[float]
+            None si se admite la petición o los segundos
+            que hay que esperar si se rechaza
+        """
+        if RateLimiter.backend is not None:
+            retry_after = RateLimiter.backend.acquire(
+                list(
+                    RateLimiter.bucket_specs(user_key, msg_per_minute, rate_time, shard)
+                ),
+                time.time(),
+            )
+            if retry_after is not None:
+                RateLimiter.rejections += 1
+            return retry_after
+
+        now = time.monotonic()
+        user_requests, user_tokens = RateLimiter._get_user_buckets(
+            user_key, msg_per_minute, rate_time, now
+        )
+        global_requests, global_tokens = RateLimiter._get_global_buckets(now, shard)
+
+        # Comprobamos todos antes de consumir para no gastar a medias.
+        # Los buckets de tokens solo exigen no estar en deuda
+        blocked = [
+            bucket.retry_after(1)
+            for bucket in (user_requests, global_requests, user_tokens, global_tokens)
+            if not bucket.available(1, now)
+        ]
+        if blocked:
+            RateLimiter.rejections += 1
+            return max(blocked)
+
+        user_requests.take(1, now)
+        global_requests.take(1, now)
+        return None
+
+    @staticmethod
+    async def acquire_async(
+        user_key: str,
+        msg_per_minute: int = settings.MAX_MSG_PER_MINUTES,
+        rate_time: int = settings.RATE_LIMIT,
+        shard: Optional[int] = None,
+    ) -> Optional[float]:
+        """Como acquire pero para el event loop: si el backend es
+        compartido la consulta (una transacción o un script en el
+        servidor) se hace en un hilo aparte
+
+        Returns
+        -------
+        Optional[float]
+            None si se admite la petición o los segundos
+            que hay que esperar si se rechaza
+        """
+        backend = RateLimiter.backend
+        if backend is None or not backend.shared:
+            return RateLimiter.acquire(user_key, msg_per_minute, rate_time, shard)
+        retry_after = await asyncio.to_thread(
+            backend.acquire,
+            list(RateLimiter.bucket_specs(user_key, msg_per_minute, rate_time, shard)),
+            time.time(),
+        )
+        if retry_after is not None:
+            RateLimiter.rejections += 1
+        return retry_after
+
+    @staticmethod
+    def consume_tokens(user_key: str, tokens: int, shard: Optional[int] = None) -> None:
+        """Cobra los tokens consumidos por una petición ya hecha.
+        El saldo puede quedar en deuda y bloquea nuevas peticiones
+        hasta que se recupere
+
+        Parameters
+        ----------
+        user_key : str
+            _description_
+        tokens : int
+            Tokens (in + out) de la petición
+        shard : Optional[int], optional
+            Shard del que llegó el mensaje. None sin shards
+        """
+        if RateLimiter.backend is not None:
+            _, _, user_tokens, global_tokens = RateLimiter.bucket_specs(
+                user_key,
+                settings.MAX_MSG_PER_MINUTES,
+                settings.RATE_LIMIT,
+                shard,
+                tokens=tokens,
+            )
+            RateLimiter.backend.charge([user_tokens, global_tokens], time.time())
+            return
+
+        now = time.monotonic()
+        user_buckets = RateLimiter.buckets.get(user_key)
+        if user_buckets is not None:
+            user_buckets[1].take(tokens, now)
+        RateLimiter._get_global_buckets(now, shard)[1].take(tokens, now)
+
+    @staticmethod
+    def shard_of(args: tuple[Any, ...], message: Message) -> Optional[int]:
+        """Shard del mensaje según el cliente decorado
+        (el primer argumento) o None si no usa shards"""
+        shard_of = getattr(args[0], "shard_of", None) if args else None
+        return shard_of(message) if callable(shard_of) else None
 
     @staticmethod
     def limit(
         msg_per_minute: int = settings.MAX_MSG_PER_MINUTES,
         rate_time: int = settings.RATE_LIMIT,
     ):
+        """Decorador de rate limit. Admite tanto funciones
+        síncronas como corrutinas: si la función decorada
+        es una corrutina, el wrapper también lo es y puede
+        ser awaited desde el event loop de discord."""
+
         def func_wrapper(
-            f: Callable[[Message, list[ChatCompletionMessage]], ChatCompletion]
-        ) -> Callable[[Message, list[ChatCompletionMessage]], ChatCompletion]:
+            f: Callable[
+                [Message, list[ChatCompletionMessage]],
+                Union[ChatCompletion, Awaitable[ChatCompletion]],
+            ],
+        ) -> Callable[
+            [Message, list[ChatCompletionMessage]],
+            Union[ChatCompletion, Awaitable[ChatCompletion]],
+        ]:
+            if inspect.iscoroutinefunction(f):
+
+                @wraps(f)
+                async def async_wrapper(*args, **kwds) -> ChatCompletion:
+                    # Trackear el usuario
+                    mensaje: Message = kwds["message"]
+                    user_key: str = mensaje.author.name
+
+                    with tracer.span("rate_limit"):
+                        retry_after = await RateLimiter.acquire_async(
+                            user_key,
+                            msg_per_minute,
+                            rate_time,
+                            RateLimiter.shard_of(args, mensaje),
+                        )
+                    if retry_after is not None:
+                        return default_response(user_key, retry_after)
+
+                    response: ChatCompletion = await f(*args, **kwds)  # type: ignore[misc]
+                    return response
+
+                return async_wrapper
+
             @wraps(f)
             def wrapper(*args, **kwds) -> ChatCompletion:
                 # Trackear el usuario
                 mensaje: Message = kwds["message"]
                 user_key: str = mensaje.author.name
-                user_data = RateLimiter.track[user_key]
-
-                # Comprobar si el tiempo ha pasado un minuto
-                now: datetime = datetime.now()
-                inicio: datetime = user_data["start"]
-                elapsed_time: float = (now - inicio).total_seconds()
-
-                if elapsed_time > rate_time:
-                    # Resetear el contador
-                    user_data["num_peticiones"] = 0
-                    user_data["start"] = now
-
-                # Incrementar el contador de peticiones
-                user_data["num_peticiones"] += 1
 
-                # Verificar si el número de peticiones excede el límite
-                if user_data["num_peticiones"] > msg_per_minute:
-                    return default_response(user_key)
+                with tracer.span("rate_limit"):
+                    retry_after = RateLimiter.acquire(
+                        user_key,
+                        msg_per_minute,
+                        rate_time,
+                        RateLimiter.shard_of(args, mensaje),
+                    )
+                if retry_after is not None:
+                    return default_response(user_key, retry_after)
 
-                return f(*args, **kwds)
+                return f(*args, **kwds)  # type: ignore[return-value]
 
             return wrapper
 
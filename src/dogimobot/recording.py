@@ -0,0 +1,206 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Grabación opcional del tráfico de los canales para poder
+reproducirlo después en benchmarks/replay.py.
+
+Solo se guarda la forma de cada mensaje, nunca su contenido:
+hash del autor y del canal, instante, longitud, comando y tipos
+de los adjuntos. Los eventos se acumulan en memoria y se añaden
+a un fichero JSONL desde un hilo cada flush_interval segundos."""
+
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+import time
+from typing import Any, Optional
+
+from discord import Message
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+
+
+def anonymize(value: str, salt: str = settings.RECORDING_SALT) -> str:
+    """Hash corto y con sal de un identificador
+
+    Parameters
+    ----------
+    value : str
+        _description_
+    salt : str, optional
+        _description_
+
+    Returns
+    -------
+    str
+        _description_
+    """
+    return hashlib.sha256(f"{salt}:{value}".encode()).hexdigest()[:12]
+
+
+def command_of(content: str) -> str:
+    """Comando con el que empieza el mensaje o "" si no tiene"""
+    lowered = content.lower()
+    for command in (
+        settings.CHAT_COMMAND,
+        settings.INFO_COMMAND,
+        settings.HELP_COMMAND,
+    ):
+        if lowered.startswith(command):
+            return command
+    return ""
+
+
+class TrafficRecorder:
+    """Añade a un fichero JSONL un evento anónimo por mensaje"""
+
+    def __init__(
+        self,
+        path: Path = settings.DATA_FOLDER / settings.RECORDING_FILE,
+        flush_interval: float = settings.RECORDING_FLUSH_INTERVAL,
+        salt: str = settings.RECORDING_SALT,
+    ) -> None:
+        """Inicializa la grabadora
+
+        Parameters
+        ----------
+        path : Path, optional
+            Fichero JSONL donde se añaden los eventos
+        flush_interval : float, optional
+            Segundos entre escrituras por lotes
+        salt : str, optional
+            Sal de los hashes de autores y canales
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.salt = salt
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._pending: list[dict[str, Any]] = []
+        self.recorded: int = 0
+
+    def event_for(self, message: Message) -> dict[str, Any]:
+        """Evento anónimo de un mensaje
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+
+        Returns
+        -------
+        dict[str, Any]
+            ts (instante), a (autor), c (guild/canal), cmd (comando),
+            len (caracteres sin el comando) y att (tipos de los adjuntos)
+        """
+        command = command_of(message.content)
+        guild_id = message.guild.id if message.guild is not None else None
+        return {
+            "ts": round(time.time(), 3),
+            "a": anonymize(message.author.name, self.salt),
+            "c": anonymize(f"{guild_id}/{message.channel.id}", self.salt),
+            "cmd": command,
+            "len": len(message.content) - len(command),
+            "att": [
+                attachment.content_type or "" for attachment in message.attachments
+            ],
+        }
+
+    def record(self, message: Message) -> None:
+        """Encola el evento del mensaje. O(1) en el event loop"""
+        self._pending.append(self.event_for(message))
+        self.recorded += 1
+
+    def append_events(self, events: list[dict[str, Any]]) -> None:
+        """Añade los eventos al fichero. Puede ejecutarse en otro hilo."""
+        if not events:
+            return
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.writelines(
+                json.dumps(event, separators=(",", ":")) + "\n" for event in events
+            )
+
+    def flush(self) -> None:
+        events, self._pending = self._pending, []
+        self.append_events(events)
+
+    async def run(self) -> None:
+        """Bucle en segundo plano que escribe los eventos
+        pendientes cada flush_interval segundos en un hilo"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            events, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self.append_events, events)
+            except Exception as exc:
+                logger.error(f"Error guardando el tráfico en {self.path}: {exc}")
+                self._pending[:0] = events
+
+
+def load_events(path: Path) -> list[dict[str, Any]]:
+    """Lee una grabación ignorando una posible
+    última línea a medio escribir
+
+    Parameters
+    ----------
+    path : Path
+        _description_
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        Eventos ordenados por instante
+    """
+    events: list[dict[str, Any]] = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    events.sort(key=lambda event: event["ts"])
+    return events
+
+
+def replay_delays(
+    events: list[dict[str, Any]], speed: float = 1.0, max_gap: Optional[float] = None
+) -> list[float]:
+    """Segundos a esperar antes de cada evento para
+    reproducir la grabación a speed veces su velocidad
+
+    Parameters
+    ----------
+    events : list[dict[str, Any]]
+        Eventos ordenados por instante
+    speed : float, optional
+        1 es tiempo real, 10 diez veces más rápido
+    max_gap : Optional[float], optional
+        Espera máxima entre dos eventos (antes de acelerar),
+        para saltarse los ratos sin tráfico y los reinicios del bot
+
+    Returns
+    -------
+    list[float]
+        Una espera por evento. La primera es 0
+    """
+    delays: list[float] = []
+    previous: Optional[float] = None
+    for event in events:
+        gap = 0.0 if previous is None else event["ts"] - previous
+        if max_gap is not None:
+            gap = min(gap, max_gap)
+        delays.append(gap / speed)
+        previous = event["ts"]
+    return delays
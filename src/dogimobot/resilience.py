@@ -0,0 +1,305 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Capa de resiliencia alrededor de openAI.
+Reintenta los errores transitorios (429, 5xx, timeouts y
+errores de conexión) con backoff exponencial y jitter,
+respetando la cabecera Retry-After, y abre un circuit
+breaker cuando openAI falla seguido para no seguir
+machacando a un proveedor degradado."""
+
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from openai import APIConnectionError
+
+from dogimobot import settings
+from dogimobot.exceptions import CircuitOpenException
+from dogimobot.logging_config import logger
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Indica si el error de openAI es transitorio
+
+    Parameters
+    ----------
+    exc : BaseException
+        _description_
+
+    Returns
+    -------
+    bool
+        True para timeouts, errores de conexión, 429 y 5xx
+    """
+    # APITimeoutError hereda de APIConnectionError
+    if isinstance(exc, APIConnectionError):
+        return True
+    status_code = getattr(exc, "status_code", None)
+    if not isinstance(status_code, int):
+        return False
+    return status_code in RETRYABLE_STATUS or status_code >= 500
+
+
+def get_retry_after(exc: BaseException) -> Optional[float]:
+    """Devuelve los segundos que pide esperar openAI
+    en la cabecera Retry-After (o retry-after-ms) del error
+
+    Parameters
+    ----------
+    exc : BaseException
+        _description_
+
+    Returns
+    -------
+    Optional[float]
+        Segundos o None si no hay cabecera o no es un número
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # Retry-After también puede ser una fecha HTTP: se ignora
+        return None
+    return None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Backoff exponencial con full jitter: un valor aleatorio
+    entre 0 y base_delay * 2 ** attempt, con tope max_delay
+
+    Parameters
+    ----------
+    attempt : int
+        Número de reintento empezando en 0
+    base_delay : float
+        _description_
+    max_delay : float
+        _description_
+
+    Returns
+    -------
+    float
+        Segundos a esperar
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    """Circuit breaker con tres estados:
+    cerrado (todo normal), abierto (se rechaza sin llamar)
+    y semiabierto (se deja pasar una petición de prueba)
+    """
+
+    CLOSED = "cerrado"
+    OPEN = "abierto"
+    HALF_OPEN = "semiabierto"
+
+    def __init__(
+        self,
+        failure_threshold: int = settings.BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = settings.BREAKER_RESET_TIMEOUT,
+    ) -> None:
+        """Inicializa el breaker
+
+        Parameters
+        ----------
+        failure_threshold : int, optional
+            Fallos seguidos que abren el circuito
+        reset_timeout : float, optional
+            Segundos abierto antes de probar de nuevo
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.times_opened: int = 0
+        self._probing: bool = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def probing(self) -> bool:
+        """Indica si hay una petición de prueba en curso"""
+        return self._probing
+
+    def allow(self) -> bool:
+        """Indica si se puede llamar a openAI.
+        En semiabierto solo pasa una petición de prueba a la vez"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self) -> None:
+        """Termina la petición de prueba sin cambiar el estado,
+        para cuando no dice nada de si openAI funciona"""
+        self._probing = False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Circuit breaker de openAI cerrado")
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        # Si falla la petición de prueba se vuelve a abrir
+        if self._probing or self.consecutive_failures >= self.failure_threshold:
+            if self.state == self.CLOSED:
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+            self._probing = False
+            logger.warning(
+                f"Circuit breaker de openAI abierto tras "
+                f"{self.consecutive_failures} fallos seguidos"
+            )
+
+
+class ResilientCaller:
+    """Ejecuta las llamadas a openAI con reintentos
+    y circuit breaker
+    """
+
+    def __init__(
+        self,
+        breaker: Optional[CircuitBreaker] = None,
+        max_retries: int = settings.RETRY_MAX_RETRIES,
+        base_delay: float = settings.RETRY_BASE_DELAY,
+        max_delay: float = settings.RETRY_MAX_DELAY,
+        sleep: Optional[Callable[[float], Awaitable[None]]] = None,
+    ) -> None:
+        """Inicializa la capa de resiliencia
+
+        Parameters
+        ----------
+        breaker : Optional[CircuitBreaker], optional
+            _description_
+        max_retries : int, optional
+            Reintentos como máximo después del primer intento
+        base_delay : float, optional
+            Espera base del backoff en segundos
+        max_delay : float, optional
+            Espera máxima entre intentos. Si Retry-After
+            pide más no se reintenta
+        sleep : Optional[Callable[[float], Awaitable[None]]], optional
+            Corrutina para esperar entre intentos. Por defecto
+            asyncio.sleep
+        """
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        # Métricas
+        self.retries: int = 0
+        self.failures: int = 0
+        self.fast_failures: int = 0
+
+    async def call(self, func: Callable[[], Awaitable[T]]) -> T:
+        """Llama a func reintentando los errores transitorios
+
+        Parameters
+        ----------
+        func : Callable[[], Awaitable[T]]
+            Función que hace la llamada a openAI
+
+        Returns
+        -------
+        T
+            Lo que devuelva func
+
+        Raises
+        ------
+        CircuitOpenException
+            Si el circuito está abierto
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.fast_failures += 1
+                raise CircuitOpenException("openAI no está disponible")
+            # Tras allow solo hay prueba en curso si es esta petición
+            probe = self.breaker.probing
+            try:
+                result = await func()
+            except Exception as exc:
+                if not is_retryable(exc):
+                    # Errores nuestros (400, 401...) no dicen nada de openAI
+                    if probe:
+                        self.breaker.release()
+                    raise
+                self.failures += 1
+                self.breaker.record_failure()
+
+                retry_after = get_retry_after(exc)
+                if attempt >= self.max_retries or (
+                    retry_after is not None and retry_after > self.max_delay
+                ):
+                    logger.error(f"Error de openAI sin más reintentos: {exc!r}")
+                    raise
+                delay = (
+                    retry_after
+                    if retry_after is not None
+                    else backoff_delay(attempt, self.base_delay, self.max_delay)
+                )
+                logger.warning(
+                    f"Error transitorio de openAI ({exc!r}). "
+                    f"Reintento {attempt + 1}/{self.max_retries} en {delay:.2f}s"
+                )
+                self.retries += 1
+                attempt += 1
+                if self.sleep is not None:
+                    await self.sleep(delay)
+                else:
+                    await asyncio.sleep(delay)
+            except BaseException:
+                # Cancelada: si era la petición de prueba hay que soltarla
+                if probe:
+                    self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    def stats(self) -> dict[str, Any]:
+        """Métricas de reintentos y estado del breaker"""
+        return {
+            "state": self.breaker.state,
+            "retries": self.retries,
+            "failures": self.failures,
+            "fast_failures": self.fast_failures,
+            "times_opened": self.breaker.times_opened,
+        }
@@ -0,0 +1,203 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Enrutado de peticiones entre los modelos de OPENAI_PRICING.
+Las preguntas cortas y sencillas van al modelo barato y las
+largas o complejas al modelo potente. El tamaño del prompt,
+las preferencias por usuario y el presupuesto que queda
+pueden cambiar la elección."""
+
+import re
+from typing import Callable, Optional, Union
+
+from dogimobot import settings
+from dogimobot.tokens import count_tokens, get_context_budget
+
+# Pistas de que la pregunta necesita razonamiento largo
+COMPLEX_PATTERNS = re.compile(
+    r"```|\b(analiza\w*|compara\w*|demuestra\w*|diseñ\w*|optimiza\w*|"
+    r"depura\w*|refactoriza\w*|paso a paso|en detalle|por qué|explica\w*)\b",
+    re.IGNORECASE,
+)
+
+
+def estimate_cost(model: str, in_tokens: int, out_tokens: int) -> float:
+    """Coste en dólares de una petición con el modelo indicado
+
+    Parameters
+    ----------
+    model : str
+        _description_
+    in_tokens : int
+        _description_
+    out_tokens : int
+        _description_
+
+    Returns
+    -------
+    float
+        _description_
+    """
+    pricing = settings.OPENAI_PRICING[model]
+    return (in_tokens * pricing["in"] + out_tokens * pricing["out"]) / 1e6
+
+
+def tokens_for(prompt_tokens: Union[int, Callable[[str], int]], model: str) -> int:
+    """Tokens del prompt que se enviaría al modelo
+
+    Parameters
+    ----------
+    prompt_tokens : Union[int, Callable[[str], int]]
+        Tokens del prompt o función que los da para cada modelo
+    model : str
+        _description_
+
+    Returns
+    -------
+    int
+        _description_
+    """
+    if callable(prompt_tokens):
+        return prompt_tokens(model)
+    return prompt_tokens
+
+
+class ModelRouter:
+    """Elige el modelo de cada petición"""
+
+    def __init__(
+        self,
+        default_model: str = settings.MODELO,
+        cheap_model: str = settings.ROUTING_CHEAP_MODEL,
+        strong_model: str = settings.ROUTING_STRONG_MODEL,
+        overrides: Optional[dict[str, str]] = None,
+        enabled: bool = settings.ROUTING_ENABLED,
+    ) -> None:
+        """Inicializa el router
+
+        Parameters
+        ----------
+        default_model : str, optional
+            Modelo si el enrutado está desactivado
+        cheap_model : str, optional
+            Modelo para preguntas sencillas
+        strong_model : str, optional
+            Modelo para preguntas complejas
+        overrides : Optional[dict[str, str]], optional
+            Modelo fijo por usuario. Por defecto ROUTING_USER_OVERRIDES
+        enabled : bool, optional
+            Si es False todas las peticiones usan default_model
+
+        Raises
+        ------
+        ValueError
+            Si alguno de los modelos del enrutado no tiene precio
+        """
+        self.default_model = default_model
+        self.cheap_model = cheap_model
+        self.strong_model = strong_model
+        self.overrides = (
+            overrides if overrides is not None else settings.ROUTING_USER_OVERRIDES
+        )
+        self.enabled = enabled
+        if not enabled:
+            return
+        for model in [cheap_model, strong_model, *self.overrides.values()]:
+            if model not in settings.OPENAI_PRICING:
+                raise ValueError(
+                    f"El modelo {model} no es válido. Modelos válidos: "
+                    f"{', '.join(settings.OPENAI_PRICING.keys())}"
+                )
+
+    @staticmethod
+    def is_complex(question: str) -> bool:
+        """Detecta si la pregunta es compleja: larga, con código
+        o pidiendo análisis, comparaciones o explicaciones
+
+        Parameters
+        ----------
+        question : str
+            _description_
+
+        Returns
+        -------
+        bool
+            _description_
+        """
+        if count_tokens(question) >= settings.ROUTING_COMPLEX_MIN_TOKENS:
+            return True
+        return COMPLEX_PATTERNS.search(question) is not None
+
+    def route(
+        self,
+        question: str,
+        prompt_tokens: Union[int, Callable[[str], int]],
+        user: Optional[str] = None,
+        remaining_budget: Optional[float] = None,
+    ) -> tuple[str, str]:
+        """Elige el modelo para una petición
+
+        Parameters
+        ----------
+        question : str
+            Pregunta sin el comando
+        prompt_tokens : Union[int, Callable[[str], int]]
+            Tokens estimados del prompt que se envía (contexto incluido)
+            o función que los da para cada modelo, porque el historial
+            se recorta al presupuesto de contexto de cada uno
+        user : Optional[str], optional
+            Usuario que pregunta, para las preferencias por usuario
+        remaining_budget : Optional[float], optional
+            Dólares que quedan de presupuesto. None si no hay límite
+
+        Returns
+        -------
+        tuple[str, str]
+            Modelo elegido y motivo de la elección
+        """
+        if not self.enabled:
+            return self.default_model, "por defecto"
+        if user is not None and user in self.overrides:
+            return self.overrides[user], "preferencia del usuario"
+
+        if self.is_complex(question):
+            model, reason = self.strong_model, "pregunta compleja"
+        else:
+            model, reason = self.cheap_model, "pregunta sencilla"
+
+        # Si ni el prompt recortado cabe se pasa al modelo
+        # barato con más contexto
+        if tokens_for(prompt_tokens, model) > get_context_budget(model):
+            candidates = sorted(
+                (
+                    m
+                    for m in settings.OPENAI_PRICING
+                    if get_context_budget(m) >= tokens_for(prompt_tokens, m)
+                ),
+                key=lambda m: estimate_cost(m, tokens_for(prompt_tokens, m), 0),
+            )
+            if candidates:
+                model, reason = candidates[0], "contexto largo"
+
+        # Con poco presupuesto se baja al modelo barato
+        if remaining_budget is not None and model != self.cheap_model:
+            expected = estimate_cost(
+                model,
+                tokens_for(prompt_tokens, model),
+                settings.ROUTING_EXPECTED_OUT_TOKENS,
+            )
+            if expected > remaining_budget * settings.ROUTING_MAX_BUDGET_SHARE:
+                model, reason = self.cheap_model, "presupuesto bajo"
+
+        return model, reason
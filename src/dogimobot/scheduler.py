@@ -0,0 +1,220 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Planificador de peticiones a openAI.
+Limita cuántas completions hay en vuelo a la vez y reparte
+los huecos de forma justa: por turnos entre canales y, dentro
+de cada canal, por turnos entre usuarios. Las peticiones de
+prioridad alta (administradores) pasan antes que las normales
+y tienen huecos reservados. Las esperas entre reintentos
+se hacen con sleep, que suelta el hueco mientras tanto."""
+
+import asyncio
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from enum import IntEnum
+import time
+from typing import Any, Awaitable, Callable, Deque, Hashable, Optional, TypeVar
+
+from dogimobot import settings
+
+T = TypeVar("T")
+
+# canal -> usuario -> cola de (futuro, instante de encolado)
+Queues = OrderedDict[
+    Hashable, OrderedDict[str, Deque[tuple["asyncio.Future[None]", float]]]
+]
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+
+
+class _Slot:
+    """Hueco que ocupa la petición de la tarea actual"""
+
+    def __init__(self, user: str, channel: Hashable, priority: Priority) -> None:
+        self.user = user
+        self.channel = channel
+        self.priority = priority
+        self.held: bool = True
+
+
+# Hueco de la petición que se está ejecutando en la tarea actual
+_current_slot: ContextVar[Optional[_Slot]] = ContextVar("current_slot", default=None)
+
+
+class RequestScheduler:
+    """Planificador con concurrencia global acotada
+    y colas por turnos por canal y usuario
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = settings.SCHEDULER_MAX_CONCURRENCY,
+        reserved_high: int = settings.SCHEDULER_RESERVED_HIGH,
+    ) -> None:
+        """Inicializa el planificador
+
+        Parameters
+        ----------
+        max_concurrency : int, optional
+            Peticiones en vuelo como máximo
+        reserved_high : int, optional
+            Huecos que solo puede usar la prioridad alta
+        """
+        self.max_concurrency = max_concurrency
+        self.reserved_high = min(reserved_high, max_concurrency - 1)
+        self._queues: dict[Priority, Queues] = {
+            priority: OrderedDict() for priority in Priority
+        }
+        self.in_flight: int = 0
+        self.queue_depth: int = 0
+        # Métricas
+        self.total_scheduled: int = 0
+        self.max_wait: float = 0.0
+        self.waits: Deque[float] = deque(maxlen=settings.SCHEDULER_WAIT_SAMPLES)
+
+    @property
+    def avg_wait(self) -> float:
+        """Espera media en cola de las últimas peticiones (segundos)"""
+        return sum(self.waits) / len(self.waits) if self.waits else 0.0
+
+    def _limit(self, priority: Priority) -> int:
+        """Huecos que puede ocupar una prioridad"""
+        if priority == Priority.HIGH:
+            return self.max_concurrency
+        return self.max_concurrency - self.reserved_high
+
+    def _pop_next(self, queues: Queues) -> tuple["asyncio.Future[None]", float]:
+        """Saca el siguiente trabajo por turnos: primer canal,
+        primer usuario de ese canal, y los manda al final"""
+        channel, users = next(iter(queues.items()))
+        user, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        if jobs:
+            users.move_to_end(user)
+        else:
+            del users[user]
+        if users:
+            queues.move_to_end(channel)
+        else:
+            del queues[channel]
+        return job
+
+    def _dispatch(self) -> None:
+        """Concede huecos libres a los trabajos en cola"""
+        for priority in Priority:
+            queues = self._queues[priority]
+            while queues and self.in_flight < self._limit(priority):
+                future, enqueued_at = self._pop_next(queues)
+                self.queue_depth -= 1
+                if future.done():
+                    # El que esperaba se ha cancelado
+                    continue
+                wait = time.perf_counter() - enqueued_at
+                self.waits.append(wait)
+                self.max_wait = max(self.max_wait, wait)
+                self.in_flight += 1
+                future.set_result(None)
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def _acquire(self, user: str, channel: Hashable, priority: Priority) -> None:
+        """Se pone a la cola y espera a que se conceda un hueco"""
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        queues = self._queues[priority]
+        queues.setdefault(channel, OrderedDict()).setdefault(user, deque()).append(
+            (future, time.perf_counter())
+        )
+        self.queue_depth += 1
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Si ya se nos había concedido el hueco hay que liberarlo
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    async def run(
+        self,
+        func: Callable[[], Awaitable[T]],
+        user: str,
+        channel: Hashable,
+        priority: Priority = Priority.NORMAL,
+    ) -> T:
+        """Espera turno y ejecuta func ocupando un hueco
+
+        Parameters
+        ----------
+        func : Callable[[], Awaitable[T]]
+            Función que lanza la petición
+        user : str
+            Usuario que hace la petición
+        channel : Hashable
+            Canal o conversación de la petición
+        priority : Priority, optional
+            _description_
+
+        Returns
+        -------
+        T
+            Lo que devuelva func
+        """
+        self.total_scheduled += 1
+        await self._acquire(user, channel, priority)
+        slot = _Slot(user, channel, priority)
+        token = _current_slot.set(slot)
+        try:
+            return await func()
+        finally:
+            _current_slot.reset(token)
+            if slot.held:
+                self._release()
+
+    async def sleep(self, delay: float) -> None:
+        """Espera delay segundos. Si la tarea actual ocupa un
+        hueco lo suelta durante la espera y vuelve a la cola
+        después, para que los reintentos no dejen sin hueco
+        a las peticiones de otros usuarios
+
+        Parameters
+        ----------
+        delay : float
+            Segundos a esperar
+        """
+        slot = _current_slot.get()
+        if slot is None or not slot.held:
+            await asyncio.sleep(delay)
+            return
+        slot.held = False
+        self._release()
+        await asyncio.sleep(delay)
+        await self._acquire(slot.user, slot.channel, slot.priority)
+        slot.held = True
+
+    def stats(self) -> dict[str, Any]:
+        """Métricas del planificador"""
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "total_scheduled": self.total_scheduled,
+            "avg_wait": self.avg_wait,
+            "max_wait": self.max_wait,
+        }
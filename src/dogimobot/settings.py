@@ -14,12 +14,57 @@
 
 from pathlib import Path
 
-
 ASSETS_FOLDER = Path("assets")
 # Log
 FOLDER_LOGS = Path("logs")
 LOG_FILE = "dogimobot.log"
 LOG_PATH = FOLDER_LOGS / LOG_FILE
+LOG_LEVEL = "INFO"
+LOG_JSON = False  # registros en JSON lines en el fichero de log
+LOG_ROTATION = "size"  # "size" por tamaño o "time" por tiempo
+LOG_MAX_BYTES = 10_000_000  # rotación por tamaño
+LOG_BACKUP_COUNT = 5
+LOG_ROTATION_WHEN = "midnight"  # rotación por tiempo (ver TimedRotatingFileHandler)
+LOG_ROTATION_INTERVAL = 1
+
+# Trazas de latencia por etapa
+TRACE_WINDOW = 1_000  # duraciones que se guardan por etapa para los percentiles
+TRACE_SAMPLE_RATE = 0.0  # fracción de peticiones que se trazan enteras en el log
+
+# Endpoint de métricas en formato Prometheus
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Datos persistentes
+DATA_FOLDER = Path("data")
+PERSIST_MEMORY = False  # guarda la memoria de conversaciones en SQLite
+MEMORY_DB_FILE = "memory.db"
+MEMORY_FLUSH_INTERVAL = 2.0  # segundos entre escrituras por lotes
+PERSIST_STATS = False  # guarda las estadísticas para tener totales históricos
+STATS_SNAPSHOT_FILE = "stats.json"
+STATS_DELTAS_FILE = "stats.deltas.jsonl"
+STATS_FLUSH_INTERVAL = 5.0  # segundos entre escrituras del diario de cambios
+STATS_SNAPSHOT_INTERVAL = 300.0  # segundos entre instantáneas completas
+RECORD_TRAFFIC = False  # graba la forma (no el contenido) de los mensajes
+RECORDING_FILE = "traffic.jsonl"
+RECORDING_FLUSH_INTERVAL = 5.0  # segundos entre escrituras por lotes
+RECORDING_SALT = "dogimobot"  # cámbiala para que los hashes no se puedan adivinar
+
+# Shards (ver dogimobot.sharding)
+SHARD_STATS_FOLDER = "shards"  # dentro de DATA_FOLDER, una subcarpeta por proceso
+SHARD_STATS_FILE = "live.json"  # estadísticas que cada proceso publica al resto
+SHARD_STATS_INTERVAL = 10.0  # segundos entre publicaciones
+SHARD_STATS_MAX_AGE = 60.0  # la sesión de un proceso sin publicar desde hace más no se suma
+
+# Estado compartido entre procesos (ver dogimobot.state)
+STATE_BACKEND: str | None = None  # None (cada proceso el suyo), "memory", "sqlite" o "redis"
+STATE_DB_FILE = "state.db"  # dentro de DATA_FOLDER, para "sqlite"
+STATE_REDIS_URL = "redis://localhost:6379/0"  # para "redis"
+STATE_KEY_PREFIX = "dogimobot:"  # prefijo de las claves en redis
+STATE_FLUSH_INTERVAL = 1.0  # segundos entre volcados por lotes
+STATE_MAX_STORED_MESSAGES = 1_000  # mensajes guardados por conversación en redis
 
 # Templates
 TEMPLATE_FOLDER = Path("templates")
@@ -27,6 +72,7 @@ STATS_REPLY_FILE = "stats_reply.md"
 STATS_REPLY_TEMPLATE = ASSETS_FOLDER / TEMPLATE_FOLDER / STATS_REPLY_FILE
 HELP_REPLY_FILE = "help_reply.md"
 HELP_REPLY_TEMPLATE = ASSETS_FOLDER / TEMPLATE_FOLDER / HELP_REPLY_FILE
+TEMPLATE_RELOAD_INTERVAL = 2.0  # segundos entre comprobaciones del mtime
 
 # Usuarios
 USERS = {"matata9040": "Sergio", "therealjun": "Afonso", "carlos_71156": "Carlos"}
@@ -34,7 +80,8 @@ USER_EQ = "\n".join(f"El nombre propio de {k} es {v}" for k, v in USERS.items())
 
 # Bot
 BOT_NAME = "Dogimo"
-MEMORY_SIZE = 50
+MEMORY_SIZE = 50  # mensajes por conversación (canal o hilo)
+MEMORY_MAX_MESSAGES = 5000  # tope global de mensajes entre todas las conversaciones
 SYSTEM_PROMPT = f"""Eres un asistente que va al grano y está especializado
 en proporcionar información sobre data science para un canal de discord.
 Tu nombre es {BOT_NAME}.
@@ -59,8 +106,13 @@ CONSIDERACIONES IMPORTANTES:
 - RECUERDA: No preguntes si puedes ayudar en algo y evita saludar repetidamente."""
 
 MODELO = "gpt-3.5-turbo-0125"
-MAX_MSG_PER_MINUTES = 5
+OPENAI_BASE_URL: str | None = None  # API compatible con openAI (None = openAI)
+MAX_MSG_PER_MINUTES = 5  # por usuario, también es la ráfaga máxima
 RATE_LIMIT = 60  # en segundos
+MAX_TOKENS_PER_MINUTE = 20_000  # tokens de openAI por usuario
+GLOBAL_MAX_MSG_PER_MINUTE = 30  # entre todos los usuarios
+GLOBAL_MAX_TOKENS_PER_MINUTE = 100_000
+RATE_LIMIT_MAX_KEYS = 10_000  # usuarios con estado como máximo
 DEFAULT_ERR_ANSWER = "Lo siento, no pude obtener una respuesta adecuada."
 OPENAI_PRICING: dict[str, dict[str, float | int]] = {  # POR MILLON DE TOKENS
     "gpt-3.5-turbo-0125": {"in": 0.5, "out": 1.5},
@@ -70,8 +122,90 @@ OPENAI_PRICING: dict[str, dict[str, float | int]] = {  # POR MILLON DE TOKENS
     "gpt-4-turbo": {"in": 10, "out": 30},
     "gpt-4-turbo-2024-04-09": {"in": 10, "out": 30},
 }
+# Tokens máximos que se envían como contexto (system prompt + historial + mensaje)
+# Se deja margen respecto a la ventana del modelo para la respuesta
+OPENAI_CONTEXT_BUDGET: dict[str, int] = {
+    "gpt-3.5-turbo-0125": 12_000,
+    "gpt-3.5-turbo-instruct": 3_000,
+    "gpt-4": 6_000,
+    "gpt-4-32k": 24_000,
+    "gpt-4-turbo": 16_000,
+    "gpt-4-turbo-2024-04-09": 16_000,
+}
+DEFAULT_CONTEXT_BUDGET = 3_000
+
+# Enrutado de cada petición entre los modelos de OPENAI_PRICING
+ROUTING_ENABLED = False  # si es False todas las peticiones usan MODELO
+ROUTING_CHEAP_MODEL = MODELO  # preguntas cortas y sencillas
+ROUTING_STRONG_MODEL = "gpt-4-turbo"  # preguntas largas o complejas
+ROUTING_COMPLEX_MIN_TOKENS = 150  # a partir de aquí la pregunta es compleja
+ROUTING_USER_OVERRIDES: dict[str, str] = {}  # usuario -> modelo fijo
+ROUTING_BUDGET: float | None = None  # dólares por sesión, None sin límite
+ROUTING_MAX_BUDGET_SHARE = 0.05  # parte del presupuesto restante por petición
+ROUTING_EXPECTED_OUT_TOKENS = 500  # estimación de tokens de respuesta
+
+# Presupuestos de gasto en dólares (None = sin límite)
+BUDGET_USER_DAILY: float | None = None
+BUDGET_USER_MONTHLY: float | None = None
+BUDGET_GUILD_DAILY: float | None = None
+BUDGET_GUILD_MONTHLY: float | None = None
+# Límites propios: "user:<nombre>" o "guild:<id>" -> {"daily": x, "monthly": y}
+BUDGET_OVERRIDES: dict[str, dict[str, float | None]] = {}
+BUDGET_EXCEEDED_ANSWER = (
+    "💸 Se ha agotado el presupuesto {budget}. "
+    "Vuelve a intentarlo cuando se reinicie."
+)
+
+# Resumen de conversaciones
+SUMMARY_ENABLED = True
+SUMMARY_TRIGGER_TOKENS = 4_000  # tokens de historial a partir de los cuales se resume
+SUMMARY_KEEP_MESSAGES = 10  # mensajes más recientes que nunca se resumen
+SUMMARY_MODEL = MODELO
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_PROMPT = """Resume de forma breve y en el idioma de la conversación
+lo más importante de los siguientes mensajes de un canal de Discord:
+temas tratados, decisiones, datos y preferencias de cada usuario.
+Si hay un resumen anterior intégralo en el nuevo. Responde solo con el resumen."""
+
+# Planificador de peticiones a openAI
+SCHEDULER_MAX_CONCURRENCY = 4  # completions en vuelo como máximo
+SCHEDULER_RESERVED_HIGH = 1  # huecos reservados para la prioridad alta
+SCHEDULER_WAIT_SAMPLES = 500  # esperas recientes para calcular la media
+ADMIN_USERS = {"matata9040"}  # usuarios con prioridad alta
+
+# Reintentos y circuit breaker alrededor de openAI
+RETRY_MAX_RETRIES = 3  # reintentos tras el primer intento
+RETRY_BASE_DELAY = 1.0  # segundos, se dobla en cada reintento (con jitter)
+RETRY_MAX_DELAY = 20.0  # espera máxima entre intentos
+BREAKER_FAILURE_THRESHOLD = 5  # fallos seguidos que abren el circuito
+BREAKER_RESET_TIMEOUT = 30.0  # segundos abierto antes de volver a probar
+FALLBACK_ANSWER = (
+    "Ahora mismo no consigo hablar con openAI 😵. Prueba de nuevo en un rato."
+)
+
+# Agrupación de ráfagas de !chat en una sola completion
+COALESCE_ENABLED = False
+COALESCE_WINDOW = 1.5  # segundos que se espera a más !chat desde el primero
+COALESCE_MAX_MESSAGES = 5  # a partir de aquí se responde sin esperar
+COALESCE_PROMPT = """Varios usuarios han preguntado a la vez.
+Responde a cada uno por separado y en el mismo orden,
+empezando cada respuesta con su nombre en negrita."""
+
+# Caché de respuestas
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_MAX_ENTRIES = 500
+RESPONSE_CACHE_TTL = 24 * 3600  # en segundos
+RESPONSE_CACHE_MIN_CHARS = 15  # las preguntas más cortas no se cachean
+
+# Streaming de respuestas
+STREAM_REPLIES = True
+STREAM_PLACEHOLDER = "✍️ ..."
+STREAM_EDIT_INTERVAL = 1.0  # segundos máximos sin editar si hay texto nuevo
+STREAM_EDIT_TOKENS = 40  # tokens nuevos que fuerzan una edición anticipada
+STREAM_MIN_EDIT_INTERVAL = 0.5  # nunca editar más a menudo (rate limit de discord)
 
 # Discord
+DISCORD_MAX_MESSAGE_LENGTH = 2000
 CHAT_COMMAND = "!chat"
 INFO_COMMAND = "!stats"
 HELP_COMMAND = "!help"
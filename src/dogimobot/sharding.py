@@ -0,0 +1,354 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Modo con shards para despliegues en muchos guilds.
+
+ShardedDiscordClient usa discord.AutoShardedClient y reparte por
+shard la memoria de conversaciones, el rate limit global y las
+estadísticas. Los shards se pueden repartir en varios procesos de
+la misma máquina: cada proceso publica sus estadísticas en
+DATA_FOLDER/SHARD_STATS_FOLDER/<proceso>/SHARD_STATS_FILE y lee
+las del resto, de forma que !stats muestra la suma de todos.
+
+Uso (desde la raíz del repositorio):
+    python -m dogimobot.sharding
+    python -m dogimobot.sharding --shard-count 8 --processes 2
+    python -m dogimobot.sharding --shard-count 16 --shards 8-15 --processes 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+from typing import Any, Optional, Sequence
+
+import discord
+from discord import Message
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+from dogimobot.main import DiscordClient
+from dogimobot.memory import ConversationStore, ShardedConversationStore, shard_for
+from dogimobot.stats import BotStats
+from dogimobot.utils import get_discord_key
+
+
+class ShardStatsExchange:
+    """Publica las estadísticas de este proceso y lee
+    las que publican los demás procesos de la máquina"""
+
+    def __init__(
+        self,
+        process_name: str,
+        folder: Path = settings.DATA_FOLDER / settings.SHARD_STATS_FOLDER,
+        interval: float = settings.SHARD_STATS_INTERVAL,
+        max_age: float = settings.SHARD_STATS_MAX_AGE,
+    ) -> None:
+        """Inicializa el intercambio
+
+        Parameters
+        ----------
+        process_name : str
+            Nombre del proceso. Cada proceso publica en su subcarpeta
+        folder : Path, optional
+            Carpeta con una subcarpeta por proceso
+        interval : float, optional
+            Segundos entre publicaciones
+        max_age : float, optional
+            Segundos tras los que la sesión de un proceso
+            que no ha vuelto a publicar deja de sumarse
+        """
+        self.process_name = process_name
+        self.folder = folder
+        self.interval = interval
+        self.max_age = max_age
+        self.path = folder / process_name / settings.SHARD_STATS_FILE
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Últimas estadísticas leídas de los otros procesos
+        self.peers: dict[str, dict[str, Any]] = {}
+
+    @staticmethod
+    def state_of(bot_stats: BotStats) -> dict[str, Any]:
+        """Estadísticas del proceso que se publican"""
+        return {
+            "updated": time.time(),
+            "session": bot_stats.session_state(),
+            "alltime": bot_stats.alltime_state(),
+            "shards": {
+                str(shard): dict(stats)
+                for shard, stats in bot_stats.shard_stats.items()
+            },
+        }
+
+    def publish(self, state: dict[str, Any]) -> None:
+        """Escribe el estado en un fichero temporal y lo renombra
+        para que nadie lea uno a medias. Puede ejecutarse en otro hilo."""
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.path)
+
+    def read_peers(self) -> dict[str, dict[str, Any]]:
+        """Lee lo publicado por los otros procesos.
+        Puede ejecutarse en otro hilo.
+
+        Returns
+        -------
+        dict[str, dict[str, Any]]
+            Nombre del proceso -> estado publicado
+        """
+        peers = {}
+        for path in self.folder.glob(f"*/{settings.SHARD_STATS_FILE}"):
+            name = path.parent.name
+            if name == self.process_name:
+                continue
+            try:
+                peers[name] = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError) as exc:
+                logger.warning(
+                    f"No se han podido leer las estadísticas de {name}: {exc}"
+                )
+        return peers
+
+    def merge(
+        self, bot_stats: BotStats, now: Optional[float] = None
+    ) -> tuple[dict[str, Any], dict[str, Any], dict[int, dict[str, Any]]]:
+        """Suma a las estadísticas propias las de los otros procesos.
+        De los procesos parados solo se suman los históricos
+
+        Parameters
+        ----------
+        bot_stats : BotStats
+            Estadísticas de este proceso
+        now : Optional[float], optional
+            Instante actual (time.time())
+
+        Returns
+        -------
+        tuple[dict[str, Any], dict[str, Any], dict[int, dict[str, Any]]]
+            Las de la sesión, las históricas y las de cada shard
+        """
+        now = time.time() if now is None else now
+        sessions = [bot_stats.session_state()]
+        alltimes = [bot_stats.alltime_state()]
+        shards = {shard: dict(stats) for shard, stats in bot_stats.shard_stats.items()}
+        for peer in self.peers.values():
+            alltimes.append(peer["alltime"])
+            if now - peer["updated"] > self.max_age:
+                continue
+            sessions.append(peer["session"])
+            for shard, stats in peer["shards"].items():
+                shards[int(shard)] = stats
+        return (
+            BotStats.merge_states(*sessions),
+            BotStats.merge_states(*alltimes),
+            shards,
+        )
+
+    async def run(self, bot_stats: BotStats) -> None:
+        """Bucle en segundo plano que publica las estadísticas
+        y lee las de los demás cada interval segundos en un hilo"""
+        while True:
+            try:
+                await asyncio.to_thread(self.publish, self.state_of(bot_stats))
+                self.peers = await asyncio.to_thread(self.read_peers)
+            except Exception as exc:
+                logger.error(f"Error intercambiando las estadísticas de shards: {exc}")
+            await asyncio.sleep(self.interval)
+
+
+class ShardedDiscordClient(DiscordClient, discord.AutoShardedClient):
+    """DiscordClient con shards. Acepta shard_ids y shard_count
+    como discord.AutoShardedClient"""
+
+    def __init__(self, *args, process_name: str = "shards", **kwargs):
+        # Se usa al crear el almacén de estadísticas en DiscordClient
+        self.process_name = process_name
+        super().__init__(*args, **kwargs)
+        self.shard_exchange: ShardStatsExchange = ShardStatsExchange(
+            process_name, settings.DATA_FOLDER / settings.SHARD_STATS_FOLDER
+        )
+
+    def _create_memory(self) -> ConversationStore:
+        """Crea un almacén de conversaciones por shard"""
+        return ShardedConversationStore(
+            lambda: self.shard_count or 1,
+            window_size=settings.MEMORY_SIZE,
+            max_messages=settings.MEMORY_MAX_MESSAGES,
+            backend=self.memory_backend,
+        )
+
+    def _stats_folder(self) -> Path:
+        """Cada proceso persiste sus estadísticas en su subcarpeta"""
+        return settings.DATA_FOLDER / settings.SHARD_STATS_FOLDER / self.process_name
+
+    def shard_of(self, message: Message) -> Optional[int]:
+        """Shard del guild del mensaje
+
+        Parameters
+        ----------
+        message : Message
+            _description_
+
+        Returns
+        -------
+        Optional[int]
+            _description_
+        """
+        guild_id = message.guild.id if message.guild is not None else None
+        return shard_for(guild_id, self.shard_count or 1)
+
+    async def _stats_snapshot(
+        self,
+    ) -> tuple[dict[str, Any], dict[str, Any], Optional[dict[int, dict[str, Any]]]]:
+        """Estadísticas de todos los procesos"""
+        session, alltime, shards = self.shard_exchange.merge(self.bot_stats)
+        if self.state_backend is not None:
+            # Con estado compartido los históricos ya son los de todos
+            alltime = await asyncio.to_thread(self.state_backend.stats_state)
+        return session, alltime, shards
+
+    async def setup_hook(self) -> None:
+        await super().setup_hook()
+        self.background_tasks.append(
+            asyncio.create_task(self.shard_exchange.run(self.bot_stats))
+        )
+
+    async def close(self) -> None:
+        await super().close()
+        # Última publicación para que los demás tengan los históricos completos
+        try:
+            self.shard_exchange.publish(ShardStatsExchange.state_of(self.bot_stats))
+        except Exception as exc:
+            logger.error(f"Error publicando las estadísticas de shards: {exc}")
+
+
+def parse_shards(value: str) -> list[int]:
+    """Convierte "4-7" en [4, 5, 6, 7] y "3" en [3]"""
+    start, _, end = value.partition("-")
+    return list(range(int(start), int(end or start) + 1))
+
+
+def split_shards(shard_ids: Sequence[int], processes: int) -> list[list[int]]:
+    """Reparte los shards en rangos consecutivos, uno por
+    proceso, con como mucho un shard de diferencia entre ellos
+
+    Parameters
+    ----------
+    shard_ids : Sequence[int]
+        _description_
+    processes : int
+        _description_
+
+    Returns
+    -------
+    list[list[int]]
+        _description_
+    """
+    processes = min(processes, len(shard_ids))
+    size, remainder = divmod(len(shard_ids), processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < remainder else 0)
+        ranges.append(list(shard_ids[start:end]))
+        start = end
+    return ranges
+
+
+def run_shards(
+    shard_ids: Optional[list[int]], shard_count: Optional[int], index: int = 0
+) -> None:
+    """Arranca un cliente con los shards indicados.
+    Es el punto de entrada de cada proceso
+
+    Parameters
+    ----------
+    shard_ids : Optional[list[int]]
+        Shards de este proceso. None para que discord los elija todos
+    shard_count : Optional[int]
+        Total de shards entre todos los procesos
+    index : int, optional
+        Número del proceso. Desplaza el puerto de métricas
+    """
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+
+    settings.METRICS_PORT += index
+    process_name = f"shards-{shard_ids[0]}-{shard_ids[-1]}" if shard_ids else "shards"
+    client = ShardedDiscordClient(
+        intents=intents,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        process_name=process_name,
+    )
+    client.run(get_discord_key())
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        help="total de shards. Sin él discord decide y se usa un solo proceso",
+    )
+    parser.add_argument(
+        "--shards",
+        type=parse_shards,
+        help="rango de shards de esta máquina, por ejemplo 0-7 (todos por defecto)",
+    )
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.shard_count is None:
+        if args.shards is not None or args.processes > 1:
+            parser.error("--shards y --processes necesitan --shard-count")
+        run_shards(None, None)
+        return
+
+    shard_ids = args.shards or list(range(args.shard_count))
+    ranges = split_shards(shard_ids, args.processes)
+    if len(ranges) == 1:
+        run_shards(ranges[0], args.shard_count)
+        return
+
+    # spawn para que cada proceso arranque limpio, sin el event loop del padre
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(
+            target=run_shards,
+            args=(shard_range, args.shard_count, index),
+            name=f"shards-{shard_range[0]}-{shard_range[-1]}",
+        )
+        for index, shard_range in enumerate(ranges)
+    ]
+    for worker in workers:
+        worker.start()
+        logger.info(f"Proceso {worker.name} arrancado (pid {worker.pid})")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
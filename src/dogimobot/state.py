@@ -0,0 +1,1014 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Estado compartido entre varios procesos del bot.
+
+Sin backend cada proceso guarda en memoria sus buckets del rate
+limit, sus estadísticas y su memoria de conversaciones, así que
+con varias réplicas los límites son por proceso, las estadísticas
+se parten y las memorias divergen. Con un StateBackend compartido:
+    - los buckets del rate limit se comprueban y consumen de
+      forma atómica en el backend,
+    - los cambios de las estadísticas (el diario de BotStats)
+      se suman con incrementos atómicos,
+    - los mensajes de la memoria se guardan en el backend y las
+      conversaciones se recargan de él al construir el contexto.
+Lo que no hay que decidir en el momento (tokens cobrados a
+posteriori, estadísticas, mensajes y resúmenes) se acumula y se
+vuelca por lotes cada flush_interval segundos desde un hilo, así
+que los demás procesos lo ven con ese retraso. El propio proceso
+sí ve al momento sus mensajes y estadísticas pendientes.
+
+Implementaciones:
+    - InMemoryStateBackend: un solo proceso. Sirve de referencia
+      y para tests.
+    - SQLiteStateBackend: procesos de la misma máquina.
+    - RedisStateBackend: procesos en varias máquinas. Necesita el
+      paquete redis y un servidor con soporte de scripts Lua."""
+
+from abc import ABC, abstractmethod
+import asyncio
+from contextlib import contextmanager
+import json
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Iterator, Optional
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+from dogimobot.persistence import SCHEMA, entry_from_row, row_key
+from dogimobot.rate_limiting import TokenBucket
+from dogimobot.stats import BotStats
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - depende del entorno
+    redis = None
+
+ConversationKey = tuple[Optional[int], int]
+# Bucket del rate limit: (clave, capacidad, segundos en rellenarse, unidades)
+BucketSpec = tuple[str, float, float, float]
+# Campos enteros de las estadísticas (el resto son costes)
+INTEGER_FIELDS = {"total_tokens", "total_queries", "tokens", "queries"}
+
+STATE_SCHEMA = SCHEMA + """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    capacity REAL NOT NULL,
+    period REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+def flatten_state(state: dict[str, Any]) -> dict[str, float]:
+    """Convierte un estado como el de BotStats.empty_state
+    en contadores planos: total_tokens, user_stats/<usuario>/tokens...
+
+    Parameters
+    ----------
+    state : dict[str, Any]
+        _description_
+
+    Returns
+    -------
+    dict[str, float]
+        _description_
+    """
+    counters = {
+        name: state[name]
+        for name in ("total_tokens", "total_queries", "total_cost", "max_cost")
+    }
+    for group in ("user_stats", "model_stats", "budget_spend"):
+        for name, stats in state.get(group, {}).items():
+            for field, value in stats.items():
+                counters[f"{group}/{name}/{field}"] = value
+    return counters
+
+
+def unflatten_state(counters: dict[str, float]) -> dict[str, Any]:
+    """Inversa de flatten_state
+
+    Parameters
+    ----------
+    counters : dict[str, float]
+        _description_
+
+    Returns
+    -------
+    dict[str, Any]
+        _description_
+    """
+    state = BotStats.empty_state()
+    for counter, value in counters.items():
+        if "/" not in counter:
+            state[counter] = int(value) if counter in INTEGER_FIELDS else value
+            continue
+        group, rest = counter.split("/", 1)
+        # Los nombres de los modelos pueden llevar "/"
+        name, field = rest.rsplit("/", 1)
+        if group == "budget_spend":
+            # Gasto por periodo del presupuesto
+            state[group].setdefault(name, {})[field] = value
+            continue
+        stats = state[group].setdefault(name, {"tokens": 0, "cost": 0.0, "queries": 0})
+        stats[field] = int(value) if field in INTEGER_FIELDS else value
+    return state
+
+
+def _fold_deltas(deltas: list[dict[str, Any]]) -> dict[str, float]:
+    """Suma un lote de cambios del diario de BotStats en contadores"""
+    state = BotStats.empty_state()
+    for delta in deltas:
+        BotStats.apply_delta(state, delta)
+    return flatten_state(state)
+
+
+class PendingWrites:
+    """Escrituras acumuladas entre dos volcados"""
+
+    def __init__(self) -> None:
+        # Tokens cobrados: (bucket, instante)
+        self.charges: list[tuple[BucketSpec, float]] = []
+        # Cambios del diario de BotStats
+        self.deltas: list[dict[str, Any]] = []
+        self.messages: list[tuple[ConversationKey, dict[str, Any]]] = []
+        # (conversación, resumen, tokens, mensajes resumidos)
+        self.summaries: list[tuple[ConversationKey, str, int, list[dict[str, Any]]]] = (
+            []
+        )
+
+    def __len__(self) -> int:
+        return (
+            len(self.charges)
+            + len(self.deltas)
+            + len(self.messages)
+            + len(self.summaries)
+        )
+
+    def prepend(self, other: "PendingWrites") -> None:
+        """Devuelve a la cola un lote que no se ha podido escribir"""
+        self.charges[:0] = other.charges
+        self.deltas[:0] = other.deltas
+        self.messages[:0] = other.messages
+        self.summaries[:0] = other.summaries
+
+    def charged(self) -> dict[str, tuple[float, float, float, float]]:
+        """Tokens cobrados por bucket
+
+        Returns
+        -------
+        dict[str, tuple[float, float, float, float]]
+            Clave -> (capacidad, periodo, unidades, último instante)
+        """
+        totals: dict[str, tuple[float, float, float, float]] = {}
+        for (key, capacity, period, amount), now in self.charges:
+            previous = totals.get(key, (capacity, period, 0.0, now))[2]
+            totals[key] = (capacity, period, previous + amount, now)
+        return totals
+
+
+class StateBackend(ABC):
+    """Interfaz del estado compartido: buckets del rate limit,
+    contadores de las estadísticas y memoria de conversaciones.
+    Las escrituras se acumulan y se vuelcan por lotes con run
+    (en segundo plano) o flush.
+
+    Las subclases implementan acquire, _stats_counters,
+    _load_stored, conversation_version y _write. Hay dos locks
+    porque _write se ejecuta en otro hilo: _lock protege las
+    escrituras pendientes y solo se coge para operaciones en
+    memoria, así que el event loop nunca espera a una escritura;
+    _io_lock serializa el acceso al backend.
+    """
+
+    # Si otros procesos usan el mismo estado
+    shared: bool = True
+
+    def __init__(self, flush_interval: float = settings.STATE_FLUSH_INTERVAL) -> None:
+        """Inicializa el backend
+
+        Parameters
+        ----------
+        flush_interval : float, optional
+            Segundos entre volcados de las escrituras pendientes
+        """
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._io_lock = threading.RLock()
+        self._pending = PendingWrites()
+        # Lote que se está escribiendo en otro hilo
+        self._in_flight: Optional[PendingWrites] = None
+        # Estadísticas cuyos cambios se vuelcan en el backend
+        self.stats_source: Optional[BotStats] = None
+
+    @property
+    def pending(self) -> int:
+        """Número de escrituras pendientes de volcar"""
+        return len(self._pending)
+
+    # Rate limit
+    @abstractmethod
+    def acquire(self, buckets: list[BucketSpec], now: float) -> Optional[float]:
+        """Si todos los buckets tienen al menos una unidad consume
+        de cada uno sus unidades, todo de forma atómica
+
+        Parameters
+        ----------
+        buckets : list[BucketSpec]
+            Buckets a comprobar. Se crean llenos si no existen
+        now : float
+            Instante actual (time.time(), común a todos los procesos)
+
+        Returns
+        -------
+        Optional[float]
+            None si se admite o los segundos que hay que esperar
+        """
+
+    def charge(self, buckets: list[BucketSpec], now: float) -> None:
+        """Consume unidades sin comprobar el saldo, que puede
+        quedar en deuda. Se aplica en el próximo volcado"""
+        self._pending.charges.extend((bucket, now) for bucket in buckets)
+
+    # Estadísticas
+    def attach_stats(self, bot_stats: BotStats) -> None:
+        """Suma en el backend los cambios de bot_stats en cada volcado"""
+        bot_stats.enable_journal()
+        self.stats_source = bot_stats
+
+    @abstractmethod
+    def _stats_counters(self) -> dict[str, float]:
+        """Contadores guardados en el backend"""
+
+    def stats_state(self) -> dict[str, Any]:
+        """Totales de todos los procesos, incluidos los cambios
+        de este proceso que aún no se han volcado
+
+        Returns
+        -------
+        dict[str, Any]
+            Estado como el de BotStats.empty_state
+        """
+        # Con _io_lock cogido no hay un volcado a medias que
+        # pudiera contarse dos veces (en el backend y en _in_flight)
+        with self._io_lock:
+            state = unflatten_state(self._stats_counters())
+            with self._lock:
+                local = list(self._in_flight.deltas) if self._in_flight else []
+                local += self._pending.deltas
+                if self.stats_source is not None and self.stats_source.journal:
+                    local += self.stats_source.journal
+        for delta in local:
+            BotStats.apply_delta(state, delta)
+        return state
+
+    # Memoria
+    def enqueue(self, key: ConversationKey, entry: dict[str, Any]) -> None:
+        """Encola un mensaje para guardarlo en el próximo volcado.
+        El id (db_id) se le asigna al escribirlo"""
+        self._pending.messages.append((key, entry))
+
+    def save_summary(
+        self,
+        key: ConversationKey,
+        summary: str,
+        tokens: int,
+        entries: list[dict[str, Any]],
+    ) -> None:
+        """Encola el resumen de la conversación y los mensajes que incluye"""
+        self._pending.summaries.append((key, summary, tokens, entries))
+
+    @abstractmethod
+    def _load_stored(
+        self, key: ConversationKey, limit: int
+    ) -> tuple[list[dict[str, Any]], str, int, int]:
+        """Ventana reciente y resumen guardados en el backend
+
+        Returns
+        -------
+        tuple[list[dict[str, Any]], str, int, int]
+            Mensajes posteriores al resumen de más antiguo a más
+            reciente, resumen, tokens del resumen y id del último
+            mensaje resumido
+        """
+
+    def load(
+        self, key: ConversationKey, limit: int
+    ) -> tuple[list[dict[str, Any]], str, int]:
+        """Carga la ventana reciente de una conversación y su
+        resumen, con los mensajes y resúmenes de este proceso
+        que aún no se han volcado
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        limit : int
+            Número máximo de mensajes a cargar
+
+        Returns
+        -------
+        tuple[list[dict[str, Any]], str, int]
+            Mensajes de más antiguo a más reciente, resumen y tokens del resumen
+        """
+        with self._io_lock:
+            entries, summary, summary_tokens, _ = self._load_stored(key, limit)
+            with self._lock:
+                batches = [self._pending]
+                if self._in_flight is not None:
+                    batches.insert(0, self._in_flight)
+                local = [
+                    entry
+                    for batch in batches
+                    for message_key, entry in batch.messages
+                    if message_key == key
+                ]
+                summaries = [
+                    summary_data
+                    for batch in batches
+                    for summary_data in batch.summaries
+                    if summary_data[0] == key
+                ]
+        entries += local
+        if summaries:
+            # El último resumen local aún no está en el backend
+            _, summary, summary_tokens, summarized = summaries[-1]
+            last_id = max((entry.get("db_id", 0) for entry in summarized), default=0)
+            ids = {id(entry) for entry in summarized}
+            entries = [
+                entry
+                for entry in entries
+                if id(entry) not in ids and entry.get("db_id", last_id + 1) > last_id
+            ]
+        return entries[-limit:], summary, summary_tokens
+
+    @abstractmethod
+    def conversation_version(self, key: ConversationKey) -> tuple[int, int]:
+        """Versión de la conversación guardada en el backend.
+        Cambia cuando se escriben mensajes o resúmenes nuevos y
+        es mucho más barata de leer que la conversación
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+
+        Returns
+        -------
+        tuple[int, int]
+            Id del último mensaje guardado y del último resumido
+        """
+
+    # Volcado por lotes
+    def _take_pending(self) -> PendingWrites:
+        """Se lleva las escrituras pendientes y los cambios de las
+        estadísticas. Se llama desde el event loop"""
+        with self._lock:
+            if self.stats_source is not None:
+                self._pending.deltas.extend(self.stats_source.take_journal())
+            batch, self._pending = self._pending, PendingWrites()
+            self._in_flight = batch
+        return batch
+
+    @abstractmethod
+    def _write(self, batch: PendingWrites) -> None:
+        """Escribe un lote de forma atómica. Asigna db_id a los
+        mensajes escritos. Se llama con _io_lock cogido"""
+
+    def _flush_batch(self, batch: PendingWrites) -> int:
+        """Escribe un lote. Puede ejecutarse en otro hilo.
+        Durante la escritura solo se coge _io_lock, así que
+        el event loop puede seguir encolando"""
+        with self._io_lock:
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception:
+                # Devolvemos el lote a la cola para reintentarlo
+                # sin los ids de la transacción fallida
+                for _, entry in batch.messages:
+                    entry.pop("db_id", None)
+                with self._lock:
+                    self._pending.prepend(batch)
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight = None
+        return len(batch)
+
+    def flush(self) -> int:
+        """Escribe de forma síncrona todas las escrituras pendientes
+
+        Returns
+        -------
+        int
+            Número de escrituras volcadas
+        """
+        return self._flush_batch(self._take_pending())
+
+    async def run(self) -> None:
+        """Bucle en segundo plano que vuelca las escrituras
+        pendientes cada flush_interval segundos en un hilo"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self._flush_batch, self._take_pending())
+            except Exception as exc:
+                logger.error(f"Error volcando el estado compartido: {exc}")
+
+    def close(self) -> None:
+        """Vuelca lo pendiente"""
+        self.flush()
+
+
+class InMemoryStateBackend(StateBackend):
+    """Estado en memoria de un solo proceso"""
+
+    shared = False
+
+    def __init__(
+        self,
+        flush_interval: float = settings.STATE_FLUSH_INTERVAL,
+        max_stored_messages: int = settings.STATE_MAX_STORED_MESSAGES,
+    ) -> None:
+        super().__init__(flush_interval)
+        self.max_stored_messages = max_stored_messages
+        self.buckets: dict[str, TokenBucket] = {}
+        self.counters: dict[str, float] = {}
+        self.messages: dict[ConversationKey, list[dict[str, Any]]] = {}
+        # Conversación -> (resumen, tokens, id del último mensaje resumido)
+        self.summaries: dict[ConversationKey, tuple[str, int, int]] = {}
+        self._next_id: int = 1
+
+    def _bucket(
+        self, key: str, capacity: float, period: float, now: float
+    ) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(capacity, period, now)
+        return bucket
+
+    def acquire(self, buckets: list[BucketSpec], now: float) -> Optional[float]:
+        with self._io_lock:
+            found = [
+                (self._bucket(key, capacity, period, now), amount)
+                for key, capacity, period, amount in buckets
+            ]
+            blocked = [
+                bucket.retry_after(1)
+                for bucket, _ in found
+                if not bucket.available(1, now)
+            ]
+            if blocked:
+                return max(blocked)
+            for bucket, amount in found:
+                bucket.take(amount, now)
+        return None
+
+    def _stats_counters(self) -> dict[str, float]:
+        return dict(self.counters)
+
+    def _load_stored(
+        self, key: ConversationKey, limit: int
+    ) -> tuple[list[dict[str, Any]], str, int, int]:
+        summary, summary_tokens, last_id = self.summaries.get(key, ("", 0, 0))
+        entries = [
+            entry for entry in self.messages.get(key, []) if entry["db_id"] > last_id
+        ]
+        return entries[-limit:] if limit else [], summary, summary_tokens, last_id
+
+    def conversation_version(self, key: ConversationKey) -> tuple[int, int]:
+        with self._io_lock:
+            stored = self.messages.get(key)
+            last_id = self.summaries.get(key, ("", 0, 0))[2]
+            return (stored[-1]["db_id"] if stored else 0), last_id
+
+    def _write(self, batch: PendingWrites) -> None:
+        charged = batch.charged()
+        for bucket_key, (capacity, period, amount, now) in charged.items():
+            self._bucket(bucket_key, capacity, period, now).take(amount, now)
+        for name, value in _fold_deltas(batch.deltas).items():
+            if name == "max_cost":
+                self.counters[name] = max(self.counters.get(name, 0.0), value)
+            else:
+                self.counters[name] = self.counters.get(name, 0) + value
+        for key, entry in batch.messages:
+            entry["db_id"] = self._next_id
+            self._next_id += 1
+            stored = self.messages.setdefault(key, [])
+            stored.append(entry)
+            del stored[: -self.max_stored_messages]
+        for key, summary, tokens, entries in batch.summaries:
+            last_id = max((entry.get("db_id", 0) for entry in entries), default=0)
+            self.summaries[key] = (summary, tokens, last_id)
+        if charged:
+            # Los buckets que ya se han rellenado no guardan información
+            now = max(now for _, _, _, now in charged.values())
+            for bucket_key in [
+                bucket_key
+                for bucket_key, bucket in self.buckets.items()
+                if bucket.idle(now)
+            ]:
+                del self.buckets[bucket_key]
+
+
+class SQLiteStateBackend(StateBackend):
+    """Estado en una base de datos SQLite que pueden compartir
+    varios procesos de la misma máquina. Cada operación es una
+    transacción BEGIN IMMEDIATE, que bloquea la base de datos
+    para escribir desde el principio y la hace atómica también
+    entre procesos"""
+
+    def __init__(
+        self,
+        path: Path = settings.DATA_FOLDER / settings.STATE_DB_FILE,
+        flush_interval: float = settings.STATE_FLUSH_INTERVAL,
+    ) -> None:
+        """Abre (o crea) la base de datos
+
+        Parameters
+        ----------
+        path : Path, optional
+            Ruta del fichero de la base de datos
+        flush_interval : float, optional
+            Segundos entre volcados de las escrituras pendientes
+        """
+        super().__init__(flush_interval)
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Las transacciones se abren a mano (isolation_level=None)
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        with self._io_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(STATE_SCHEMA)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._io_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _buckets(
+        conn: sqlite3.Connection,
+        buckets: dict[str, tuple[float, float]],
+        now: float,
+    ) -> dict[str, TokenBucket]:
+        """Lee los buckets y crea llenos los que no existen
+
+        Parameters
+        ----------
+        buckets : dict[str, tuple[float, float]]
+            Clave -> (capacidad, periodo)
+        """
+        placeholders = ", ".join("?" * len(buckets))
+        rows = conn.execute(
+            f"SELECT key, tokens, updated FROM buckets WHERE key IN ({placeholders})",
+            list(buckets),
+        ).fetchall()
+        stored = {key: (tokens, updated) for key, tokens, updated in rows}
+        found = {}
+        for key, (capacity, period) in buckets.items():
+            bucket = TokenBucket(capacity, period, now)
+            if key in stored:
+                bucket.tokens, bucket.updated = stored[key]
+            found[key] = bucket
+        return found
+
+    @staticmethod
+    def _save_buckets(
+        conn: sqlite3.Connection,
+        buckets: dict[str, TokenBucket],
+        periods: dict[str, float],
+    ) -> None:
+        conn.executemany(
+            "INSERT OR REPLACE INTO buckets (key, tokens, updated, capacity, period) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (key, bucket.tokens, bucket.updated, bucket.capacity, periods[key])
+                for key, bucket in buckets.items()
+            ],
+        )
+
+    def acquire(self, buckets: list[BucketSpec], now: float) -> Optional[float]:
+        specs = {key: (capacity, period) for key, capacity, period, _ in buckets}
+        with self._transaction() as conn:
+            found = self._buckets(conn, specs, now)
+            blocked = [
+                bucket.retry_after(1)
+                for bucket in found.values()
+                if not bucket.available(1, now)
+            ]
+            if blocked:
+                return max(blocked)
+            for key, _, _, amount in buckets:
+                found[key].take(amount, now)
+            self._save_buckets(
+                conn, found, {key: period for key, (_, period) in specs.items()}
+            )
+        return None
+
+    def _stats_counters(self) -> dict[str, float]:
+        with self._io_lock:
+            rows = self._conn.execute("SELECT name, value FROM counters").fetchall()
+        return dict(rows)
+
+    def _load_stored(
+        self, key: ConversationKey, limit: int
+    ) -> tuple[list[dict[str, Any]], str, int, int]:
+        guild_id, channel_id = row_key(key)
+        with self._io_lock:
+            summary_row = self._conn.execute(
+                "SELECT summary, tokens, last_id FROM summaries "
+                "WHERE guild_id = ? AND channel_id = ?",
+                (guild_id, channel_id),
+            ).fetchone()
+            summary, summary_tokens, last_id = summary_row or ("", 0, 0)
+            rows = self._conn.execute(
+                "SELECT id, role, author, time, content, rendered, tokens "
+                "FROM messages WHERE guild_id = ? AND channel_id = ? AND id > ? "
+                "ORDER BY id DESC LIMIT ?",
+                (guild_id, channel_id, last_id, limit),
+            ).fetchall()
+        entries = [entry_from_row(*row) for row in reversed(rows)]
+        return entries, summary, summary_tokens, last_id
+
+    def conversation_version(self, key: ConversationKey) -> tuple[int, int]:
+        conversation = row_key(key)
+        with self._io_lock:
+            last_message, last_summarized = self._conn.execute(
+                "SELECT "
+                "(SELECT MAX(id) FROM messages WHERE guild_id = ? AND channel_id = ?), "
+                "(SELECT last_id FROM summaries WHERE guild_id = ? AND channel_id = ?)",
+                (*conversation, *conversation),
+            ).fetchone()
+        return last_message or 0, last_summarized or 0
+
+    def _write(self, batch: PendingWrites) -> None:
+        with self._transaction() as conn:
+            charged = batch.charged()
+            if charged:
+                now = max(now for _, _, _, now in charged.values())
+                found = self._buckets(
+                    conn,
+                    {
+                        bucket_key: (capacity, period)
+                        for bucket_key, (capacity, period, _, _) in charged.items()
+                    },
+                    now,
+                )
+                for bucket_key, (_, _, amount, charged_at) in charged.items():
+                    bucket = found[bucket_key]
+                    bucket.take(amount, max(charged_at, bucket.updated))
+                self._save_buckets(
+                    conn,
+                    found,
+                    {
+                        bucket_key: period
+                        for bucket_key, (_, period, _, _) in charged.items()
+                    },
+                )
+                # Los buckets que ya se han rellenado no guardan información
+                conn.execute(
+                    "DELETE FROM buckets "
+                    "WHERE tokens + (? - updated) * capacity / period >= capacity",
+                    (now,),
+                )
+            counters = _fold_deltas(batch.deltas) if batch.deltas else {}
+            max_cost = counters.pop("max_cost", None)
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                counters.items(),
+            )
+            if max_cost is not None:
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES ('max_cost', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (max_cost,),
+                )
+            for key, entry in batch.messages:
+                cursor = conn.execute(
+                    "INSERT INTO messages "
+                    "(guild_id, channel_id, role, author, time, content, rendered, tokens) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        *row_key(key),
+                        entry["role"],
+                        entry["author"],
+                        entry.get("time"),
+                        entry["content"],
+                        str(entry["param"]["content"]),
+                        entry["tokens"],
+                    ),
+                )
+                entry["db_id"] = cursor.lastrowid
+            conn.executemany(
+                "INSERT OR REPLACE INTO summaries "
+                "(guild_id, channel_id, summary, tokens, last_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        *row_key(key),
+                        summary,
+                        tokens,
+                        max((entry.get("db_id", 0) for entry in entries), default=0),
+                    )
+                    for key, summary, tokens, entries in batch.summaries
+                ],
+            )
+
+    def close(self) -> None:
+        """Vuelca lo pendiente y cierra la conexión"""
+        super().close()
+        with self._io_lock:
+            self._conn.close()
+
+
+# Scripts de redis. Usan la hora del servidor para que
+# todas las máquinas compartan el mismo reloj
+_REDIS_NOW = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+"""
+
+# KEYS: buckets. ARGV: capacidad, periodo y unidades de cada uno
+# y un último argumento "1" si hay que comprobar el saldo
+_REDIS_TAKE = _REDIS_NOW + """
+local check = ARGV[#ARGV] == '1'
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[3 * i - 2])
+    local rate = capacity / tonumber(ARGV[3 * i - 1])
+    local stored = redis.call('HMGET', key, 'tokens', 'updated')
+    local level = tonumber(stored[1]) or capacity
+    local updated = tonumber(stored[2]) or now
+    level = math.min(capacity, level + math.max(0, now - updated) * rate)
+    levels[i] = level
+    if check and level < 1 then
+        wait = math.max(wait, (1 - level) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[3 * i - 2])
+    local rate = capacity / tonumber(ARGV[3 * i - 1])
+    local level = levels[i] - tonumber(ARGV[3 * i])
+    redis.call('HSET', key, 'tokens', tostring(level), 'updated', tostring(now))
+    -- Cuando se rellena del todo ya no guarda información
+    redis.call('EXPIRE', key, math.ceil((capacity - level) / rate) + 1)
+end
+return false
+"""
+
+# KEYS: contadores. ARGV: campo y valor máximo
+_REDIS_MAX = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > current then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+# KEYS: mensajes de la conversación y secuencia de ids.
+# ARGV: mensaje en JSON y mensajes que se guardan como mucho
+_REDIS_APPEND = """
+local id = redis.call('INCR', KEYS[2])
+local entry = cjson.decode(ARGV[1])
+entry['db_id'] = id
+redis.call('RPUSH', KEYS[1], cjson.encode(entry))
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+return id
+"""
+
+
+class RedisStateBackend(StateBackend):
+    """Estado en un servidor redis (o compatible) que pueden
+    compartir procesos de varias máquinas. Las comprobaciones
+    del rate limit son scripts Lua, atómicos en el servidor, y
+    cada volcado es una transacción MULTI/EXEC"""
+
+    def __init__(
+        self,
+        url: str = settings.STATE_REDIS_URL,
+        prefix: str = settings.STATE_KEY_PREFIX,
+        flush_interval: float = settings.STATE_FLUSH_INTERVAL,
+        max_stored_messages: int = settings.STATE_MAX_STORED_MESSAGES,
+    ) -> None:
+        """Conecta con el servidor
+
+        Parameters
+        ----------
+        url : str, optional
+            URL de redis, por ejemplo redis://localhost:6379/0
+        prefix : str, optional
+            Prefijo de todas las claves
+        flush_interval : float, optional
+            Segundos entre volcados de las escrituras pendientes
+        max_stored_messages : int, optional
+            Mensajes que se guardan como mucho por conversación
+
+        Raises
+        ------
+        RuntimeError
+            Si el paquete redis no está instalado
+        """
+        if redis is None:
+            raise RuntimeError("RedisStateBackend necesita el paquete redis")
+        super().__init__(flush_interval)
+        self.prefix = prefix
+        self.max_stored_messages = max_stored_messages
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._take = self.client.register_script(_REDIS_TAKE)
+        self._max = self.client.register_script(_REDIS_MAX)
+        self._append = self.client.register_script(_REDIS_APPEND)
+
+    def _key(self, *parts: Any) -> str:
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    def _conversation_keys(self, key: ConversationKey) -> tuple[str, str]:
+        """Claves de los mensajes y del resumen de una conversación"""
+        guild_id, channel_id = row_key(key)
+        return (
+            self._key("memory", guild_id, channel_id),
+            self._key("summary", guild_id, channel_id),
+        )
+
+    @staticmethod
+    def _take_args(buckets: list[BucketSpec], check: bool) -> list[Any]:
+        args: list[Any] = []
+        for _, capacity, period, amount in buckets:
+            args += [capacity, period, amount]
+        return args + ["1" if check else "0"]
+
+    def acquire(self, buckets: list[BucketSpec], now: float) -> Optional[float]:
+        # El instante lo pone el servidor
+        wait = self._take(
+            keys=[self._key("bucket", key) for key, _, _, _ in buckets],
+            args=self._take_args(buckets, check=True),
+        )
+        return None if wait is None else float(wait)
+
+    def _stats_counters(self) -> dict[str, float]:
+        counters = self.client.hgetall(self._key("stats"))
+        return {name: float(value) for name, value in counters.items()}
+
+    def _load_stored(
+        self, key: ConversationKey, limit: int
+    ) -> tuple[list[dict[str, Any]], str, int, int]:
+        messages_key, summary_key = self._conversation_keys(key)
+        pipeline = self.client.pipeline()
+        pipeline.hgetall(summary_key)
+        pipeline.lrange(messages_key, -limit, -1)
+        stored_summary, rows = pipeline.execute() if limit else ({}, [])
+        last_id = int(stored_summary.get("last_id", 0))
+        entries = []
+        for row in rows:
+            data = json.loads(row)
+            if data["db_id"] > last_id:
+                entries.append(
+                    entry_from_row(
+                        data["db_id"],
+                        data["role"],
+                        data["author"],
+                        data["time"],
+                        data["content"],
+                        data["rendered"],
+                        data["tokens"],
+                    )
+                )
+        return (
+            entries,
+            stored_summary.get("summary", ""),
+            int(stored_summary.get("tokens", 0)),
+            last_id,
+        )
+
+    def conversation_version(self, key: ConversationKey) -> tuple[int, int]:
+        messages_key, summary_key = self._conversation_keys(key)
+        pipeline = self.client.pipeline()
+        pipeline.lindex(messages_key, -1)
+        pipeline.hget(summary_key, "last_id")
+        last_row, last_summarized = pipeline.execute()
+        return (
+            json.loads(last_row)["db_id"] if last_row else 0,
+            int(last_summarized or 0),
+        )
+
+    def _write(self, batch: PendingWrites) -> None:
+        pipeline = self.client.pipeline(transaction=True)
+        charged = batch.charged()
+        if charged:
+            buckets = [
+                (key, capacity, period, amount)
+                for key, (capacity, period, amount, _) in charged.items()
+            ]
+            self._take(
+                keys=[self._key("bucket", key) for key, _, _, _ in buckets],
+                args=self._take_args(buckets, check=False),
+                client=pipeline,
+            )
+        counters = _fold_deltas(batch.deltas) if batch.deltas else {}
+        max_cost = counters.pop("max_cost", None)
+        for name, value in counters.items():
+            if value:
+                pipeline.hincrbyfloat(self._key("stats"), name, value)
+        if max_cost is not None:
+            self._max(
+                keys=[self._key("stats")], args=["max_cost", max_cost], client=pipeline
+            )
+        for key, entry in batch.messages:
+            self._append(
+                keys=[self._conversation_keys(key)[0], self._key("memory", "ids")],
+                args=[
+                    json.dumps(
+                        {
+                            "role": entry["role"],
+                            "author": entry["author"],
+                            "time": entry.get("time"),
+                            "content": entry["content"],
+                            "rendered": str(entry["param"]["content"]),
+                            "tokens": entry["tokens"],
+                        }
+                    ),
+                    self.max_stored_messages,
+                ],
+                client=pipeline,
+            )
+        results = pipeline.execute()
+        # Los ids de los mensajes son los últimos resultados
+        ids = results[len(results) - len(batch.messages) :]
+        for (_, entry), db_id in zip(batch.messages, ids):
+            entry["db_id"] = int(db_id)
+        if batch.summaries:
+            # Los resúmenes van después porque necesitan los ids
+            pipeline = self.client.pipeline(transaction=True)
+            for key, summary, tokens, entries in batch.summaries:
+                pipeline.hset(
+                    self._conversation_keys(key)[1],
+                    mapping={
+                        "summary": summary,
+                        "tokens": tokens,
+                        "last_id": max(
+                            (entry.get("db_id", 0) for entry in entries), default=0
+                        ),
+                    },
+                )
+            pipeline.execute()
+
+
+def create_state_backend(kind: Optional[str]) -> Optional[StateBackend]:
+    """Crea el backend de estado indicado en settings.STATE_BACKEND
+
+    Parameters
+    ----------
+    kind : Optional[str]
+        None, "memory", "sqlite" o "redis"
+
+    Returns
+    -------
+    Optional[StateBackend]
+        None si cada proceso guarda su propio estado
+
+    Raises
+    ------
+    ValueError
+        Si el tipo de backend no existe
+    """
+    if kind is None:
+        return None
+    if kind == "memory":
+        return InMemoryStateBackend()
+    if kind == "sqlite":
+        return SQLiteStateBackend(settings.DATA_FOLDER / settings.STATE_DB_FILE)
+    if kind == "redis":
+        return RedisStateBackend(settings.STATE_REDIS_URL)
+    raise ValueError(f"Backend de estado desconocido: {kind}")
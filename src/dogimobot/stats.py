@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from collections import defaultdict
-from typing import Union
+from typing import Any, Optional, Union
 
 from discord import Message
 
@@ -31,10 +31,148 @@ class BotStats:
         self.total_cost = 0.0
         self.max_cost: float = 0.0
         self.total_tokens: int = 0
+        # Tokens de entrada (prompt) y de salida (completion) de la sesión
+        self.input_tokens: int = 0
+        self.output_tokens: int = 0
         # Estadísticas de usuario
         self.user_stats: defaultdict[str, dict[str, Union[int, float]]] = defaultdict(
             lambda: {"tokens": 0, "cost": 0.0, "queries": 0}
         )
+        # Estadísticas por modelo usado
+        self.model_stats: defaultdict[str, dict[str, Union[int, float]]] = defaultdict(
+            lambda: {"tokens": 0, "cost": 0.0, "queries": 0}
+        )
+        # Estadísticas por shard (solo en modo sharding y sin persistir,
+        # porque el reparto de guilds cambia con el número de shards)
+        self.shard_stats: defaultdict[int, dict[str, Union[int, float]]] = defaultdict(
+            lambda: {"tokens": 0, "cost": 0.0, "queries": 0}
+        )
+        # Gasto de los presupuestos: clave ("user:<nombre>", "guild:<id>")
+        # -> periodo ("2024-06-01" o "2024-06") -> dólares
+        self.budget_spend: defaultdict[str, dict[str, float]] = defaultdict(dict)
+        # Totales de sesiones anteriores (si se persisten las estadísticas)
+        self.historical: dict[str, Any] = BotStats.empty_state()
+        # Diario de cambios pendientes de persistir. None si no se persiste
+        self.journal: Optional[list[dict[str, Any]]] = None
+
+    @staticmethod
+    def empty_state() -> dict[str, Any]:
+        """Estado vacío de unas estadísticas acumuladas"""
+        return {
+            "total_tokens": 0,
+            "total_queries": 0,
+            "total_cost": 0.0,
+            "max_cost": 0.0,
+            "user_stats": {},
+            "model_stats": {},
+            "budget_spend": {},
+        }
+
+    @staticmethod
+    def apply_delta(state: dict[str, Any], delta: dict[str, Any]) -> None:
+        """Aplica sobre un estado acumulado un cambio del diario
+
+        Parameters
+        ----------
+        state : dict[str, Any]
+            Estado como el de empty_state
+        delta : dict[str, Any]
+            Cambio registrado por alguno de los métodos add_*
+        """
+        op = delta["op"]
+        if op == "tokens":
+            state["total_tokens"] += delta["tokens"]
+        elif op == "queries":
+            state["total_queries"] += 1
+        elif op == "cost":
+            state["total_cost"] += delta["cost"]
+            state["max_cost"] = max(state["max_cost"], delta["cost"])
+        elif op == "user":
+            user = state["user_stats"].setdefault(
+                delta["user"], {"tokens": 0, "cost": 0.0, "queries": 0}
+            )
+            user["tokens"] += delta["tokens"]
+            user["cost"] += delta["cost"]
+            user["queries"] += 1
+        elif op == "model":
+            model = state["model_stats"].setdefault(
+                delta["model"], {"tokens": 0, "cost": 0.0, "queries": 0}
+            )
+            model["tokens"] += delta["tokens"]
+            model["cost"] += delta["cost"]
+            model["queries"] += 1
+        elif op == "budget":
+            spend = state.setdefault("budget_spend", {}).setdefault(delta["key"], {})
+            for period in delta["periods"]:
+                spend[period] = spend.get(period, 0.0) + delta["cost"]
+
+    def _record(self, delta: dict[str, Any]) -> None:
+        """Apunta el cambio en el diario si se persisten las estadísticas"""
+        if self.journal is not None:
+            self.journal.append(delta)
+
+    def enable_journal(self) -> None:
+        """Empieza a registrar los cambios para poder persistirlos"""
+        if self.journal is None:
+            self.journal = []
+
+    def take_journal(self) -> list[dict[str, Any]]:
+        """Devuelve los cambios pendientes y vacía el diario"""
+        journal, self.journal = self.journal or [], []
+        return journal
+
+    @staticmethod
+    def merge_states(*states: dict[str, Any]) -> dict[str, Any]:
+        """Suma varios estados como el de empty_state,
+        por ejemplo los históricos y los de la sesión
+        o los de varios procesos con shards
+
+        Returns
+        -------
+        dict[str, Any]
+            _description_
+        """
+        merged = BotStats.empty_state()
+        for state in states:
+            merged["total_tokens"] += state["total_tokens"]
+            merged["total_queries"] += state["total_queries"]
+            merged["total_cost"] += state["total_cost"]
+            merged["max_cost"] = max(merged["max_cost"], state["max_cost"])
+            for key in ("user_stats", "model_stats"):
+                for name, stats in state.get(key, {}).items():
+                    total = merged[key].setdefault(
+                        name, {"tokens": 0, "cost": 0.0, "queries": 0}
+                    )
+                    for field, value in stats.items():
+                        total[field] += value
+            for key, periods in state.get("budget_spend", {}).items():
+                spend = merged["budget_spend"].setdefault(key, {})
+                for period, cost in periods.items():
+                    spend[period] = spend.get(period, 0.0) + cost
+        return merged
+
+    def session_state(self) -> dict[str, Any]:
+        """Devuelve las estadísticas de la sesión actual
+        con la forma de empty_state"""
+        return {
+            "total_tokens": self.total_tokens,
+            "total_queries": self.total_queries,
+            "total_cost": self.total_cost,
+            "max_cost": self.max_cost,
+            "user_stats": {
+                user: dict(stats) for user, stats in self.user_stats.items()
+            },
+            "model_stats": {
+                model: dict(stats) for model, stats in self.model_stats.items()
+            },
+            "budget_spend": {
+                key: dict(periods) for key, periods in self.budget_spend.items()
+            },
+        }
+
+    def alltime_state(self) -> dict[str, Any]:
+        """Devuelve los totales históricos incluyendo la sesión actual"""
+        return BotStats.merge_states(self.historical, self.session_state())
 
     def add_total_tokens(self, total_tokens: int) -> None:
         """Suma a total_tokens los tokens de la query
@@ -46,17 +184,35 @@ class BotStats:
             _description_
         """
         self.total_tokens += total_tokens
+        self._record({"op": "tokens", "tokens": total_tokens})
+
+    def add_direction_tokens(self, in_tokens: int, out_tokens: int) -> None:
+        """Suma a la sesión los tokens de entrada y de salida
+        por separado. No se persisten: solo son para las métricas
+
+        Parameters
+        ----------
+        in_tokens : int
+            Tokens del prompt
+        out_tokens : int
+            Tokens de la respuesta
+        """
+        self.input_tokens += in_tokens
+        self.output_tokens += out_tokens
 
     def add_total_queries(self) -> None:
         """Suma 1 al numero de queries totales
         a chatgpt
         """
         self.total_queries += 1
+        self._record({"op": "queries"})
 
-    def calculate_total_cost(self, in_tokens: int, out_tokens: int) -> float:
+    def calculate_total_cost(
+        self, in_tokens: int, out_tokens: int, model: Optional[str] = None
+    ) -> float:
         """Devuelve el coste total en función
         de los tokens in y out y el modelo
-        escogido
+        que ha respondido
 
         Parameters
         ----------
@@ -64,18 +220,17 @@ class BotStats:
             _description_
         out_tokens : int
             _description_
+        model : Optional[str], optional
+            Modelo usado en la petición. Por defecto settings.MODELO
 
         Returns
         -------
         float
             _description_
         """
-        in_cost: float = (in_tokens / 1e6) * settings.OPENAI_PRICING[settings.MODELO][
-            "in"
-        ]
-        out_cost: float = (out_tokens / 1e6) * settings.OPENAI_PRICING[settings.MODELO][
-            "out"
-        ]
+        pricing = settings.OPENAI_PRICING[model or settings.MODELO]
+        in_cost: float = (in_tokens / 1e6) * pricing["in"]
+        out_cost: float = (out_tokens / 1e6) * pricing["out"]
 
         return in_cost + out_cost
 
@@ -91,6 +246,7 @@ class BotStats:
 
         self.total_cost += total_cost
         self.max_cost = max(self.max_cost, total_cost)
+        self._record({"op": "cost", "cost": total_cost})
 
     def add_user_stats(
         self, message: Message, total_tokens: int, total_cost: float
@@ -102,3 +258,92 @@ class BotStats:
         self.user_stats[message.author.name]["tokens"] += total_tokens
         self.user_stats[message.author.name]["cost"] += total_cost
         self.user_stats[message.author.name]["queries"] += 1
+        self._record(
+            {
+                "op": "user",
+                "user": message.author.name,
+                "tokens": total_tokens,
+                "cost": total_cost,
+            }
+        )
+
+    def add_model_stats(self, model: str, total_tokens: int, total_cost: float) -> None:
+        """Alimenta las estadísticas del modelo que
+        ha respondido la petición
+
+        Parameters
+        ----------
+        model : str
+            _description_
+        total_tokens : int
+            _description_
+        total_cost : float
+            _description_
+        """
+        self.model_stats[model]["tokens"] += total_tokens
+        self.model_stats[model]["cost"] += total_cost
+        self.model_stats[model]["queries"] += 1
+        self._record(
+            {
+                "op": "model",
+                "model": model,
+                "tokens": total_tokens,
+                "cost": total_cost,
+            }
+        )
+
+    def add_shard_stats(
+        self, shard_id: int, total_tokens: int, total_cost: float
+    ) -> None:
+        """Alimenta las estadísticas del shard por el que
+        llegó la petición
+
+        Parameters
+        ----------
+        shard_id : int
+            _description_
+        total_tokens : int
+            _description_
+        total_cost : float
+            _description_
+        """
+        self.shard_stats[shard_id]["tokens"] += total_tokens
+        self.shard_stats[shard_id]["cost"] += total_cost
+        self.shard_stats[shard_id]["queries"] += 1
+
+    def add_budget_spend(self, key: str, periods: list[str], cost: float) -> None:
+        """Apunta el gasto de un presupuesto para que se
+        persista junto al resto de estadísticas
+
+        Parameters
+        ----------
+        key : str
+            Clave del presupuesto ("user:<nombre>" o "guild:<id>")
+        periods : list[str]
+            Periodos en curso a los que se suma el gasto
+        cost : float
+            _description_
+        """
+        spend = self.budget_spend[key]
+        for period in periods:
+            spend[period] = spend.get(period, 0.0) + cost
+        self._record({"op": "budget", "key": key, "periods": periods, "cost": cost})
+
+    def prune_budget_spend(self, periods: set[str]) -> None:
+        """Olvida el gasto de los periodos de presupuesto
+        que ya han terminado, en la sesión y en los históricos
+
+        Parameters
+        ----------
+        periods : set[str]
+            Periodos en curso, los únicos que se conservan
+        """
+        for spend in (self.budget_spend, self.historical.get("budget_spend", {})):
+            for key in list(spend):
+                spend[key] = {
+                    period: cost
+                    for period, cost in spend[key].items()
+                    if period in periods
+                }
+                if not spend[key]:
+                    del spend[key]
@@ -0,0 +1,163 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compactación de conversaciones en segundo plano.
+Cuando el historial de una conversación supera
+SUMMARY_TRIGGER_TOKENS, los mensajes más antiguos se resumen
+con openAI en un resumen acumulado que se envía como un único
+mensaje de contexto."""
+
+import asyncio
+from typing import Optional
+
+from openai import AsyncOpenAI
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_system_message_param import (
+    ChatCompletionSystemMessageParam,
+)
+from openai.types.chat.chat_completion_user_message_param import (
+    ChatCompletionUserMessageParam,
+)
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+from dogimobot.memory import ConversationKey, ConversationStore
+from dogimobot.stats import BotStats
+from dogimobot.tokens import count_message_tokens
+
+
+def summary_message(summary: str) -> ChatCompletionSystemMessageParam:
+    """Mensaje de contexto con el resumen de la conversación"""
+    return ChatCompletionSystemMessageParam(
+        role="system",
+        content=f"Resumen de la conversación anterior: {summary}",
+    )
+
+
+class ConversationSummarizer:
+    """Resume en segundo plano la parte más antigua
+    de las conversaciones que superan el umbral de tokens
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        client_openai: AsyncOpenAI,
+        bot_stats: BotStats,
+        trigger_tokens: int = settings.SUMMARY_TRIGGER_TOKENS,
+        keep_messages: int = settings.SUMMARY_KEEP_MESSAGES,
+    ) -> None:
+        self.store = store
+        self.client_openai = client_openai
+        self.bot_stats = bot_stats
+        self.trigger_tokens = trigger_tokens
+        self.keep_messages = keep_messages
+        # Guardamos referencias a las tareas para que no las recoja el GC
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def maybe_schedule(self, key: ConversationKey) -> Optional[asyncio.Task[None]]:
+        """Lanza el resumen de la conversación en segundo plano
+        si supera el umbral de tokens o tiene la ventana llena
+        y no se está resumiendo ya
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+
+        Returns
+        -------
+        Optional[asyncio.Task[None]]
+            La tarea lanzada o None si no hace falta resumir
+        """
+        conversation = self.store.peek(key)
+        if not settings.SUMMARY_ENABLED or conversation is None:
+            return None
+        if conversation.summarizing or len(conversation) <= self.keep_messages:
+            return None
+        # Se resume al pasar el umbral de tokens o con la ventana llena,
+        # antes de que los mensajes más antiguos se pierdan
+        window_full = len(conversation) == conversation.messages.maxlen
+        if conversation.tokens < self.trigger_tokens and not window_full:
+            return None
+
+        conversation.summarizing = True
+        task = asyncio.create_task(self.summarize(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def summarize(self, key: ConversationKey) -> None:
+        """Resume los mensajes más antiguos de la conversación
+        dejando fuera los keep_messages más recientes
+
+        Parameters
+        ----------
+        key : ConversationKey
+            _description_
+        """
+        conversation = self.store.peek(key)
+        if conversation is None:
+            return
+        entries = list(conversation.messages)[: -self.keep_messages]
+        try:
+            if not entries:
+                return
+            transcript = "\n".join(str(entry["param"]["content"]) for entry in entries)
+            if conversation.summary:
+                transcript = f"Resumen anterior: {conversation.summary}\n{transcript}"
+
+            response: ChatCompletion = await self.client_openai.chat.completions.create(
+                model=settings.SUMMARY_MODEL,
+                max_tokens=settings.SUMMARY_MAX_TOKENS,
+                messages=[
+                    ChatCompletionSystemMessageParam(
+                        role="system", content=settings.SUMMARY_PROMPT
+                    ),
+                    ChatCompletionUserMessageParam(role="user", content=transcript),
+                ],
+            )
+            content = response.choices[0].message.content if response.choices else None
+            if not content:
+                return
+
+            summary = content.strip()
+            removed = self.store.fold(
+                key,
+                entries,
+                summary,
+                count_message_tokens(summary, settings.SUMMARY_MODEL),
+            )
+
+            # El resumen también cuesta dinero
+            if response.usage is not None:
+                in_tokens = int(response.usage.prompt_tokens)
+                out_tokens = int(response.usage.completion_tokens)
+                cost = self.bot_stats.calculate_total_cost(
+                    in_tokens, out_tokens, settings.SUMMARY_MODEL
+                )
+                self.bot_stats.add_total_tokens(in_tokens + out_tokens)
+                self.bot_stats.add_direction_tokens(in_tokens, out_tokens)
+                self.bot_stats.add_total_and_max_cost(cost)
+                self.bot_stats.add_model_stats(
+                    settings.SUMMARY_MODEL, in_tokens + out_tokens, cost
+                )
+            logger.info(
+                f"Conversación {key} resumida: {removed} mensajes "
+                f"sustituidos por un resumen"
+            )
+        except Exception as exc:
+            logger.error(f"No se pudo resumir la conversación {key}: {exc}")
+        finally:
+            conversation.summarizing = False
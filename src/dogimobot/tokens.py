@@ -0,0 +1,129 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conteo local de tokens para construir el contexto
+sin pasarse del presupuesto del modelo.
+Si tiktoken está instalado y dispone de la codificación
+se usa para contar de forma exacta; si no, se hace una
+estimación por número de caracteres."""
+
+from functools import lru_cache
+import math
+from typing import Any, Optional
+
+from dogimobot import settings
+from dogimobot.logging_config import logger
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - depende del entorno
+    tiktoken = None
+
+# Tokens extra que añade openai por cada mensaje (role, separadores...)
+TOKENS_PER_MESSAGE = 4
+# Estimación de caracteres por token cuando no hay tokenizador
+CHARS_PER_TOKEN = 4
+
+# Para avisar una sola vez de que se está estimando
+_fallback_warned = False
+
+
+def _warn_fallback(reason: str) -> None:
+    """Avisa en el log, solo la primera vez, de que
+    los tokens se estiman por número de caracteres"""
+    global _fallback_warned
+    if _fallback_warned:
+        return
+    _fallback_warned = True
+    logger.warning(
+        f"Conteo de tokens estimado ({CHARS_PER_TOKEN} caracteres por token): {reason}"
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str) -> Optional[Any]:
+    """Devuelve la codificación de tiktoken del modelo
+    o None si no se puede cargar (sin tiktoken o sin red
+    para descargar la codificación)"""
+    if tiktoken is None:
+        _warn_fallback("tiktoken no está instalado")
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _warn_fallback(f"no se pudo cargar la codificación de {model}: {e}")
+            return None
+    except Exception as e:
+        _warn_fallback(f"no se pudo cargar la codificación de {model}: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = settings.MODELO) -> int:
+    """Cuenta los tokens de un texto para el modelo dado
+
+    Parameters
+    ----------
+    text : str
+        _description_
+    model : str, optional
+        Modelo de openAI cuyo tokenizador se usa
+
+    Returns
+    -------
+    int
+        Número de tokens
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(content: str, model: str = settings.MODELO) -> int:
+    """Cuenta los tokens de un mensaje del chat
+    incluyendo la sobrecarga fija por mensaje
+
+    Parameters
+    ----------
+    content : str
+        Contenido del mensaje
+    model : str, optional
+        _description_
+
+    Returns
+    -------
+    int
+        _description_
+    """
+    return count_tokens(content, model) + TOKENS_PER_MESSAGE
+
+
+def get_context_budget(model: str) -> int:
+    """Devuelve el presupuesto de tokens de contexto
+    configurado para el modelo
+
+    Parameters
+    ----------
+    model : str
+        _description_
+
+    Returns
+    -------
+    int
+        _description_
+    """
+    return settings.OPENAI_CONTEXT_BUDGET.get(model, settings.DEFAULT_CONTEXT_BUDGET)
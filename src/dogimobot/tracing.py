@@ -0,0 +1,178 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trazas de latencia por etapa del pipeline de on_message.
+Cada etapa se mide con tracer.span y sus tiempos se guardan
+en una ventana deslizante para calcular p50, p95 y p99.
+Una fracción de las peticiones (TRACE_SAMPLE_RATE) se traza
+entera y se vuelca al log."""
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+import time
+from typing import Any, Callable, Deque, Iterator, Optional
+
+from dogimobot import settings
+
+# Etapas de la petición que se está trazando en la tarea actual
+_current_trace: ContextVar[Optional[list[tuple[str, float]]]] = ContextVar(
+    "current_trace", default=None
+)
+
+
+class LatencyHistogram:
+    """Últimas duraciones de una etapa"""
+
+    def __init__(self, window: int) -> None:
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.count: int = 0
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, *quantiles: float) -> list[float]:
+        """Percentiles por rango más cercano de la ventana
+
+        Parameters
+        ----------
+        quantiles : float
+            Cuantiles entre 0 y 1
+
+        Returns
+        -------
+        list[float]
+            Un valor en segundos por cuantil. 0 si no hay muestras
+        """
+        if not self.samples:
+            return [0.0 for _ in quantiles]
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return [ordered[min(last, int(q * len(ordered)))] for q in quantiles]
+
+
+class Tracer:
+    """Mide la duración de cada etapa y guarda las trazas muestreadas"""
+
+    def __init__(
+        self,
+        window: int = settings.TRACE_WINDOW,
+        sample_rate: float = settings.TRACE_SAMPLE_RATE,
+    ) -> None:
+        """Inicializa el tracer
+
+        Parameters
+        ----------
+        window : int, optional
+            Duraciones que se guardan por etapa
+        sample_rate : float, optional
+            Fracción de peticiones que se trazan enteras en el log
+        """
+        self.window = window
+        self.sample_rate = sample_rate
+        self.stages: dict[str, LatencyHistogram] = {}
+        # Funciones a las que se pasa cada duración (p. ej. las métricas)
+        self.listeners: list[Callable[[str, float], None]] = []
+
+    def record(self, name: str, seconds: float) -> None:
+        """Apunta la duración de una etapa
+
+        Parameters
+        ----------
+        name : str
+            _description_
+        seconds : float
+            _description_
+        """
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = LatencyHistogram(self.window)
+        histogram.add(seconds)
+        for listener in self.listeners:
+            listener(name, seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append((name, seconds))
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Mide lo que se ejecuta dentro del with,
+        incluidos los await
+
+        Parameters
+        ----------
+        name : str
+            Nombre de la etapa
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def start_trace(self) -> bool:
+        """Decide si se traza entera la petición de la tarea actual
+
+        Returns
+        -------
+        bool
+            True si la petición se ha muestreado
+        """
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        _current_trace.set([] if sampled else None)
+        return sampled
+
+    @staticmethod
+    def is_tracing() -> bool:
+        """Indica si la petición de la tarea actual se está trazando"""
+        return _current_trace.get() is not None
+
+    @staticmethod
+    def finish_trace() -> Optional[str]:
+        """Termina la traza de la tarea actual
+
+        Returns
+        -------
+        Optional[str]
+            Las etapas con su duración o None si no se trazaba
+        """
+        trace = _current_trace.get()
+        _current_trace.set(None)
+        if trace is None:
+            return None
+        return " | ".join(f"{name}: {seconds * 1000:.1f} ms" for name, seconds in trace)
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        """p50, p95 y p99 en milisegundos de cada etapa
+
+        Returns
+        -------
+        dict[str, dict[str, Any]]
+            _description_
+        """
+        summary: dict[str, dict[str, Any]] = {}
+        for name, histogram in self.stages.items():
+            p50, p95, p99 = histogram.percentiles(0.5, 0.95, 0.99)
+            summary[name] = {
+                "count": histogram.count,
+                "p50": p50 * 1000,
+                "p95": p95 * 1000,
+                "p99": p99 * 1000,
+            }
+        return summary
+
+
+tracer = Tracer()
@@ -12,22 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from importlib.metadata import PackageNotFoundError, version
 import os
-from typing import Any
 
 from dotenv import load_dotenv
-import toml
+
+from dogimobot._version import __version__
 
 load_dotenv()
 
 
 def get_project_version() -> str:
-    """Devuelve la versión del proyecto
-    extraido del pyproject.toml"""
-    with open("pyproject.toml", "r") as file:
-        data: dict[str, Any] = toml.load(file)
-        version: str = data["tool"]["poetry"]["version"]
-    return version
+    """Devuelve la versión del proyecto.
+    Usa los metadatos del paquete instalado y si no
+    los hay la versión fijada en _version.py.
+    No lee ningún fichero del directorio de trabajo.
+
+    Returns
+    -------
+    str
+        _description_
+    """
+    try:
+        return version("dogimobot")
+    except PackageNotFoundError:
+        return __version__
+
+
+# Se resuelve una sola vez al importar
+PROJECT_VERSION: str = get_project_version()
 
 
 def get_openai_key() -> str:
@@ -16,19 +16,24 @@ from collections import deque, defaultdict
 from datetime import datetime
 import time
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
 import discord
 from discord import Message
 
 from dogimobot.main import DiscordClient
+from dogimobot.memory import ConversationStore
 from dogimobot.stats import BotStats
 from dogimobot.rate_limiting import RateLimiter
 
 # Mock settings to use in tests
 class MockSettings:
     MEMORY_SIZE = 10
+    MEMORY_MAX_MESSAGES = 100
+    PERSIST_MEMORY = False
+    PERSIST_STATS = False
+    RESPONSE_CACHE_ENABLED = False
     MODELO = "gpt-3.5-turbo"
     CHAT_COMMAND = "!chat"
     INFO_COMMAND = "!info"
@@ -37,6 +42,25 @@ class MockSettings:
     DEFAULT_ERR_ANSWER = "Sorry, something went wrong."
     BOT_NAME = "Dogimo"
     USERS = {"testuser": "Test User"}
+    STREAM_REPLIES = False
+    ADMIN_USERS = {"admin"}
+    COALESCE_ENABLED = False
+    METRICS_ENABLED = False
+    OPENAI_BASE_URL = None
+    RECORD_TRAFFIC = False
+    STATE_BACKEND = None
+    COALESCE_PROMPT = "Responde a cada uno."
+    MAX_MSG_PER_MINUTES = 5
+    FALLBACK_ANSWER = "openAI no responde."
+    ROUTING_BUDGET = None
+    ROUTING_EXPECTED_OUT_TOKENS = 500
+    BUDGET_EXCEEDED_ANSWER = "Presupuesto {budget} agotado."
+    RATE_LIMIT = 60
+    STREAM_PLACEHOLDER = "..."
+    STREAM_EDIT_INTERVAL = 1.0
+    STREAM_EDIT_TOKENS = 40
+    STREAM_MIN_EDIT_INTERVAL = 0.5
+    DISCORD_MAX_MESSAGE_LENGTH = 2000
     OPENAI_PRICING = {
         "gpt-3.5-turbo": {
             "in": 0.0001,
@@ -55,7 +79,7 @@ def mock_message():
 
 @pytest.fixture
 def reset_rate_limiter():
-    RateLimiter.track = defaultdict(lambda: {"num_peticiones": 0, "start": datetime.now()})
+    RateLimiter.reset()
 
 @pytest.fixture
 def bot_stats(scope="session"):
@@ -63,12 +87,15 @@ def bot_stats(scope="session"):
 
 @pytest.fixture(scope="session")
 def mock_settings():
-    with patch("dogimobot.main.settings", new=MockSettings):
+    # stats and routing read prices from the real settings
+    with patch("dogimobot.main.settings", new=MockSettings), patch.dict(
+        "dogimobot.settings.OPENAI_PRICING", MockSettings.OPENAI_PRICING
+    ):
         yield
 
 @pytest.fixture(scope="session")
 def mock_openai():
-    with patch("dogimobot.main.OpenAI", new=AsyncMock) as mock:
+    with patch("dogimobot.main.AsyncOpenAI", new=AsyncMock) as mock:
         yield mock
 
 @pytest.fixture()
@@ -77,9 +104,9 @@ def client(mock_settings, mock_openai):
     intents.message_content = True
     intents.members = True
     client = DiscordClient(intents=intents)
-    client.client_openai = AsyncMock(spec=OpenAI)
+    client.client_openai = AsyncMock(spec=AsyncOpenAI)
     client.session_id = "test_session_id"
-    client.memory = deque(maxlen=MockSettings.MEMORY_SIZE)
+    client.memory = ConversationStore(window_size=MockSettings.MEMORY_SIZE, max_messages=MockSettings.MEMORY_MAX_MESSAGES)
     client.model = MockSettings.MODELO
     client.session_start = time.perf_counter()
     return client
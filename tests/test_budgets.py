@@ -0,0 +1,102 @@
+from datetime import date
+
+import pytest
+
+from dogimobot.budgets import BudgetTracker
+from dogimobot.stats import BotStats
+
+
+class FakeClock:
+    def __init__(self, day: date):
+        self.day = day
+
+    def __call__(self) -> date:
+        return self.day
+
+
+def _tracker(clock=None, overrides=None) -> BudgetTracker:
+    return BudgetTracker(
+        user_limits={"daily": 1.0, "monthly": 10.0},
+        guild_limits={"daily": 5.0, "monthly": None},
+        overrides=overrides or {},
+        today=clock or FakeClock(date(2024, 6, 1)),
+    )
+
+
+def test_check_and_charge():
+    tracker = _tracker()
+    assert tracker.check("ana", 1, 0.5) is None
+    tracker.charge("ana", 1, 0.8)
+    assert tracker.check("ana", 1, 0.5) == "diario del usuario"
+    assert tracker.rejections == 1
+    # Otro usuario del mismo servidor no se ve afectado
+    assert tracker.check("luis", 1, 0.5) is None
+
+def test_guild_budget():
+    tracker = _tracker()
+    for user in ["a", "b", "c", "d", "e"]:
+        tracker.charge(user, 1, 0.99)
+    assert tracker.check("f", 1, 0.1) == "diario del servidor"
+    # Los mensajes directos no tienen servidor
+    assert tracker.check("f", None, 0.1) is None
+
+def test_daily_and_monthly_reset():
+    clock = FakeClock(date(2024, 6, 1))
+    tracker = _tracker(clock)
+    tracker.charge("ana", 1, 1.0)
+    assert tracker.check("ana", 1, 0.1) is not None
+    clock.day = date(2024, 6, 2)
+    assert tracker.check("ana", 1, 0.1) is None
+    assert tracker.status("ana", 1)["user"]["monthly"] == (1.0, 10.0)
+    clock.day = date(2024, 7, 1)
+    assert tracker.status("ana", 1)["user"]["monthly"] == (0.0, 10.0)
+
+def test_overrides_and_remaining():
+    tracker = _tracker(overrides={"user:vip": {"daily": None, "monthly": 100.0}})
+    tracker.charge("vip", 1, 3.0)
+    # El límite del servidor es el más restrictivo
+    assert tracker.remaining("vip", 1) == 2.0
+    assert tracker.check("vip", 1, 1.5) is None
+    assert tracker.remaining("ana", None) == 1.0
+
+def test_no_limits():
+    tracker = BudgetTracker(
+        user_limits={"daily": None, "monthly": None},
+        guild_limits={"daily": None, "monthly": None},
+        overrides={},
+    )
+    tracker.charge("ana", 1, 1000.0)
+    assert tracker.check("ana", 1, 1000.0) is None
+    assert tracker.remaining("ana", 1) is None
+
+def test_check_reserves_until_charged():
+    tracker = _tracker()
+    # Dos peticiones en vuelo no pueden pasarse juntas del límite
+    assert tracker.check("ana", 1, 0.6) is None
+    assert tracker.check("ana", 1, 0.6) == "diario del usuario"
+    assert tracker.remaining("ana", 1) == pytest.approx(0.4)
+    # El coste real sustituye a la reserva
+    tracker.charge("ana", 1, 0.1, reserved=0.6)
+    assert tracker.check("ana", 1, 0.6) is None
+    # Una petición que falla libera su reserva
+    tracker.release("ana", 1, 0.6)
+    assert tracker.remaining("ana", 1) == pytest.approx(0.9)
+
+def test_spend_survives_restart_and_prunes_old_periods():
+    clock = FakeClock(date(2024, 6, 1))
+    bot_stats = BotStats()
+    tracker = _tracker(clock)
+    tracker.bot_stats = bot_stats
+    tracker.charge("ana", 1, 0.8)
+
+    # Nuevo proceso con las estadísticas guardadas
+    restarted = _tracker(clock)
+    restarted.restore(bot_stats.alltime_state())
+    assert restarted.check("ana", 1, 0.5) == "diario del usuario"
+    assert restarted.status("ana", 1)["guild"]["daily"] == (0.8, 5.0)
+
+    # Al cambiar de mes se olvida el gasto de los periodos terminados
+    clock.day = date(2024, 7, 1)
+    tracker.check("luis", 1, 0.1)
+    assert "user:ana" not in tracker.spend
+    assert "user:ana" not in bot_stats.budget_spend
@@ -0,0 +1,53 @@
+from unittest.mock import patch
+
+from dogimobot.cache import ResponseCache
+
+
+def test_normalize():
+    assert ResponseCache.normalize("  ¿Qué  es la REGULARIZACIÓN L2? ") == "que es la regularizacion l2"
+
+def test_make_key_ignores_formatting():
+    key1 = ResponseCache.make_key("¿Diferencia entre L1 y L2?", "gpt-4", "ctx")
+    key2 = ResponseCache.make_key("diferencia entre l1 y l2", "gpt-4", "ctx")
+    assert key1 == key2
+    assert key1 != ResponseCache.make_key("diferencia entre l1 y l2", "gpt-3.5-turbo", "ctx")
+    assert key1 != ResponseCache.make_key("diferencia entre l1 y l2", "gpt-4", "otro")
+
+def test_is_cacheable():
+    assert not ResponseCache.is_cacheable("¿y eso?")
+    assert ResponseCache.is_cacheable("¿Qué diferencia hay entre L1 y L2?")
+
+def test_get_put_and_hit_rate():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    assert cache.get("a") is None
+    cache.put("a", "respuesta")
+    assert cache.get("a") == "respuesta"
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_rate == 0.5
+
+def test_ttl_expiration():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    with patch("dogimobot.cache.time.monotonic", return_value=0.0):
+        cache.put("a", "respuesta")
+    with patch("dogimobot.cache.time.monotonic", return_value=61.0):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+def test_get_allow_stale():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    with patch("dogimobot.cache.time.monotonic", return_value=0.0):
+        cache.put("a", "respuesta")
+    with patch("dogimobot.cache.time.monotonic", return_value=61.0):
+        assert cache.get("a", allow_stale=True) == "respuesta"
+        assert cache.get("a") is None
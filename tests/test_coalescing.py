@@ -0,0 +1,75 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from dogimobot import settings
+from dogimobot.coalescing import ChatCoalescer
+
+
+def _message(user: str, channel: int) -> MagicMock:
+    message = MagicMock()
+    message.author.name = user
+    message.guild.id = 1
+    message.channel.id = channel
+    return message
+
+
+@pytest.mark.asyncio
+async def test_messages_within_window_are_batched():
+    batches: list[list] = []
+
+    async def handler(batch):
+        batches.append(batch)
+
+    coalescer = ChatCoalescer(handler, window=0.05, max_messages=10)
+    first, second = _message("a", 1), _message("b", 1)
+    other = _message("c", 2)
+    coalescer.submit(first)
+    coalescer.submit(second)
+    coalescer.submit(other)
+    assert batches == []
+    await asyncio.sleep(0.1)
+    assert [first, second] in batches
+    assert [other] in batches
+    assert coalescer.batches == 1
+    assert coalescer.coalesced_messages == 2
+
+@pytest.mark.asyncio
+async def test_full_batch_is_flushed_without_waiting():
+    batches: list[list] = []
+
+    async def handler(batch):
+        batches.append(batch)
+
+    coalescer = ChatCoalescer(handler, window=10, max_messages=2)
+    coalescer.submit(_message("a", 1))
+    coalescer.submit(_message("b", 1))
+    await asyncio.sleep(0)
+    assert len(batches) == 1
+    assert len(batches[0]) == 2
+
+@pytest.mark.asyncio
+async def test_close_flushes_pending():
+    batches: list[list] = []
+
+    async def handler(batch):
+        batches.append(batch)
+
+    coalescer = ChatCoalescer(handler, window=10, max_messages=5)
+    coalescer.submit(_message("a", 1))
+    await coalescer.close()
+    assert len(batches) == 1
+
+@pytest.mark.asyncio
+async def test_handler_error_notifies_channel():
+    async def handler(batch):
+        raise RuntimeError("boom")
+
+    coalescer = ChatCoalescer(handler, window=0.01, max_messages=10)
+    message = _message("a", 1)
+    message.channel.send = AsyncMock()
+    coalescer.submit(message)
+    await asyncio.sleep(0.05)
+    message.channel.send.assert_awaited_once_with(settings.FALLBACK_ANSWER)
+    assert not coalescer._tasks
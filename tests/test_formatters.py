@@ -1,8 +1,11 @@
+import os
+
 import pytest
 from pathlib import Path
 from string import Template
 from unittest.mock import patch
-from dogimobot.formatters import format_stats, format_help
+from dogimobot import settings
+from dogimobot.formatters import TemplateRegistry, format_stats, format_help, split_message, templates
 from dogimobot.exceptions import FormatterException
 
 # Simular USERS para los tests
@@ -12,6 +15,12 @@ USERS = {
     "user3": "User Three",
 }
 
+@pytest.fixture(autouse=True)
+def clear_templates():
+    templates.clear()
+    yield
+    templates.clear()
+
 @pytest.fixture
 def sample_template():
     return Path("sample_template.md")
@@ -160,3 +169,117 @@ def test_format_help_raises_exception(sample_help_template):
             help_command="!help"
         )
 
+
+def test_format_stats_shard_stats(sample_template):
+    kwargs = dict(
+        template=sample_template,
+        session_id="12345",
+        version="0.1.0",
+        model="gpt-4",
+        elapsed_days=0,
+        elapsed_hours=0,
+        elapsed_minutes=0,
+        elapsed_seconds=0,
+        total_tokens=0,
+        total_queries=0,
+        total_cost=0.0,
+        user_stats={},
+        max_cost=0.0,
+        session_start_time="2023-01-01 00:00:00",
+    )
+    with patch("pathlib.Path.read_text", return_value="$shard_stats"):
+        assert format_stats(**kwargs) == "Sin shards"
+        assert format_stats(**kwargs, shard_stats={}) == "Sin peticiones todavía"
+        formatted = format_stats(
+            **kwargs,
+            shard_stats={
+                1: {"tokens": 20, "cost": 0.2, "queries": 2},
+                0: {"tokens": 10, "cost": 0.1, "queries": 1},
+            },
+        )
+    assert formatted == (
+        "- **Shard 0**: 1 peticiones, 10 tokens, 0.1000 $\n"
+        "- **Shard 1**: 2 peticiones, 20 tokens, 0.2000 $"
+    )
+
+
+def test_registry_reads_template_once(tmp_path):
+    path = tmp_path / "help.md"
+    path.write_text("Usa $chat_command", encoding="utf-8")
+    registry = TemplateRegistry(reload_interval=0)
+    for _ in range(3):
+        template, _ = registry.get(path)
+        assert template.safe_substitute(chat_command="!chat") == "Usa !chat"
+    assert registry.reads == 1
+
+def test_registry_hot_reload_on_mtime_change(tmp_path):
+    path = tmp_path / "help.md"
+    path.write_text("Usa $chat_command", encoding="utf-8")
+    registry = TemplateRegistry(reload_interval=0)
+    assert registry.render_static(path, chat_command="!chat") == "Usa !chat"
+    path.write_text("Escribe $chat_command", encoding="utf-8")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert registry.render_static(path, chat_command="!chat") == "Escribe !chat"
+    assert registry.reads == 2
+
+def test_registry_throttles_mtime_checks(tmp_path):
+    path = tmp_path / "help.md"
+    path.write_text("Usa $chat_command", encoding="utf-8")
+    registry = TemplateRegistry(reload_interval=60)
+    registry.get(path)
+    with patch("pathlib.Path.stat", side_effect=AssertionError("stat")):
+        registry.get(path)
+    assert registry.reads == 1
+
+def test_format_help_is_memoized(tmp_path):
+    path = tmp_path / "help.md"
+    path.write_text("Usa $chat_command, $stats_command o $help_command", encoding="utf-8")
+    first = format_help(path, "!chat", "!stats", "!help")
+    with patch("pathlib.Path.read_text", side_effect=AssertionError("read")):
+        assert format_help(path, "!chat", "!stats", "!help") == first
+    assert templates.reads == 1
+
+def test_split_message_keeps_sections_and_code_blocks():
+    text = "## Uno\n" + "a\n" * 5 + "## Dos\n```\n" + "fila\n" * 30 + "```"
+    chunks = split_message(text, max_length=60)
+    assert all(len(chunk) <= 60 for chunk in chunks)
+    assert chunks[0].startswith("## Uno")
+    assert chunks[1].startswith("## Dos")
+    # Cada trozo abre y cierra sus bloques de código
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+    assert "".join(chunks).replace("```", "").count("fila") == 30
+    assert split_message("corto") == ["corto"]
+
+def test_stats_reply_fits_discord_limit():
+    users = {"user1": "User One", "user2": "User Two", "user3": "User Three"}
+    stats = {"tokens": 123456, "cost": 12.3456, "queries": 789}
+    with patch("dogimobot.formatters.USERS", users):
+        reply = format_stats(
+            template=settings.STATS_REPLY_TEMPLATE,
+            session_id="0e6f3b4c-2d2b-4a4e-9a51-8f1c1b7d9e21",
+            version="0.1.0",
+            model="gpt-3.5-turbo-0125",
+            elapsed_days=12,
+            elapsed_hours=1,
+            elapsed_minutes=2,
+            elapsed_seconds=3,
+            total_tokens=370368,
+            total_queries=2367,
+            total_cost=37.0368,
+            user_stats={user: stats for user in users},
+            max_cost=0.1234,
+            session_start_time="01/06/2024 - 10:00:00",
+            model_stats={"gpt-3.5-turbo-0125": stats},
+            shard_stats={0: stats, 1: stats},
+            budget={"user": {"daily": (0.5, 1.0), "monthly": (5.0, 10.0)},
+                    "guild": {"daily": (2.0, 5.0), "monthly": (20.0, None)}},
+            latency={
+                stage: {"p50": 123.4, "p95": 456.7, "p99": 890.1, "count": 2367}
+                for stage in ["memory", "context", "queue", "openai", "reply", "send", "chat", "total"]
+            },
+        )
+    chunks = split_message(reply)
+    assert len(reply) > settings.DISCORD_MAX_MESSAGE_LENGTH
+    assert all(len(chunk) <= settings.DISCORD_MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert "\n".join(chunks) == reply
@@ -0,0 +1,42 @@
+import json
+import logging
+from logging.handlers import QueueHandler
+from unittest.mock import patch
+
+from dogimobot import logging_config
+from dogimobot.logging_config import JsonFormatter, file_handler_config
+
+
+def test_root_logger_uses_queue_handler():
+    root = logging.getLogger()
+    assert any(isinstance(handler, QueueHandler) for handler in root.handlers)
+    # Los handlers que escriben están en el listener
+    assert logging_config.listener.handlers
+
+def test_json_formatter_includes_extra_fields():
+    record = logging.LogRecord("dogimobot", logging.INFO, "main.py", 10, "Hola %s", ("bot",), None)
+    record.session_id = "abc"
+    record.user = "testuser"
+    record.tokens = 15
+    record.cost = 0.001
+    data = json.loads(JsonFormatter().format(record))
+    assert data["message"] == "Hola bot"
+    assert data["level"] == "INFO"
+    assert data["session_id"] == "abc"
+    assert data["user"] == "testuser"
+    assert data["tokens"] == 15
+    assert data["cost"] == 0.001
+    assert "latency" not in data
+
+def test_file_handler_config_by_size():
+    with patch.object(logging_config, "LOG_ROTATION", "size"), patch.object(logging_config, "LOG_MAX_BYTES", 1234):
+        config = file_handler_config()
+    assert config["class"] == "logging.handlers.RotatingFileHandler"
+    assert config["maxBytes"] == 1234
+
+def test_file_handler_config_by_time():
+    with patch.object(logging_config, "LOG_ROTATION", "time"), patch.object(logging_config, "LOG_JSON", True):
+        config = file_handler_config()
+    assert config["class"] == "logging.handlers.TimedRotatingFileHandler"
+    assert config["when"] == logging_config.LOG_ROTATION_WHEN
+    assert config["formatter"] == "json"
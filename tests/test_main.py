@@ -31,6 +31,10 @@ from openai.types.chat.chat_completion_assistant_message_param import (
 
 from dogimobot import settings
 from dogimobot.main import DiscordClient, OpenAIMessageType
+from dogimobot.memory import ConversationStore
+from dogimobot.scheduler import Priority
+from dogimobot.tracing import Tracer
+from tests.conftest import MockSettings
 
 
 
@@ -45,17 +49,18 @@ def test_save_in_memory(client: DiscordClient):
     message.content = "!chat test message"
     message.author.name = "testuser"
     client._save_in_memory(message)
-    assert len(client.memory) == 1
-    assert client.memory[0]['role'] == 'user'
-    assert client.memory[0]['content'] == 'test message'
-    assert client.memory[0]['author'] == 'testuser'
+    conversation = client.memory.get(ConversationStore.key_for(message))
+    assert len(conversation) == 1
+    assert conversation.messages[0]['role'] == 'user'
+    assert conversation.messages[0]['content'] == 'test message'
+    assert conversation.messages[0]['author'] == 'testuser'
 
 def test_get_context(client: DiscordClient):
     message = MagicMock(spec=Message)
     message.content = "!chat test message"
     message.author.name = "testuser"
     client._save_in_memory(message)
-    context = client._get_context()
+    context = client._get_context(message)
     print(context)
     print(client.memory)
     assert len(context) == 2  # System prompt + 1 message
@@ -63,12 +68,64 @@ def test_get_context(client: DiscordClient):
     assert context[1]['role'] == 'user'
     assert 'Test User dijo: test message' in context[1]['content']
 
+def test_get_context_is_per_channel(client: DiscordClient):
+    message1 = MagicMock(spec=Message)
+    message1.content = "!chat en el canal 1"
+    message1.author.name = "testuser"
+    message1.guild.id = 1
+    message1.channel.id = 10
+    message2 = MagicMock(spec=Message)
+    message2.content = "!chat en el canal 2"
+    message2.author.name = "testuser"
+    message2.guild.id = 1
+    message2.channel.id = 20
+    client._save_in_memory(message1)
+    client._save_in_memory(message2)
+    context = client._get_context(message1)
+    assert len(context) == 2
+    assert 'en el canal 1' in context[1]['content']
+
+def test_get_context_respects_token_budget(client: DiscordClient):
+    message = MagicMock(spec=Message)
+    message.author.name = "testuser"
+
+    with patch("dogimobot.main.get_context_budget", return_value=400), \
+        patch("dogimobot.main.count_message_tokens", side_effect=lambda text, model: 100):
+        for i in range(5):
+            message.content = f"!chat mensaje {i} " + "x" * 400
+            client._save_in_memory(message)
+        context = client._get_context(message)
+
+    # 400 - system prompt - mensaje actual = 200 -> caben los 2 más recientes
+    assert len(context) == 3
+    assert 'mensaje 3' in context[1]['content']
+    assert 'mensaje 4' in context[2]['content']
+    # El número de tokens queda guardado en memoria
+    conversation = client.memory.get(ConversationStore.key_for(message))
+    assert conversation.messages[-1]['tokens'] == 100
+
+def test_save_in_memory_prerenders_message(client: DiscordClient):
+    message = MagicMock(spec=Message)
+    message.content = "!chat test message"
+    message.author.name = "testuser"
+    client._save_in_memory(message)
+    client._save_reply_in_memory(message, "respuesta")
+    conversation = client.memory.get(ConversationStore.key_for(message))
+    user_entry, bot_entry = conversation.messages
+    assert 'Test User dijo: test message' in user_entry['param']['content']
+    assert bot_entry['param'] == {"role": "assistant", "content": "respuesta"}
+    assert user_entry['tokens'] > 0
+    # El contexto reutiliza los mismos objetos ya renderizados
+    context = client._get_context(message)
+    assert context[1] is user_entry['param']
+    assert context[2] is bot_entry['param']
+
 @pytest.mark.asyncio
 async def test_get_response_from_openai(client: DiscordClient):
     message = MagicMock(spec=Message)
     message.content = "!dog test message"
     message.author.name = "testuser"
-    context = client._get_context()
+    context = client._get_context(message)
 
     # Ensure the OpenAI client's chat.completions.create method is patched
     client.client_openai.chat = MagicMock()
@@ -102,3 +159,232 @@ def test_get_tokens_from_response(client: DiscordClient):
     assert in_tokens == 10
     assert out_tokens == 20
 
+
+
+def _make_chunks(deltas: list[str], prompt_tokens: int, completion_tokens: int):
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice, ChoiceDelta
+    from openai.types.completion_usage import CompletionUsage
+
+    chunks = [
+        ChatCompletionChunk(
+            id="chunk",
+            object="chat.completion.chunk",
+            created=1677652288,
+            model="gpt-3.5-turbo",
+            choices=[Choice(index=0, delta=ChoiceDelta(content=delta), finish_reason=None)],
+        )
+        for delta in deltas
+    ]
+    chunks.append(
+        ChatCompletionChunk(
+            id="chunk",
+            object="chat.completion.chunk",
+            created=1677652288,
+            model="gpt-3.5-turbo",
+            choices=[],
+            usage=CompletionUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+    )
+
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    return stream()
+
+@pytest.mark.asyncio
+async def test_stream_reply(client: DiscordClient):
+    message = MagicMock(spec=Message)
+    placeholder = MagicMock()
+    placeholder.edit = AsyncMock()
+    message.channel.send = AsyncMock(return_value=placeholder)
+
+    reply, in_tokens, out_tokens = await client._stream_reply(
+        message, _make_chunks(["Hola", ", ", "Test User"], 12, 3)
+    )
+
+    assert reply == "Hola, Test User"
+    assert (in_tokens, out_tokens) == (12, 3)
+    message.channel.send.assert_awaited_once_with(MockSettings.STREAM_PLACEHOLDER)
+    placeholder.edit.assert_awaited_with(content="Hola, Test User")
+
+@pytest.mark.asyncio
+async def test_stream_reply_splits_long_messages(client: DiscordClient):
+    message = MagicMock(spec=Message)
+    placeholder = MagicMock()
+    placeholder.edit = AsyncMock()
+    message.channel.send = AsyncMock(return_value=placeholder)
+
+    with patch.object(MockSettings, "DISCORD_MAX_MESSAGE_LENGTH", 10):
+        reply, _, _ = await client._stream_reply(
+            message, _make_chunks(["abcdef", "ghijkl"], 1, 2)
+        )
+
+    assert reply == "abcdefghijkl"
+    # Placeholder + un mensaje nuevo con el texto que no cabía
+    assert message.channel.send.await_count == 2
+    placeholder.edit.assert_awaited_with(content="ghijkl")
+
+def test_should_edit(client: DiscordClient):
+    assert not client._should_edit(0, 10.0)
+    assert not client._should_edit(100, 0.0)
+    assert client._should_edit(MockSettings.STREAM_EDIT_TOKENS, MockSettings.STREAM_MIN_EDIT_INTERVAL)
+    assert client._should_edit(1, MockSettings.STREAM_EDIT_INTERVAL)
+
+def test_get_context_includes_summary(client: DiscordClient):
+    message = MagicMock(spec=Message)
+    message.content = "!chat test message"
+    message.author.name = "testuser"
+    client._save_in_memory(message)
+    conversation = client.memory.get(ConversationStore.key_for(message))
+    conversation.summary = "Hablamos de regularización"
+    context = client._get_context(message)
+    assert len(context) == 3
+    assert context[1]['role'] == 'system'
+    assert 'Hablamos de regularización' in context[1]['content']
+
+def _completion(content: str, prompt_tokens: int = 10, completion_tokens: int = 5) -> ChatCompletion:
+    from openai.types.chat.chat_completion import Choice
+    from openai.types.chat.chat_completion_message import ChatCompletionMessage
+    from openai.types.completion_usage import CompletionUsage
+
+    return ChatCompletion(
+        id="chatcmpl-test",
+        object="chat.completion",
+        created=1677652288,
+        model="gpt-3.5-turbo",
+        choices=[
+            Choice(
+                index=0,
+                message=ChatCompletionMessage(role="assistant", content=content),
+                logprobs=None,
+                finish_reason="stop",
+            )
+        ],
+        usage=CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        ),
+    )
+
+def _chat_message(content: str) -> MagicMock:
+    message = MagicMock(spec=Message)
+    message.content = content
+    message.author.name = "testuser"
+    message.guild.id = 1
+    message.channel.id = 1
+    message.channel.send = AsyncMock()
+    return message
+
+@pytest.mark.asyncio
+async def test_handle_chat_sends_reply_and_records_stats(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("Hola"))
+    message = _chat_message("!chat hola bot")
+    await client._handle_chat(message)
+    message.channel.send.assert_awaited_once_with("Hola")
+    assert client.bot_stats.total_queries == 1
+    assert client.bot_stats.total_tokens == 15
+    assert (client.bot_stats.input_tokens, client.bot_stats.output_tokens) == (10, 5)
+
+@pytest.mark.asyncio
+async def test_handle_chat_uses_response_cache(client: DiscordClient, reset_rate_limiter):
+    from dogimobot.cache import ResponseCache
+
+    client.response_cache = ResponseCache(max_entries=10, ttl=60)
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("L1 usa |w|"))
+    question = "!chat ¿Qué diferencia hay entre L1 y L2?"
+
+    await client._handle_chat(_chat_message(question))
+    message = _chat_message("!chat  que diferencia HAY entre l1 y l2")
+    await client._handle_chat(message)
+
+    client.client_openai.chat.completions.create.assert_awaited_once()
+    message.channel.send.assert_awaited_once_with("L1 usa |w|")
+    # El acierto cuenta como petición sin coste
+    assert client.bot_stats.total_queries == 2
+    assert client.bot_stats.total_tokens == 15
+    assert client.response_cache.hits == 1
+    # Y la respuesta queda en memoria
+    conversation = client.memory.get(ConversationStore.key_for(message))
+    assert conversation.messages[-1]["content"] == "L1 usa |w|"
+
+def test_priority_for_admins(client: DiscordClient):
+    message = _chat_message("!chat hola")
+    assert client._priority_for(message) == Priority.NORMAL
+    message.author.name = "admin"
+    assert client._priority_for(message) == Priority.HIGH
+
+@pytest.mark.asyncio
+async def test_handle_chat_goes_through_scheduler(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("Hola"))
+    await client._handle_chat(_chat_message("!chat hola bot"))
+    assert client.scheduler.total_scheduled == 1
+    assert client.scheduler.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_handle_chat_batch_splits_usage(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("Hola a los dos"))
+    first = _chat_message("!chat qué es L1")
+    second = _chat_message("!chat qué es L2")
+    second.author.name = "otheruser"
+    await client._handle_chat_batch([first, second])
+    # Una sola completion para los dos mensajes
+    client.client_openai.chat.completions.create.assert_awaited_once()
+    question = client.client_openai.chat.completions.create.call_args.kwargs["messages"][-1]["content"]
+    assert "qué es L1" in question and "qué es L2" in question
+    second.channel.send.assert_awaited_once_with("Hola a los dos")
+    assert client.bot_stats.total_queries == 2
+    assert client.bot_stats.total_tokens == 15
+    assert client.bot_stats.user_stats["testuser"]["tokens"] == 8
+    assert client.bot_stats.user_stats["otheruser"]["tokens"] == 7
+    assert client.bot_stats.user_stats["otheruser"]["queries"] == 1
+
+@pytest.mark.asyncio
+async def test_handle_chat_sends_fallback_on_error(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(side_effect=ValueError("boom"))
+    message = _chat_message("!chat hola bot")
+    await client._handle_chat(message)
+    message.channel.send.assert_awaited_once_with(MockSettings.FALLBACK_ANSWER)
+    assert client.bot_stats.total_queries == 0
+
+@pytest.mark.asyncio
+async def test_handle_chat_uses_routed_model(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("Hola"))
+    with patch.object(client.router, "route", return_value=("gpt-4", "pregunta compleja")), patch.dict(
+        settings.OPENAI_PRICING, {"gpt-4": {"in": 30, "out": 60}}
+    ):
+        await client._handle_chat(_chat_message("!chat analiza esto"))
+        expected_cost = client.bot_stats.calculate_total_cost(10, 5, "gpt-4")
+    assert client.client_openai.chat.completions.create.call_args.kwargs["model"] == "gpt-4"
+    assert client.bot_stats.model_stats["gpt-4"]["queries"] == 1
+    assert client.bot_stats.total_cost == pytest.approx(expected_cost)
+
+@pytest.mark.asyncio
+async def test_handle_chat_rejects_over_budget(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("Hola"))
+    client.budgets.limits["user"]["daily"] = 0.0
+    message = _chat_message("!chat hola bot")
+    await client._handle_chat(message)
+    client.client_openai.chat.completions.create.assert_not_called()
+    message.channel.send.assert_awaited_once_with("Presupuesto diario del usuario agotado.")
+    assert client.bot_stats.total_queries == 0
+
+@pytest.mark.asyncio
+async def test_handle_chat_records_stage_latencies(client: DiscordClient, reset_rate_limiter):
+    client.client_openai.chat = MagicMock()
+    client.client_openai.chat.completions.create = AsyncMock(return_value=_completion("Hola"))
+    with patch("dogimobot.main.tracer", Tracer(window=10, sample_rate=0.0)) as stage_tracer:
+        await client._handle_chat(_chat_message("!chat hola bot"))
+    assert {"context", "queue", "openai", "reply", "send"} <= set(stage_tracer.summary())
@@ -0,0 +1,80 @@
+from unittest.mock import MagicMock
+
+from discord import Message
+
+from dogimobot.memory import ConversationStore, ShardedConversationStore, shard_for
+
+
+def _entry(content: str) -> dict:
+    return {"role": "user", "content": content, "author": "testuser"}
+
+def test_key_for_guild_message():
+    message = MagicMock(spec=Message)
+    message.guild.id = 1
+    message.channel.id = 2
+    assert ConversationStore.key_for(message) == (1, 2)
+
+def test_key_for_direct_message():
+    message = MagicMock(spec=Message)
+    message.guild = None
+    message.channel.id = 3
+    assert ConversationStore.key_for(message) == (None, 3)
+
+def test_conversations_are_isolated():
+    store = ConversationStore(window_size=5, max_messages=100)
+    store.append((1, 1), _entry("a"))
+    store.append((1, 2), _entry("b"))
+    assert [m["content"] for m in store.get((1, 1))] == ["a"]
+    assert [m["content"] for m in store.get((1, 2))] == ["b"]
+    assert store.total_messages == 2
+
+def test_window_is_bounded_per_conversation():
+    store = ConversationStore(window_size=3, max_messages=100)
+    for i in range(10):
+        store.append((1, 1), _entry(str(i)))
+    assert [m["content"] for m in store.get((1, 1))] == ["7", "8", "9"]
+    assert store.total_messages == 3
+
+def test_lru_eviction_under_global_cap():
+    store = ConversationStore(window_size=5, max_messages=4)
+    store.append((1, 1), _entry("a"))
+    store.append((1, 1), _entry("a"))
+    store.append((1, 2), _entry("b"))
+    store.append((1, 2), _entry("b"))
+    # Usamos la conversación 1 para que la 2 sea la menos reciente
+    store.append((1, 1), _entry("a"))
+    assert (1, 2) not in store
+    assert (1, 1) in store
+    assert store.evictions == 1
+    assert store.total_messages == 3
+
+def test_hit_miss_counters():
+    store = ConversationStore(window_size=5, max_messages=100)
+    store.get((1, 1))
+    store.get((1, 1))
+    store.get((1, 2))
+    assert store.hits == 1
+    assert store.misses == 2
+    assert store.hit_rate == 1 / 3
+
+def test_shard_for():
+    assert shard_for(None, 4) == 0
+    assert shard_for(5 << 22, 4) == 1
+    assert shard_for(5 << 22, 1) == 0
+
+def test_sharded_store_partitions_by_shard():
+    store = ShardedConversationStore(lambda: 2, window_size=5, max_messages=2)
+    shard0, shard1 = (2 << 22, 1), (3 << 22, 1)
+    store.append(shard0, _entry("a"))
+    store.append(shard1, _entry("b"))
+    assert set(store.shards) == {0, 1}
+    assert len(store) == 2
+    assert shard1 in store
+    # El tope es por shard, así que llenar el 0 no desaloja el 1
+    store.append((4 << 22, 1), _entry("c"))
+    store.append((4 << 22, 1), _entry("d"))
+    assert shard0 not in store
+    assert [m["content"] for m in store.get(shard1)] == ["b"]
+    assert store.evictions == 1
+    assert store.total_messages == 3
+    assert store.hits == 1
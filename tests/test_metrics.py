@@ -0,0 +1,113 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from dogimobot import settings
+from dogimobot.budgets import BudgetTracker
+from dogimobot.memory import ConversationStore
+from dogimobot.metrics import (
+    Histogram,
+    MetricsRegistry,
+    MetricsServer,
+    runtime_collector,
+    stats_collector,
+)
+from dogimobot.rate_limiting import RateLimiter
+from dogimobot.resilience import ResilientCaller
+from dogimobot.scheduler import RequestScheduler
+from dogimobot.stats import BotStats
+from dogimobot.tracing import Tracer
+
+
+def test_histogram_cumulative_buckets():
+    histogram = Histogram([0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 3.0]:
+        histogram.observe(value)
+    assert histogram.cumulative() == [("0.1", 2), ("1", 3), ("+Inf", 4)]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(3.65)
+
+
+def test_render_stats_and_latencies():
+    bot_stats = BotStats()
+    bot_stats.add_total_queries()
+    bot_stats.add_total_tokens(15)
+    bot_stats.add_direction_tokens(10, 5)
+    message = MagicMock()
+    message.author.name = 'ana "la" jefa'
+    bot_stats.add_user_stats(message, 15, 0.25)
+    bot_stats.add_model_stats("gpt-4", 15, 0.25)
+    registry = MetricsRegistry(latency_buckets=[0.5])
+    registry.add_collector(stats_collector(bot_stats))
+    tracer = Tracer(window=10, sample_rate=0.0)
+    tracer.listeners.append(registry.observe_latency)
+    tracer.record("openai", 0.2)
+
+    text = registry.render()
+    assert "# TYPE dogimobot_queries_total counter" in text
+    assert "dogimobot_queries_total 1\n" in text
+    assert 'dogimobot_tokens_total{direction="in"} 10\n' in text
+    assert 'dogimobot_tokens_total{direction="out"} 5\n' in text
+    assert 'dogimobot_user_cost_dollars_total{user="ana \\"la\\" jefa"} 0.25' in text
+    assert 'dogimobot_model_tokens_total{model="gpt-4"} 15' in text
+    assert "# TYPE dogimobot_stage_latency_seconds histogram" in text
+    assert 'dogimobot_stage_latency_seconds_bucket{stage="openai",le="0.5"} 1' in text
+    assert 'dogimobot_stage_latency_seconds_count{stage="openai"} 1' in text
+    assert text.count("# TYPE dogimobot_stage_latency_seconds ") == 1
+
+
+def test_runtime_collector(reset_rate_limiter):
+    RateLimiter.rejections = 3
+    registry = MetricsRegistry()
+    registry.add_collector(
+        runtime_collector(
+            ConversationStore(),
+            RequestScheduler(),
+            ResilientCaller(),
+            BudgetTracker(),
+        )
+    )
+    text = registry.render()
+    assert "dogimobot_rate_limit_rejections_total 3" in text
+    assert "dogimobot_scheduler_queue_depth 0" in text
+    assert "dogimobot_openai_circuit_open 0" in text
+    assert "dogimobot_cache_entries" not in text
+
+
+def test_for_components_reads_port_when_called(monkeypatch):
+    # Cada proceso con shards desplaza el puerto antes de crear el cliente
+    monkeypatch.setattr(settings, "METRICS_PORT", 9111)
+    server = MetricsServer.for_components(
+        Tracer(window=10, sample_rate=0.0),
+        BotStats(),
+        ConversationStore(),
+        RequestScheduler(),
+        ResilientCaller(),
+        BudgetTracker(),
+    )
+    assert server.port == 9111
+
+
+@pytest.mark.asyncio
+async def test_server_serves_metrics():
+    registry = MetricsRegistry()
+    registry.add_collector(lambda: [("dogimobot_queries_total", {}, 7)])
+    server = MetricsServer(registry, host="127.0.0.1", port=0)
+    await server.start()
+    assert server.server is not None
+    port = server.server.sockets[0].getsockname()[1]
+
+    async def get(path: str) -> bytes:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    response = await get("/metrics")
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"dogimobot_queries_total 7" in response
+    assert (await get("/otra")).startswith(b"HTTP/1.1 404")
+    await server.close()
@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+
+from dogimobot.memory import ConversationStore
+from dogimobot.persistence import SQLiteMemoryBackend, StatsStore
+from dogimobot.stats import BotStats
+
+KEY = (1, 1)
+
+
+def _entry(content: str, role: str = "user") -> dict:
+    return {
+        "role": role,
+        "content": content,
+        "author": "testuser",
+        "time": "01/01/2024 a las 00:00:00",
+        "attachments": None,
+        "param": {"role": role, "content": f"Test User dijo: {content}"},
+        "tokens": 10,
+    }
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteMemoryBackend(tmp_path / "memory.db", flush_interval=0.01)
+    yield backend
+    backend.close()
+
+def test_wal_mode(backend: SQLiteMemoryBackend):
+    mode = backend._conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+def test_enqueue_does_not_write_until_flush(backend: SQLiteMemoryBackend):
+    backend.enqueue(KEY, _entry("hola"))
+    assert backend.pending == 1
+    assert backend.load(KEY, 10)[0] == []
+    assert backend.flush() == 1
+    assert backend.pending == 0
+    entries, summary, _ = backend.load(KEY, 10)
+    assert [e["content"] for e in entries] == ["hola"]
+    assert entries[0]["param"] == {"role": "user", "content": "Test User dijo: hola"}
+    assert summary == ""
+
+def test_load_recent_window_only(backend: SQLiteMemoryBackend):
+    for i in range(100):
+        backend.enqueue(KEY, _entry(str(i)))
+    backend.enqueue((1, 2), _entry("otro canal"))
+    backend.flush()
+    entries, _, _ = backend.load(KEY, 3)
+    assert [e["content"] for e in entries] == ["97", "98", "99"]
+
+def test_direct_messages_have_no_guild(backend: SQLiteMemoryBackend):
+    backend.enqueue((None, 5), _entry("dm"))
+    backend.flush()
+    assert [e["content"] for e in backend.load((None, 5), 10)[0]] == ["dm"]
+
+def test_store_reloads_after_restart(tmp_path):
+    path = tmp_path / "memory.db"
+    backend = SQLiteMemoryBackend(path)
+    store = ConversationStore(window_size=5, max_messages=100, backend=backend)
+    for i in range(4):
+        store.append(KEY, _entry(str(i)))
+    store.fold(KEY, list(store.get(KEY).messages)[:2], "Resumen", 7)
+    backend.close()
+
+    # Nuevo proceso: la conversación se carga al pedirla
+    backend = SQLiteMemoryBackend(path)
+    store = ConversationStore(window_size=5, max_messages=100, backend=backend)
+    conversation = store.get(KEY)
+    assert [m["content"] for m in conversation] == ["2", "3"]
+    assert conversation.summary == "Resumen"
+    assert conversation.summary_tokens == 7
+    assert store.total_messages == 2
+    # Los ids siguen creciendo tras reiniciar
+    store.append(KEY, _entry("4"))
+    assert conversation.messages[-1]["db_id"] == 5
+    backend.close()
+
+@pytest.mark.asyncio
+async def test_ensure_loaded_reads_in_thread(tmp_path, monkeypatch):
+    backend = SQLiteMemoryBackend(tmp_path / "memory.db")
+    backend.enqueue(KEY, _entry("hola"))
+    backend.flush()
+    store = ConversationStore(window_size=5, max_messages=100, backend=backend)
+    threads = []
+    original = asyncio.to_thread
+
+    async def to_thread(func, *args):
+        threads.append(func)
+        return await original(func, *args)
+
+    monkeypatch.setattr(asyncio, "to_thread", to_thread)
+    await store.ensure_loaded(KEY)
+    assert threads == [backend.load]
+    # get ya no vuelve a leer del backend
+    monkeypatch.setattr(backend, "load", None)
+    assert [m["content"] for m in store.get(KEY)] == ["hola"]
+    assert store.misses == 1
+    await store.ensure_loaded(KEY)
+    assert len(threads) == 1
+    backend.close()
+
+@pytest.mark.asyncio
+async def test_run_flushes_in_background(backend: SQLiteMemoryBackend):
+    backend.enqueue(KEY, _entry("hola"))
+    task = asyncio.create_task(backend.run())
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if backend.pending == 0 and backend.load(KEY, 10)[0]:
+            break
+    task.cancel()
+    assert [e["content"] for e in backend.load(KEY, 10)[0]] == ["hola"]
+
+
+def _session(stats_store: StatsStore, queries: int) -> BotStats:
+    bot_stats = BotStats()
+    bot_stats.historical = stats_store.load()
+    bot_stats.enable_journal()
+    for _ in range(queries):
+        bot_stats.add_total_tokens(10)
+        bot_stats.add_total_queries()
+        bot_stats.add_total_and_max_cost(0.1)
+    return bot_stats
+
+def test_stats_survive_restart(tmp_path):
+    stats_store = StatsStore(tmp_path)
+    bot_stats = _session(stats_store, 3)
+    stats_store.close(bot_stats)
+
+    stats_store = StatsStore(tmp_path)
+    bot_stats = _session(stats_store, 2)
+    state = bot_stats.alltime_state()
+    assert state["total_queries"] == 5
+    assert state["total_tokens"] == 50
+    assert bot_stats.total_queries == 2
+
+def test_stats_replay_deltas_after_snapshot(tmp_path):
+    stats_store = StatsStore(tmp_path)
+    bot_stats = _session(stats_store, 3)
+    stats_store.close(bot_stats)
+    # Cambios escritos en el diario pero sin instantánea (caída del proceso)
+    bot_stats.add_total_queries()
+    stats_store.append_deltas(stats_store._number(bot_stats.take_journal()))
+    with open(stats_store.deltas_path, "a", encoding="utf-8") as file:
+        file.write('{"op": "queries", "se')
+
+    assert StatsStore(tmp_path).load()["total_queries"] == 4
+
+def test_stats_ignore_deltas_already_in_snapshot(tmp_path):
+    stats_store = StatsStore(tmp_path)
+    bot_stats = _session(stats_store, 3)
+    deltas = stats_store._number(bot_stats.take_journal())
+    stats_store.append_deltas(deltas)
+    stats_store.write_snapshot(bot_stats.alltime_state(), stats_store.seq)
+    # Simulamos una caída antes de vaciar el diario
+    stats_store.append_deltas(deltas)
+    assert StatsStore(tmp_path).load()["total_queries"] == 3
+
+@pytest.mark.asyncio
+async def test_stats_run_writes_in_background(tmp_path):
+    stats_store = StatsStore(tmp_path, flush_interval=0.01, snapshot_interval=0.02)
+    bot_stats = _session(stats_store, 2)
+    task = asyncio.create_task(stats_store.run(bot_stats))
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if stats_store.snapshot_path.exists():
+            break
+    task.cancel()
+    assert StatsStore(tmp_path).load()["total_queries"] == 2
@@ -11,7 +11,7 @@ from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
 from dogimobot.main import DiscordClient
 from dogimobot import settings
-from dogimobot.rate_limiting import RateLimiter, default_response
+from dogimobot.rate_limiting import RateLimiter, default_response, is_default_response
 
 # Decorador para la función de ejemplo
 @RateLimiter.limit()
@@ -41,19 +41,44 @@ def example_get_response(self: DiscordClient, message: Message, context: list) -
 def test_rate_limit_not_exceeded(client, mock_message, reset_rate_limiter):
     response: ChatCompletion = example_get_response(client, message=mock_message, context=[])
     assert response.id == "test"
-    assert RateLimiter.track[mock_message.author.name]["num_peticiones"] == 1
+    requests, _ = RateLimiter.buckets[mock_message.author.name]
+    assert requests.tokens == pytest.approx(settings.MAX_MSG_PER_MINUTES - 1, abs=1e-3)
 
 def test_rate_limit_exceeded(client, mock_message, reset_rate_limiter):
-    RateLimiter.track["Test User"] = {"num_peticiones": settings.MAX_MSG_PER_MINUTES + 1, "start": datetime.now()}
+    for _ in range(settings.MAX_MSG_PER_MINUTES):
+        assert example_get_response(client, message=mock_message, context=[]).id == "test"
     response: ChatCompletion = example_get_response(client, message=mock_message, context=[])
-    assert response.choices[0].message.content.startswith("No tan rápido,")
+    assert is_default_response(response)
     assert "Has excedido el límite de mensajes por minuto" in response.choices[0].message.content
+    assert RateLimiter.rejections == 1
 
 def test_rate_limit_reset(client, mock_message, reset_rate_limiter):
-    RateLimiter.track[mock_message.author.name] = {"num_peticiones": settings.MAX_MSG_PER_MINUTES, "start": datetime.now() - timedelta(seconds=settings.RATE_LIMIT + 1)}
-    response: ChatCompletion = example_get_response(client, message=mock_message, context=[])
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0):
+        for _ in range(settings.MAX_MSG_PER_MINUTES + 1):
+            example_get_response(client, message=mock_message, context=[])
+    # Tras la ventana el bucket se ha rellenado
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0 + settings.RATE_LIMIT):
+        response: ChatCompletion = example_get_response(client, message=mock_message, context=[])
     assert response.id == "test"
-    assert RateLimiter.track[mock_message.author.name]["num_peticiones"] == 1
+
+def test_rate_limit_refills_gradually(client, mock_message, reset_rate_limiter):
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0):
+        for _ in range(settings.MAX_MSG_PER_MINUTES):
+            example_get_response(client, message=mock_message, context=[])
+        retry_after = RateLimiter.acquire(mock_message.author.name)
+    # Un mensaje se recupera en RATE_LIMIT / MAX_MSG_PER_MINUTES segundos
+    assert retry_after == pytest.approx(settings.RATE_LIMIT / settings.MAX_MSG_PER_MINUTES)
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0 + retry_after):
+        assert RateLimiter.acquire(mock_message.author.name) is None
+
+def test_no_double_burst_across_windows(client, mock_message, reset_rate_limiter):
+    # Con ventana fija se podían hacer 2x peticiones en el cambio de ventana
+    admitted = 0
+    for second in (59.0, 59.5, 60.0, 60.5):
+        with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0 + second):
+            for _ in range(settings.MAX_MSG_PER_MINUTES):
+                admitted += RateLimiter.acquire(mock_message.author.name) is None
+    assert admitted <= settings.MAX_MSG_PER_MINUTES + 1
 
 def test_rate_limit_multiple_users(client, reset_rate_limiter):
     user1 = "user1"
@@ -68,5 +93,71 @@ def test_rate_limit_multiple_users(client, reset_rate_limiter):
     response2: ChatCompletion = example_get_response(client, message=msg2, context=[])
     assert response1.id == "test"
     assert response2.id == "test"
-    assert RateLimiter.track[user1]["num_peticiones"] == 1
-    assert RateLimiter.track[user2]["num_peticiones"] == 1
\ No newline at end of file
+    assert set(RateLimiter.buckets) == {user1, user2}
+
+def test_token_limit(mock_message, reset_rate_limiter):
+    user = mock_message.author.name
+    assert RateLimiter.acquire(user) is None
+    RateLimiter.consume_tokens(user, settings.MAX_TOKENS_PER_MINUTE + 1)
+    # En deuda de tokens no se admiten más peticiones
+    assert RateLimiter.acquire(user) is not None
+
+def test_global_limit(reset_rate_limiter):
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0):
+        admitted = sum(
+            RateLimiter.acquire(f"user{i}") is None
+            for i in range(settings.GLOBAL_MAX_MSG_PER_MINUTE + 5)
+        )
+    assert admitted == settings.GLOBAL_MAX_MSG_PER_MINUTE
+
+def test_global_limit_is_per_shard(reset_rate_limiter):
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0):
+        for i in range(settings.GLOBAL_MAX_MSG_PER_MINUTE):
+            assert RateLimiter.acquire(f"user{i}", shard=0) is None
+        # El shard 0 está agotado pero el 1 tiene su propio bucket
+        assert RateLimiter.acquire("otro", shard=0) is not None
+        assert RateLimiter.acquire("otro", shard=1) is None
+    assert set(RateLimiter.global_buckets) == {0, 1}
+
+def test_shard_of_uses_client():
+    message = MagicMock(spec=Message)
+    client = MagicMock()
+    client.shard_of.return_value = 3
+    assert RateLimiter.shard_of((client,), message) == 3
+    assert RateLimiter.shard_of((), message) is None
+
+def test_idle_buckets_are_expired(reset_rate_limiter):
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0):
+        RateLimiter.acquire("user1")
+        RateLimiter.acquire("user2")
+    with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0 + settings.RATE_LIMIT):
+        RateLimiter.acquire("user3")
+    assert list(RateLimiter.buckets) == ["user3"]
+
+def test_bucket_state_is_bounded(reset_rate_limiter):
+    with patch("dogimobot.settings.RATE_LIMIT_MAX_KEYS", 3):
+        with patch("dogimobot.rate_limiting.time.monotonic", return_value=1000.0):
+            for i in range(10):
+                RateLimiter.acquire(f"user{i}")
+    assert len(RateLimiter.buckets) == 3
+
+
+# Decorador sobre una corrutina
+@RateLimiter.limit()
+async def example_get_response_async(self: DiscordClient, message: Message, context: list) -> ChatCompletion:
+    return example_get_response.__wrapped__(self, message=message, context=context)
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_async_not_exceeded(client, mock_message, reset_rate_limiter):
+    response: ChatCompletion = await example_get_response_async(client, message=mock_message, context=[])
+    assert response.id == "test"
+    assert mock_message.author.name in RateLimiter.buckets
+
+@pytest.mark.asyncio
+async def test_rate_limit_async_exceeded(client, mock_message, reset_rate_limiter):
+    for _ in range(settings.MAX_MSG_PER_MINUTES):
+        RateLimiter.acquire(mock_message.author.name)
+    with patch.dict(settings.USERS, {mock_message.author.name: "Test User"}):
+        response: ChatCompletion = await example_get_response_async(client, message=mock_message, context=[])
+    assert response.choices[0].message.content.startswith("\n\n🛑 No tan rápido, Test User")
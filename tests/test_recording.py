@@ -0,0 +1,85 @@
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from dogimobot.recording import (
+    TrafficRecorder,
+    anonymize,
+    command_of,
+    load_events,
+    replay_delays,
+)
+
+
+def _message(content: str, author: str = "ana", attachments=()) -> MagicMock:
+    message = MagicMock()
+    message.content = content
+    message.author.name = author
+    message.guild.id = 1
+    message.channel.id = 2
+    message.attachments = [
+        MagicMock(content_type=content_type) for content_type in attachments
+    ]
+    return message
+
+
+def test_anonymize_is_salted_and_stable():
+    assert anonymize("ana", "sal") == anonymize("ana", "sal")
+    assert anonymize("ana", "sal") != anonymize("ana", "otra")
+    assert anonymize("ana", "sal") != anonymize("luis", "sal")
+    assert len(anonymize("ana", "sal")) == 12
+
+
+def test_command_of():
+    assert command_of("!chat hola") == "!chat"
+    assert command_of("!STATS") == "!stats"
+    assert command_of("hola") == ""
+
+
+def test_event_keeps_shape_not_content(tmp_path):
+    recorder = TrafficRecorder(path=tmp_path / "traffic.jsonl", salt="sal")
+    with patch("dogimobot.recording.time.time", return_value=100.0):
+        event = recorder.event_for(
+            _message("!chat secreto", attachments=["image/png", None])
+        )
+    assert event == {
+        "ts": 100.0,
+        "a": anonymize("ana", "sal"),
+        "c": anonymize("1/2", "sal"),
+        "cmd": "!chat",
+        "len": len(" secreto"),
+        "att": ["image/png", ""],
+    }
+    assert "secreto" not in json.dumps(event)
+
+
+def test_record_flush_and_load(tmp_path):
+    path = tmp_path / "traffic.jsonl"
+    recorder = TrafficRecorder(path=path)
+    for ts in [3.0, 1.0, 2.0]:
+        with patch("dogimobot.recording.time.time", return_value=ts):
+            recorder.record(_message("hola"))
+    recorder.flush()
+    # Una última línea a medio escribir se ignora
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"ts": 4.0, "a"')
+    events = load_events(path)
+    assert [event["ts"] for event in events] == [1.0, 2.0, 3.0]
+    assert recorder.recorded == 3
+
+
+@pytest.mark.asyncio
+async def test_run_writes_in_background(tmp_path):
+    recorder = TrafficRecorder(path=tmp_path / "traffic.jsonl", flush_interval=0.01)
+    recorder.record(_message("!help"))
+    with patch("dogimobot.recording.asyncio.sleep", side_effect=[None, Exception]):
+        with pytest.raises(Exception):
+            await recorder.run()
+    assert len(load_events(tmp_path / "traffic.jsonl")) == 1
+
+
+def test_replay_delays():
+    events = [{"ts": 10.0}, {"ts": 12.0}, {"ts": 500.0}]
+    assert replay_delays(events) == [0.0, 2.0, 488.0]
+    assert replay_delays(events, speed=2, max_gap=60) == [0.0, 1.0, 30.0]
@@ -0,0 +1,121 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from dogimobot.exceptions import CircuitOpenException
+from dogimobot.resilience import (
+    CircuitBreaker,
+    ResilientCaller,
+    backoff_delay,
+    get_retry_after,
+    is_retryable,
+)
+
+
+class FakeStatusError(Exception):
+    def __init__(self, status_code: int, headers: dict | None = None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def test_is_retryable():
+    assert is_retryable(FakeStatusError(429))
+    assert is_retryable(FakeStatusError(503))
+    assert not is_retryable(FakeStatusError(400))
+    assert not is_retryable(ValueError("otro"))
+
+def test_get_retry_after():
+    assert get_retry_after(FakeStatusError(429, {"retry-after": "2"})) == 2.0
+    assert get_retry_after(FakeStatusError(429, {"retry-after-ms": "500"})) == 0.5
+    assert get_retry_after(FakeStatusError(429, {"retry-after": "Wed, 21 Oct 2015"})) is None
+    assert get_retry_after(FakeStatusError(429)) is None
+
+def test_backoff_delay_is_capped():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, 1.0, 5.0) <= 5.0
+
+@pytest.mark.asyncio
+async def test_call_retries_transient_errors():
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=10), max_retries=3, base_delay=0.0)
+    func = AsyncMock(side_effect=[FakeStatusError(500), FakeStatusError(429), "ok"])
+    with patch("dogimobot.resilience.asyncio.sleep", new=AsyncMock()):
+        assert await caller.call(func) == "ok"
+    assert func.await_count == 3
+    assert caller.retries == 2
+    assert caller.breaker.consecutive_failures == 0
+
+@pytest.mark.asyncio
+async def test_call_honors_retry_after():
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=10), max_retries=1, max_delay=10)
+    func = AsyncMock(side_effect=[FakeStatusError(429, {"retry-after": "3"}), "ok"])
+    with patch("dogimobot.resilience.asyncio.sleep", new=AsyncMock()) as sleep:
+        assert await caller.call(func) == "ok"
+    sleep.assert_awaited_once_with(3.0)
+
+@pytest.mark.asyncio
+async def test_call_does_not_retry_client_errors():
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=10), max_retries=3)
+    func = AsyncMock(side_effect=FakeStatusError(400))
+    with pytest.raises(FakeStatusError):
+        await caller.call(func)
+    assert func.await_count == 1
+    assert caller.failures == 0
+
+@pytest.mark.asyncio
+async def test_breaker_opens_and_fails_fast():
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=2, reset_timeout=60), max_retries=5)
+    func = AsyncMock(side_effect=FakeStatusError(503))
+    with patch("dogimobot.resilience.asyncio.sleep", new=AsyncMock()):
+        with pytest.raises(CircuitOpenException):
+            await caller.call(func)
+    # Se deja de llamar en cuanto se abre el circuito
+    assert func.await_count == 2
+    assert caller.breaker.state == CircuitBreaker.OPEN
+    assert caller.stats()["fast_failures"] == 1
+
+def test_breaker_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    with patch("dogimobot.resilience.time.monotonic", return_value=0.0):
+        breaker.record_failure()
+        assert not breaker.allow()
+    with patch("dogimobot.resilience.time.monotonic", return_value=31.0):
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # Solo pasa una petición de prueba
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.times_opened == 1
+
+@pytest.mark.asyncio
+async def test_client_error_does_not_close_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    caller = ResilientCaller(breaker, max_retries=0)
+    with patch("dogimobot.resilience.time.monotonic", return_value=0.0):
+        breaker.record_failure()
+    with patch("dogimobot.resilience.time.monotonic", return_value=31.0):
+        with pytest.raises(FakeStatusError):
+            await caller.call(AsyncMock(side_effect=FakeStatusError(400)))
+        # Sigue semiabierto y se puede volver a probar
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.consecutive_failures == 1
+        assert breaker.allow()
+
+@pytest.mark.asyncio
+async def test_cancelled_probe_releases_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    caller = ResilientCaller(breaker, max_retries=0)
+    with patch("dogimobot.resilience.time.monotonic", return_value=0.0):
+        breaker.record_failure()
+    with patch("dogimobot.resilience.time.monotonic", return_value=31.0):
+        task = asyncio.create_task(caller.call(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        assert breaker.probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not breaker.probing
+        assert breaker.allow()
@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+import pytest
+
+from dogimobot import settings
+from dogimobot.routing import ModelRouter, estimate_cost
+
+PRICING = {
+    "cheap": {"in": 0.5, "out": 1.5},
+    "strong": {"in": 10, "out": 30},
+    "long": {"in": 1, "out": 2},
+}
+BUDGETS = {"cheap": 1000, "strong": 1000, "long": 5000}
+
+
+@pytest.fixture
+def router():
+    with patch.object(settings, "OPENAI_PRICING", PRICING), patch.object(
+        settings, "OPENAI_CONTEXT_BUDGET", BUDGETS
+    ):
+        yield ModelRouter(
+            default_model="cheap",
+            cheap_model="cheap",
+            strong_model="strong",
+            overrides={"vip": "strong"},
+            enabled=True,
+        )
+
+
+def test_estimate_cost():
+    with patch.object(settings, "OPENAI_PRICING", PRICING):
+        assert estimate_cost("strong", 1000, 1000) == pytest.approx(0.04)
+
+def test_invalid_model_raises():
+    with patch.object(settings, "OPENAI_PRICING", PRICING):
+        with pytest.raises(ValueError):
+            ModelRouter("cheap", "cheap", "gpt-5", overrides={}, enabled=True)
+
+def test_disabled_router_uses_default():
+    router = ModelRouter("default", "cheap", "strong", overrides={}, enabled=False)
+    assert router.route("Analiza este código paso a paso", 100) == ("default", "por defecto")
+
+def test_is_complex():
+    assert ModelRouter.is_complex("Compara L1 y L2 en detalle")
+    assert ModelRouter.is_complex("```python\nprint(1)\n```")
+    assert not ModelRouter.is_complex("¿Qué hora es?")
+
+def test_route_by_complexity(router):
+    assert router.route("¿Qué hora es?", 100)[0] == "cheap"
+    assert router.route("Analiza los resultados del modelo", 100)[0] == "strong"
+
+def test_route_user_override(router):
+    assert router.route("¿Qué hora es?", 100, user="vip") == ("strong", "preferencia del usuario")
+
+def test_route_long_context(router):
+    assert router.route("¿Qué hora es?", 3000) == ("long", "contexto largo")
+
+def test_route_uses_trimmed_context(router):
+    # El historial recortado cabe en el modelo barato: no se escala
+    def trimmed(model):
+        return min(3000, BUDGETS[model])
+
+    assert router.route("¿Qué hora es?", trimmed) == ("cheap", "pregunta sencilla")
+    # Si lo que no se puede recortar no cabe sí se escala
+    assert router.route("¿Qué hora es?", lambda model: 2000) == ("long", "contexto largo")
+
+def test_route_low_budget(router):
+    model, reason = router.route("Analiza los resultados", 100, remaining_budget=0.01)
+    assert (model, reason) == ("cheap", "presupuesto bajo")
+    assert router.route("Analiza los resultados", 100, remaining_budget=100)[0] == "strong"
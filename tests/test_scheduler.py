@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from dogimobot.scheduler import Priority, RequestScheduler
+
+
+async def _blocked_run(scheduler, order, name, user, channel, gate, priority=Priority.NORMAL):
+    async def job():
+        order.append(name)
+        await gate.wait()
+        return name
+
+    return await scheduler.run(job, user=user, channel=channel, priority=priority)
+
+
+@pytest.mark.asyncio
+async def test_run_returns_result_and_records_metrics():
+    scheduler = RequestScheduler(max_concurrency=2, reserved_high=0)
+
+    async def job():
+        return 42
+
+    assert await scheduler.run(job, user="a", channel=1) == 42
+    stats = scheduler.stats()
+    assert stats["total_scheduled"] == 1
+    assert stats["in_flight"] == 0
+    assert stats["queue_depth"] == 0
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded():
+    scheduler = RequestScheduler(max_concurrency=2, reserved_high=0)
+    gate = asyncio.Event()
+    order: list[str] = []
+    tasks = [
+        asyncio.create_task(_blocked_run(scheduler, order, f"t{i}", f"u{i}", 1, gate))
+        for i in range(5)
+    ]
+    await asyncio.sleep(0)
+    assert scheduler.in_flight == 2
+    assert scheduler.queue_depth == 3
+    gate.set()
+    assert await asyncio.gather(*tasks) == [f"t{i}" for i in range(5)]
+    assert scheduler.in_flight == 0
+    assert scheduler.queue_depth == 0
+
+@pytest.mark.asyncio
+async def test_round_robin_between_users_and_channels():
+    scheduler = RequestScheduler(max_concurrency=1, reserved_high=0)
+    gate = asyncio.Event()
+    order: list[str] = []
+    # Ocupa el único hueco
+    first = asyncio.create_task(_blocked_run(scheduler, order, "first", "x", 0, gate))
+    await asyncio.sleep(0)
+    # Un usuario pesado en el canal 1 y otros dos en los canales 1 y 2
+    tasks = [
+        asyncio.create_task(_blocked_run(scheduler, order, name, user, channel, gate))
+        for name, user, channel in [
+            ("a1", "a", 1),
+            ("a2", "a", 1),
+            ("a3", "a", 1),
+            ("b1", "b", 1),
+            ("c1", "c", 2),
+        ]
+    ]
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(first, *tasks)
+    assert order == ["first", "a1", "c1", "b1", "a2", "a3"]
+
+@pytest.mark.asyncio
+async def test_high_priority_uses_reserved_slot():
+    scheduler = RequestScheduler(max_concurrency=2, reserved_high=1)
+    gate = asyncio.Event()
+    order: list[str] = []
+    normal = [
+        asyncio.create_task(_blocked_run(scheduler, order, f"n{i}", f"u{i}", 1, gate))
+        for i in range(2)
+    ]
+    await asyncio.sleep(0)
+    # Solo una normal en curso, la otra espera
+    assert order == ["n0"]
+    high = asyncio.create_task(
+        _blocked_run(scheduler, order, "admin", "admin", 1, gate, Priority.HIGH)
+    )
+    await asyncio.sleep(0)
+    assert order == ["n0", "admin"]
+    gate.set()
+    await asyncio.gather(high, *normal)
+    assert order == ["n0", "admin", "n1"]
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_leak_slot():
+    scheduler = RequestScheduler(max_concurrency=1, reserved_high=0)
+    gate = asyncio.Event()
+    order: list[str] = []
+    first = asyncio.create_task(_blocked_run(scheduler, order, "first", "a", 1, gate))
+    waiting = asyncio.create_task(_blocked_run(scheduler, order, "cancel", "b", 1, gate))
+    last = asyncio.create_task(_blocked_run(scheduler, order, "last", "c", 1, gate))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    gate.set()
+    await asyncio.gather(first, last)
+    assert order == ["first", "last"]
+    assert scheduler.in_flight == 0
+    assert scheduler.queue_depth == 0
+
+@pytest.mark.asyncio
+async def test_sleep_releases_slot_while_waiting():
+    scheduler = RequestScheduler(max_concurrency=1, reserved_high=0)
+    order: list[str] = []
+
+    async def retrying():
+        order.append("retrying")
+        await scheduler.sleep(0.05)
+        order.append("retried")
+        return "retrying"
+
+    async def other():
+        order.append("other")
+        return "other"
+
+    first = asyncio.create_task(scheduler.run(retrying, user="a", channel=1))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(scheduler.run(other, user="b", channel=2))
+    assert await asyncio.gather(first, second) == ["retrying", "other"]
+    # El otro usuario no espera al backoff
+    assert order == ["retrying", "other", "retried"]
+    assert scheduler.in_flight == 0
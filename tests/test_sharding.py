@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import discord
+from openai.types.chat import ChatCompletion
+import pytest
+
+from dogimobot import settings
+from dogimobot.memory import ShardedConversationStore
+from dogimobot.rate_limiting import RateLimiter
+from dogimobot.sharding import (
+    ShardedDiscordClient,
+    ShardStatsExchange,
+    parse_shards,
+    split_shards,
+)
+from dogimobot.stats import BotStats
+
+
+@pytest.fixture
+def sharded_client(mock_settings, mock_openai, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_FOLDER", tmp_path)
+    return ShardedDiscordClient(
+        intents=discord.Intents.default(),
+        shard_ids=[0, 1],
+        shard_count=4,
+        process_name="shards-0-1",
+    )
+
+def _message(guild_id):
+    return SimpleNamespace(
+        guild=SimpleNamespace(id=guild_id),
+        channel=SimpleNamespace(id=1),
+        author=SimpleNamespace(name="testuser"),
+    )
+
+def test_parse_shards():
+    assert parse_shards("4-7") == [4, 5, 6, 7]
+    assert parse_shards("3") == [3]
+
+def test_split_shards():
+    assert split_shards(range(10), 3) == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    # Nunca hay más procesos que shards
+    assert split_shards([6, 7], 4) == [[6], [7]]
+
+def test_client_partitions_by_shard(sharded_client):
+    assert isinstance(sharded_client.memory, ShardedConversationStore)
+    assert sharded_client.summarizer.store is sharded_client.memory
+    assert sharded_client.shard_of(_message(5 << 22)) == 1
+    assert (settings.DATA_FOLDER / "shards" / "shards-0-1").is_dir()
+
+def test_record_batch_usage_feeds_shard_stats(sharded_client, reset_rate_limiter):
+    sharded_client._record_batch_usage([_message(6 << 22)], 60, 40)
+    assert sharded_client.bot_stats.shard_stats[2]["tokens"] == 100
+    assert sharded_client.bot_stats.shard_stats[2]["queries"] == 1
+    # Los tokens se cobran en el bucket global del shard
+    assert set(RateLimiter.global_buckets) == {2}
+
+def test_exchange_merges_peers(tmp_path):
+    mine, peer, stopped = BotStats(), BotStats(), BotStats()
+    mine.add_total_tokens(10)
+    mine.add_shard_stats(0, 10, 0.1)
+    peer.add_total_tokens(20)
+    peer.add_shard_stats(1, 20, 0.2)
+    stopped.add_total_tokens(40)
+    ShardStatsExchange("peer", tmp_path).publish(ShardStatsExchange.state_of(peer))
+    old = ShardStatsExchange.state_of(stopped)
+    old["updated"] -= 3600
+    ShardStatsExchange("stopped", tmp_path).publish(old)
+
+    exchange = ShardStatsExchange("mine", tmp_path, max_age=60)
+    exchange.publish(ShardStatsExchange.state_of(mine))
+    exchange.peers = exchange.read_peers()
+    assert set(exchange.peers) == {"peer", "stopped"}
+
+    session, alltime, shards = exchange.merge(mine)
+    # De los procesos parados solo cuentan los históricos
+    assert session["total_tokens"] == 30
+    assert alltime["total_tokens"] == 70
+    assert shards[0]["tokens"] == 10
+    assert shards[1]["tokens"] == 20
+
+@pytest.mark.asyncio
+async def test_batch_is_admitted_against_shard_bucket(sharded_client, reset_rate_limiter):
+    sharded_client.client_openai.chat = MagicMock()
+    sharded_client.client_openai.chat.completions.create = AsyncMock(
+        return_value=MagicMock(spec=ChatCompletion, choices=[], usage=None)
+    )
+    messages = [_message(6 << 22), _message(6 << 22)]
+    for message in messages:
+        message.content = "!chat hola"
+        message.channel.send = AsyncMock()
+    await sharded_client._handle_chat_batch(messages)
+    # Ni la admisión ni el cobro pasan por el bucket global sin shard
+    assert set(RateLimiter.global_buckets) == {2}
@@ -0,0 +1,263 @@
+import asyncio
+from unittest.mock import MagicMock
+
+from discord import Message
+import pytest
+
+from dogimobot import state
+from dogimobot.memory import ConversationStore
+from dogimobot.rate_limiting import RateLimiter
+from dogimobot.state import (
+    InMemoryStateBackend,
+    RedisStateBackend,
+    SQLiteStateBackend,
+    create_state_backend,
+    flatten_state,
+    unflatten_state,
+)
+from dogimobot.stats import BotStats
+
+KEY = (1, 1)
+# Bucket de 2 peticiones que se rellena en 60 segundos
+REQUESTS = ("user:a:requests", 2, 60, 1)
+
+
+def _entry(content: str) -> dict:
+    return {
+        "role": "user",
+        "content": content,
+        "author": "testuser",
+        "time": None,
+        "attachments": None,
+        "param": {"role": "user", "content": f"Test User dijo: {content}"},
+        "tokens": 10,
+    }
+
+def _message(author: str = "testuser") -> MagicMock:
+    message = MagicMock(spec=Message)
+    message.author.name = author
+    return message
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        backend = InMemoryStateBackend()
+    else:
+        backend = SQLiteStateBackend(tmp_path / "state.db")
+    yield backend
+    backend.close()
+
+def test_flatten_roundtrip():
+    state_ = BotStats.empty_state()
+    state_.update(total_tokens=30, total_queries=2, total_cost=0.3, max_cost=0.2)
+    state_["model_stats"] = {"org/modelo": {"tokens": 30, "cost": 0.3, "queries": 2}}
+    state_["budget_spend"] = {"user:a": {"2024-06-01": 0.2, "2024-06": 0.3}}
+    assert unflatten_state(flatten_state(state_)) == state_
+
+def test_acquire_is_all_or_nothing(backend):
+    tokens = ("user:a:tokens", 100, 60, 0)
+    assert backend.acquire([REQUESTS, tokens], 1000.0) is None
+    assert backend.acquire([REQUESTS, tokens], 1000.0) is None
+    retry_after = backend.acquire([REQUESTS, tokens], 1000.0)
+    assert retry_after == pytest.approx(30)
+    # Medio periodo después se ha recuperado una petición
+    assert backend.acquire([REQUESTS], 1030.0) is None
+
+def test_charge_is_applied_on_flush(backend):
+    tokens = ("user:a:tokens", 100, 60, 150)
+    backend.charge([tokens], 1000.0)
+    assert backend.pending == 1
+    assert backend.acquire([("user:a:tokens", 100, 60, 0)], 1000.0) is None
+    backend.flush()
+    # En deuda no se admiten más peticiones
+    assert backend.acquire([("user:a:tokens", 100, 60, 0)], 1000.0) is not None
+
+def test_stats_are_summed(backend):
+    bot_stats = BotStats()
+    backend.attach_stats(bot_stats)
+    bot_stats.add_total_tokens(100)
+    bot_stats.add_total_and_max_cost(0.5)
+    bot_stats.add_user_stats(_message(), 100, 0.5)
+    # Los cambios sin volcar se ven en este proceso
+    assert backend.stats_state()["total_tokens"] == 100
+    backend.flush()
+    bot_stats.add_total_tokens(50)
+    bot_stats.add_total_and_max_cost(0.25)
+    backend.flush()
+    totals = backend.stats_state()
+    assert totals["total_tokens"] == 150
+    assert totals["total_cost"] == pytest.approx(0.75)
+    assert totals["max_cost"] == 0.5
+    assert totals["user_stats"]["testuser"] == {"tokens": 100, "cost": 0.5, "queries": 1}
+
+def test_memory_load_includes_pending(backend):
+    first, second = _entry("a"), _entry("b")
+    backend.enqueue(KEY, first)
+    backend.flush()
+    backend.enqueue(KEY, second)
+    entries, summary, _ = backend.load(KEY, 10)
+    assert [e["content"] for e in entries] == ["a", "b"]
+    assert entries[1] is second
+    backend.save_summary(KEY, "Resumen", 5, [entries[0]])
+    entries, summary, summary_tokens = backend.load(KEY, 10)
+    assert [e["content"] for e in entries] == ["b"]
+    assert (summary, summary_tokens) == ("Resumen", 5)
+    backend.flush()
+    entries, summary, _ = backend.load(KEY, 10)
+    assert [e["content"] for e in entries] == ["b"]
+    assert entries[0]["db_id"] > first["db_id"]
+    assert summary == "Resumen"
+
+def test_sqlite_is_shared_between_processes(tmp_path):
+    # Dos backends sobre el mismo fichero hacen de dos procesos
+    path = tmp_path / "state.db"
+    first, second = SQLiteStateBackend(path), SQLiteStateBackend(path)
+    assert first.acquire([REQUESTS], 1000.0) is None
+    assert second.acquire([REQUESTS], 1000.0) is None
+    assert first.acquire([REQUESTS], 1000.0) is not None
+
+    stats_first, stats_second = BotStats(), BotStats()
+    first.attach_stats(stats_first)
+    second.attach_stats(stats_second)
+    stats_first.add_total_queries()
+    stats_second.add_total_queries()
+    first.enqueue(KEY, _entry("de uno"))
+    second.enqueue(KEY, _entry("de otro"))
+    first.flush()
+    second.flush()
+    assert first.stats_state()["total_queries"] == 2
+    assert [e["content"] for e in first.load(KEY, 10)[0]] == ["de uno", "de otro"]
+    first.close()
+    second.close()
+
+@pytest.mark.asyncio
+async def test_store_reloads_shared_conversation(tmp_path):
+    path = tmp_path / "state.db"
+    first, second = SQLiteStateBackend(path), SQLiteStateBackend(path)
+    store = ConversationStore(window_size=5, max_messages=100, backend=first)
+    await store.ensure_loaded(KEY)
+    store.append(KEY, _entry("a"))
+    assert [m["content"] for m in store.get(KEY)] == ["a"]
+    first.flush()
+    second.enqueue(KEY, _entry("b"))
+    second.flush()
+    # La conversación ya estaba en memoria pero se recarga
+    await store.ensure_loaded(KEY)
+    assert [m["content"] for m in store.get(KEY)] == ["a", "b"]
+    assert store.total_messages == 2
+    first.close()
+    second.close()
+
+@pytest.mark.asyncio
+async def test_store_reloads_only_new_versions(tmp_path, monkeypatch):
+    backend = SQLiteStateBackend(tmp_path / "state.db")
+    store = ConversationStore(window_size=5, max_messages=100, backend=backend)
+    await store.ensure_loaded(KEY)
+    store.append(KEY, _entry("a"))
+    store.get(KEY)
+    backend.flush()
+    await store.ensure_loaded(KEY)
+    assert store.get(KEY).version == backend.conversation_version(KEY)
+    load = MagicMock(wraps=backend.load)
+    monkeypatch.setattr(backend, "load", load)
+    # Sin escrituras nuevas no se vuelve a leer la conversación
+    for _ in range(3):
+        await store.ensure_loaded(KEY)
+        store.get(KEY)
+    load.assert_not_called()
+    backend.close()
+
+def test_conversation_version(backend):
+    assert backend.conversation_version(KEY) == (0, 0)
+    first, second = _entry("a"), _entry("b")
+    backend.enqueue(KEY, first)
+    backend.enqueue(KEY, second)
+    backend.flush()
+    assert backend.conversation_version(KEY) == (second["db_id"], 0)
+    backend.save_summary(KEY, "resumen", 5, [first])
+    backend.flush()
+    assert backend.conversation_version(KEY) == (second["db_id"], first["db_id"])
+    assert backend.conversation_version((1, 2)) == (0, 0)
+
+@pytest.mark.asyncio
+async def test_flush_does_not_block_pending_writes(backend, monkeypatch):
+    write = backend._write
+    started, release = asyncio.Event(), asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def slow_write(batch):
+        loop.call_soon_threadsafe(started.set)
+        asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+        write(batch)
+
+    monkeypatch.setattr(backend, "_write", slow_write)
+    backend.enqueue(KEY, _entry("a"))
+    flush = asyncio.create_task(
+        asyncio.to_thread(backend._flush_batch, backend._take_pending())
+    )
+    await started.wait()
+    # Mientras se escribe el event loop puede seguir encolando y volcando
+    backend.enqueue(KEY, _entry("b"))
+    batch = backend._take_pending()
+    assert len(batch) == 1
+    release.set()
+    await flush
+    backend._flush_batch(batch)
+    assert [m["content"] for m in backend._load_stored(KEY, 10)[0]] == ["a", "b"]
+
+def test_rate_limiter_uses_backend(reset_rate_limiter):
+    RateLimiter.backend = InMemoryStateBackend()
+    for _ in range(3):
+        assert RateLimiter.acquire("user1", msg_per_minute=3) is None
+    assert RateLimiter.acquire("user1", msg_per_minute=3) is not None
+    assert RateLimiter.rejections == 1
+    # El estado en memoria del rate limiter no se usa
+    assert not RateLimiter.buckets
+    RateLimiter.consume_tokens("user2", 10)
+    assert RateLimiter.backend.pending == 2
+    RateLimiter.reset()
+    assert RateLimiter.backend is None
+
+@pytest.mark.asyncio
+async def test_rate_limiter_acquire_async(reset_rate_limiter, tmp_path):
+    RateLimiter.backend = SQLiteStateBackend(tmp_path / "state.db")
+    for _ in range(3):
+        assert await RateLimiter.acquire_async("user1", msg_per_minute=3) is None
+    assert await RateLimiter.acquire_async("user1", msg_per_minute=3) is not None
+    assert RateLimiter.rejections == 1
+    RateLimiter.backend.close()
+
+@pytest.mark.asyncio
+async def test_run_flushes_in_background(backend):
+    backend.enqueue(KEY, _entry("hola"))
+    backend.flush_interval = 0.01
+    task = asyncio.create_task(backend.run())
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if backend.pending == 0:
+            break
+    task.cancel()
+    assert backend.pending == 0
+    assert backend._load_stored(KEY, 10)[0][0]["content"] == "hola"
+
+def test_create_state_backend(tmp_path, monkeypatch):
+    assert create_state_backend(None) is None
+    assert isinstance(create_state_backend("memory"), InMemoryStateBackend)
+    with pytest.raises(ValueError):
+        create_state_backend("cassandra")
+    monkeypatch.setattr(state, "redis", None)
+    with pytest.raises(RuntimeError, match="redis"):
+        RedisStateBackend()
+
+@pytest.mark.asyncio
+async def test_client_stats_come_from_backend(client):
+    client.state_backend = InMemoryStateBackend()
+    client.state_backend.attach_stats(client.bot_stats)
+    # Totales ya volcados por otra réplica
+    client.state_backend.counters.update(total_tokens=1000, total_queries=10)
+    client.bot_stats.add_total_tokens(100)
+    client.bot_stats.add_total_queries()
+    session, alltime, _ = await client._stats_snapshot()
+    assert session["total_tokens"] == 100
+    assert alltime["total_tokens"] == 1100
+    assert alltime["total_queries"] == 11
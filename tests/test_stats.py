@@ -1,7 +1,7 @@
 
 import pytest
 from collections import defaultdict
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from discord import Message
 
 from dogimobot.stats import BotStats
@@ -39,6 +39,22 @@ def test_calculate_total_cost(bot_stats: BotStats):
     expected_cost = (in_tokens / 1e6) * 0.0001 + (out_tokens / 1e6) * 0.0002
     assert total_cost == pytest.approx(expected_cost, rel=1e-6)
 
+def test_calculate_total_cost_with_model(bot_stats: BotStats):
+    with patch.dict(settings.OPENAI_PRICING, {"gpt-4": {"in": 30, "out": 60}}):
+        total_cost = bot_stats.calculate_total_cost(1000, 2000, "gpt-4")
+    assert total_cost == pytest.approx(1000 / 1e6 * 30 + 2000 / 1e6 * 60)
+
+def test_add_model_stats(bot_stats: BotStats):
+    bot_stats.enable_journal()
+    bot_stats.add_model_stats("gpt-4", 100, 0.5)
+    bot_stats.add_model_stats("gpt-4", 50, 0.25)
+    assert bot_stats.model_stats["gpt-4"] == {"tokens": 150, "cost": 0.75, "queries": 2}
+    state = BotStats.empty_state()
+    for delta in bot_stats.take_journal():
+        BotStats.apply_delta(state, delta)
+    assert state["model_stats"]["gpt-4"] == {"tokens": 150, "cost": 0.75, "queries": 2}
+    assert bot_stats.alltime_state()["model_stats"]["gpt-4"]["queries"] == 2
+
 def test_add_total_and_max_cost(bot_stats: BotStats):
     bot_stats.add_total_and_max_cost(0.001)
     assert bot_stats.total_cost == 0.001
@@ -65,3 +81,74 @@ def test_add_user_stats(bot_stats: BotStats):
     assert bot_stats.user_stats["test_user"]["tokens"] == 300
     assert bot_stats.user_stats["test_user"]["cost"] == 0.003
     assert bot_stats.user_stats["test_user"]["queries"] == 2
+
+def test_journal_disabled_by_default(bot_stats: BotStats):
+    bot_stats.add_total_queries()
+    assert bot_stats.journal is None
+
+def test_journal_records_deltas(bot_stats: BotStats):
+    message = MagicMock(spec=Message)
+    message.author.name = "test_user"
+    bot_stats.enable_journal()
+    bot_stats.add_total_tokens(100)
+    bot_stats.add_total_queries()
+    bot_stats.add_total_and_max_cost(0.5)
+    bot_stats.add_user_stats(message, 100, 0.5)
+    journal = bot_stats.take_journal()
+    assert [delta["op"] for delta in journal] == ["tokens", "queries", "cost", "user"]
+    assert bot_stats.journal == []
+
+    # Aplicar el diario reproduce el estado de la sesión
+    state = BotStats.empty_state()
+    for delta in journal:
+        BotStats.apply_delta(state, delta)
+    assert state == bot_stats.alltime_state()
+
+def test_alltime_state_adds_historical(bot_stats: BotStats):
+    message = MagicMock(spec=Message)
+    message.author.name = "test_user"
+    bot_stats.historical = {
+        "total_tokens": 1000,
+        "total_queries": 10,
+        "total_cost": 1.0,
+        "max_cost": 0.3,
+        "user_stats": {"test_user": {"tokens": 1000, "cost": 1.0, "queries": 10}},
+    }
+    bot_stats.add_total_tokens(100)
+    bot_stats.add_total_queries()
+    bot_stats.add_total_and_max_cost(0.5)
+    bot_stats.add_user_stats(message, 100, 0.5)
+    state = bot_stats.alltime_state()
+    assert state["total_tokens"] == 1100
+    assert state["total_queries"] == 11
+    assert state["total_cost"] == pytest.approx(1.5)
+    assert state["max_cost"] == 0.5
+    assert state["user_stats"]["test_user"] == {"tokens": 1100, "cost": 1.5, "queries": 11}
+    # Los históricos no se modifican
+    assert bot_stats.historical["total_tokens"] == 1000
+
+def test_merge_states():
+    first = BotStats.empty_state()
+    first.update(total_tokens=10, total_queries=1, total_cost=0.1, max_cost=0.1)
+    first["user_stats"] = {"a": {"tokens": 10, "cost": 0.1, "queries": 1}}
+    second = BotStats.empty_state()
+    second.update(total_tokens=30, total_queries=2, total_cost=0.3, max_cost=0.2)
+    second["user_stats"] = {
+        "a": {"tokens": 20, "cost": 0.2, "queries": 1},
+        "b": {"tokens": 10, "cost": 0.1, "queries": 1},
+    }
+    merged = BotStats.merge_states(first, second)
+    assert merged["total_tokens"] == 40
+    assert merged["total_queries"] == 3
+    assert merged["total_cost"] == pytest.approx(0.4)
+    assert merged["max_cost"] == 0.2
+    assert merged["user_stats"]["a"]["tokens"] == 30
+    assert merged["user_stats"]["b"]["queries"] == 1
+    # Los estados de entrada no se modifican
+    assert first["user_stats"]["a"]["tokens"] == 10
+
+def test_add_shard_stats(bot_stats: BotStats):
+    bot_stats.add_shard_stats(1, 100, 0.5)
+    bot_stats.add_shard_stats(1, 50, 0.25)
+    assert bot_stats.shard_stats[1] == {"tokens": 150, "cost": 0.75, "queries": 2}
+    assert 0 not in bot_stats.shard_stats
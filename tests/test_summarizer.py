@@ -0,0 +1,112 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion, Choice
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.completion_usage import CompletionUsage
+
+from dogimobot import settings
+from dogimobot.memory import ConversationStore
+from dogimobot.stats import BotStats
+from dogimobot.summarizer import ConversationSummarizer, summary_message
+
+KEY = (1, 1)
+
+
+def _entry(content: str, tokens: int = 100) -> dict:
+    return {
+        "role": "user",
+        "content": content,
+        "author": "testuser",
+        "param": {"role": "user", "content": content},
+        "tokens": tokens,
+    }
+
+def _completion(content: str) -> ChatCompletion:
+    return ChatCompletion(
+        id="summary",
+        object="chat.completion",
+        created=1677652288,
+        model="gpt-3.5-turbo",
+        choices=[
+            Choice(
+                index=0,
+                message=ChatCompletionMessage(role="assistant", content=content),
+                logprobs=None,
+                finish_reason="stop",
+            )
+        ],
+        usage=CompletionUsage(prompt_tokens=50, completion_tokens=10, total_tokens=60),
+    )
+
+@pytest.fixture
+def summarizer_setup():
+    store = ConversationStore(window_size=20, max_messages=100)
+    client_openai = MagicMock()
+    client_openai.chat.completions.create = AsyncMock(return_value=_completion("Resumen"))
+    summarizer = ConversationSummarizer(
+        store, client_openai, BotStats(), trigger_tokens=500, keep_messages=2
+    )
+    return store, client_openai, summarizer
+
+def test_summary_message():
+    assert summary_message("hola")["content"].endswith("hola")
+
+@pytest.mark.asyncio
+async def test_no_summary_below_threshold(summarizer_setup):
+    store, _, summarizer = summarizer_setup
+    for i in range(3):
+        store.append(KEY, _entry(str(i)))
+    assert summarizer.maybe_schedule(KEY) is None
+
+@pytest.mark.asyncio
+async def test_summarize_folds_oldest_messages(summarizer_setup):
+    store, client_openai, summarizer = summarizer_setup
+    for i in range(6):
+        store.append(KEY, _entry(str(i)))
+
+    task = summarizer.maybe_schedule(KEY)
+    assert task is not None
+    # No se lanza otro resumen mientras hay uno en curso
+    assert summarizer.maybe_schedule(KEY) is None
+    pricing = {"summary-model": {"in": 1, "out": 2}}
+    with patch.object(settings, "SUMMARY_MODEL", "summary-model"), patch.dict(
+        settings.OPENAI_PRICING, pricing
+    ):
+        await task
+
+    conversation = store.get(KEY)
+    assert conversation.summary == "Resumen"
+    assert [m["content"] for m in conversation] == ["4", "5"]
+    assert store.total_messages == 2
+    assert not conversation.summarizing
+    assert summarizer.bot_stats.total_tokens == 60
+    # Se cobra al precio del modelo de resúmenes
+    model_stats = summarizer.bot_stats.model_stats["summary-model"]
+    assert model_stats["tokens"] == 60
+    assert model_stats["cost"] == pytest.approx((50 * 1 + 10 * 2) / 1e6)
+    client_openai.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_summarize_keeps_messages_arrived_meanwhile(summarizer_setup):
+    store, client_openai, summarizer = summarizer_setup
+    for i in range(6):
+        store.append(KEY, _entry(str(i)))
+
+    async def slow_create(**kwargs):
+        store.append(KEY, _entry("nuevo"))
+        return _completion("Resumen")
+
+    client_openai.chat.completions.create = AsyncMock(side_effect=slow_create)
+    await summarizer.summarize(KEY)
+    assert [m["content"] for m in store.get(KEY)] == ["4", "5", "nuevo"]
+
+@pytest.mark.asyncio
+async def test_summarize_error_is_logged(summarizer_setup):
+    store, client_openai, summarizer = summarizer_setup
+    for i in range(6):
+        store.append(KEY, _entry(str(i)))
+    client_openai.chat.completions.create = AsyncMock(side_effect=Exception("boom"))
+    await summarizer.summarize(KEY)
+    assert store.get(KEY).summary == ""
+    assert len(store.get(KEY)) == 6
@@ -0,0 +1,45 @@
+from unittest.mock import patch
+
+from dogimobot import settings
+from dogimobot.tokens import (
+    CHARS_PER_TOKEN,
+    TOKENS_PER_MESSAGE,
+    _get_encoding,
+    count_message_tokens,
+    count_tokens,
+    get_context_budget,
+)
+
+
+def test_count_tokens_without_tokenizer():
+    with patch("dogimobot.tokens._get_encoding", return_value=None):
+        assert count_tokens("a" * (CHARS_PER_TOKEN * 3)) == 3
+        assert count_tokens("a" * (CHARS_PER_TOKEN * 3 + 1)) == 4
+        assert count_tokens("") == 0
+
+def test_count_tokens_with_tokenizer():
+    class FakeEncoding:
+        def encode(self, text):
+            return text.split()
+
+    with patch("dogimobot.tokens._get_encoding", return_value=FakeEncoding()):
+        assert count_tokens("uno dos tres") == 3
+
+def test_count_message_tokens_adds_overhead():
+    with patch("dogimobot.tokens._get_encoding", return_value=None):
+        assert count_message_tokens("a" * CHARS_PER_TOKEN) == 1 + TOKENS_PER_MESSAGE
+
+def test_get_context_budget():
+    with patch.dict(settings.OPENAI_CONTEXT_BUDGET, {"modelo-test": 123}):
+        assert get_context_budget("modelo-test") == 123
+    assert get_context_budget("modelo-inexistente") == settings.DEFAULT_CONTEXT_BUDGET
+
+def test_fallback_warns_once():
+    _get_encoding.cache_clear()
+    with patch("dogimobot.tokens.tiktoken", None), patch(
+        "dogimobot.tokens._fallback_warned", False
+    ), patch("dogimobot.tokens.logger") as mock_logger:
+        count_tokens("hola", model="modelo-a")
+        count_tokens("hola", model="modelo-b")
+        assert mock_logger.warning.call_count == 1
+    _get_encoding.cache_clear()
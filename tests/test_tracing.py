@@ -0,0 +1,61 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from dogimobot.tracing import LatencyHistogram, Tracer
+
+
+def test_percentiles():
+    histogram = LatencyHistogram(window=1000)
+    for value in range(1, 101):
+        histogram.add(value / 1000)
+    p50, p95, p99 = histogram.percentiles(0.5, 0.95, 0.99)
+    assert p50 == pytest.approx(0.051)
+    assert p95 == pytest.approx(0.096)
+    assert p99 == pytest.approx(0.1)
+    assert LatencyHistogram(window=10).percentiles(0.5) == [0.0]
+
+
+def test_histogram_window_is_rolling():
+    histogram = LatencyHistogram(window=3)
+    for value in [10.0, 1.0, 1.0, 1.0]:
+        histogram.add(value)
+    assert histogram.percentiles(0.99) == [1.0]
+    assert histogram.count == 4
+
+
+def test_span_records_stage():
+    tracer = Tracer(window=10, sample_rate=0.0)
+    with patch("dogimobot.tracing.time.perf_counter", side_effect=[1.0, 1.25]):
+        with tracer.span("context"):
+            pass
+    summary = tracer.summary()
+    assert summary["context"]["count"] == 1
+    assert summary["context"]["p50"] == pytest.approx(250.0)
+
+
+@pytest.mark.asyncio
+async def test_span_measures_awaits():
+    tracer = Tracer(window=10, sample_rate=0.0)
+    with tracer.span("openai"):
+        await asyncio.sleep(0.01)
+    assert tracer.summary()["openai"]["p50"] >= 10
+
+
+def test_sampled_trace():
+    tracer = Tracer(window=10, sample_rate=1.0)
+    assert tracer.start_trace()
+    assert tracer.is_tracing()
+    tracer.record("memory", 0.001)
+    tracer.record("send", 0.002)
+    assert tracer.finish_trace() == "memory: 1.0 ms | send: 2.0 ms"
+    assert not tracer.is_tracing()
+
+
+def test_unsampled_trace():
+    tracer = Tracer(window=10, sample_rate=0.0)
+    assert not tracer.start_trace()
+    tracer.record("memory", 0.001)
+    assert tracer.finish_trace() is None
+    assert tracer.summary()["memory"]["count"] == 1
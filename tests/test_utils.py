@@ -1,33 +1,29 @@
 
+from importlib.metadata import PackageNotFoundError
 import os
-from unittest.mock import patch, mock_open
+from pathlib import Path
+from unittest.mock import patch
 
 import pytest
+import toml
 
-from dogimobot.utils import get_project_version, get_openai_key
-
-def test_get_project_version_success():
-    mock_toml_content = """
-    [tool.poetry]
-    version = "1.2.0"
-    """
-    with patch("builtins.open", mock_open(read_data=mock_toml_content)):
-        with patch("toml.load", return_value={"tool": {"poetry": {"version": "1.2.0"}}}):
-            assert get_project_version() == "1.2.0"
-
-def test_get_project_version_missing_key():
-    mock_toml_content = """
-    [tool.poetry]
-    """
-    with patch("builtins.open", mock_open(read_data=mock_toml_content)):
-        with patch("toml.load", return_value={"tool": {"poetry": {}}}):
-            with pytest.raises(KeyError):
-                get_project_version()
-
-def test_get_project_version_file_not_found():
-    with patch("builtins.open", side_effect=FileNotFoundError):
-        with pytest.raises(FileNotFoundError):
-            get_project_version()
+from dogimobot._version import __version__
+from dogimobot.utils import PROJECT_VERSION, get_project_version, get_openai_key
+
+def test_get_project_version_from_metadata():
+    with patch("dogimobot.utils.version", return_value="1.2.0"):
+        assert get_project_version() == "1.2.0"
+
+def test_get_project_version_fallback():
+    with patch("dogimobot.utils.version", side_effect=PackageNotFoundError("dogimobot")):
+        assert get_project_version() == __version__
+
+def test_baked_version_matches_pyproject():
+    pyproject = Path(__file__).parent.parent / "pyproject.toml"
+    assert toml.load(pyproject)["tool"]["poetry"]["version"] == __version__
+
+def test_project_version_constant():
+    assert PROJECT_VERSION == get_project_version()
 
 def test_get_openai_key_success():
     with patch.dict(os.environ, {"OPENAI_API_KEY": "test_key"}):